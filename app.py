@@ -1,22 +1,54 @@
 # app.py
 from flask import (
     Flask, render_template, render_template_string, request, redirect, url_for, flash, session,
-    send_file, send_from_directory, jsonify, Response, abort
+    send_file, send_from_directory, jsonify, Response, abort, g, has_request_context,
+    before_render_template, template_rendered,
 )
 from flask_sqlalchemy import SQLAlchemy
-from werkzeug.security import generate_password_hash, check_password_hash
+from flask_sqlalchemy.session import Session as _SessaoFlaskSQLAlchemy
+from werkzeug.security import generate_password_hash, check_password_hash, safe_join
 from werkzeug.utils import secure_filename
 from datetime import datetime, timedelta, timezone
 from io import BytesIO
-from sqlalchemy import text, func, Index, case
+from collections import OrderedDict, namedtuple
+from sqlalchemy import (
+    text, func, select, union_all, literal, literal_column, String, Index, case, event, bindparam,
+    cast, null, and_, or_,
+)
+from sqlalchemy.engine import Engine
+from sqlalchemy.orm import selectinload
+from sqlalchemy.schema import CreateIndex
+from sqlalchemy.sql.dml import UpdateBase
+from sqlalchemy.pool import QueuePool
+from sqlalchemy import exc as sa_exc
 from werkzeug.middleware.proxy_fix import ProxyFix
-from jinja2 import TemplateNotFound
+from jinja2 import FileSystemBytecodeCache, FileSystemLoader, TemplateNotFound, nodes
+from jinja2.ext import Extension
 from zoneinfo import ZoneInfo
 import os
+import re
+import mimetypes
+import sys
+import bisect
+import functools
+import logging
+import json
+import math
+import heapq
 import time
 import hashlib
 import secrets
-from itsdangerous import URLSafeTimedSerializer, BadSignature, SignatureExpired
+import threading
+import atexit
+import struct
+import random
+import itertools
+import zlib
+from array import array
+import click
+from itsdangerous import URLSafeSerializer, URLSafeTimedSerializer, BadSignature, SignatureExpired
+
+from tarefas_fundo import CONEXOES_FUNDO, TAREFAS_FUNDO
 
 # ========= FUSO-HORÁRIO =========
 BR_TZ = ZoneInfo("America/Sao_Paulo")
@@ -80,13 +112,16 @@ def sso_load_shared(token: str, max_age_seconds: int = 60):
 # Corrige scheme/host atrás do proxy para cookies seguros e redirects corretos
 app.wsgi_app = ProxyFix(app.wsgi_app, x_for=1, x_proto=1, x_host=1, x_port=1)
 
+# Modo de execução: APP_ENV=producao|dev (no Render o padrão é produção)
+app.config['PRODUCAO'] = os.environ.get('APP_ENV', 'producao' if os.environ.get('RENDER') else 'dev') == 'producao'
+
 # Sessão/Cookies
 app.permanent_session_lifetime = timedelta(hours=10)
 app.config.update(
     SESSION_COOKIE_SAMESITE='Lax',
     SESSION_COOKIE_HTTPONLY=True,
     SESSION_COOKIE_SECURE=True,   # Render usa HTTPS
-    TEMPLATES_AUTO_RELOAD=True,   # útil no dev
+    TEMPLATES_AUTO_RELOAD=not app.config['PRODUCAO'],   # no dev, edita e recarrega
     JSONIFY_PRETTYPRINT_REGULAR=False,
     JSON_SORT_KEYS=False,
 )
@@ -101,6 +136,10 @@ def _build_db_uri() -> str:
             '@dpg-d28sr2juibrs73du5n80-a.oregon-postgres.render.com/banco_dados_9ooo'
             '?sslmode=require'
         )
+    return _normalizar_db_uri(url)
+
+
+def _normalizar_db_uri(url: str) -> str:
     if url.startswith("postgres://"):
         url = url.replace("postgres://", "postgresql+psycopg://", 1)
     elif url.startswith("postgresql://") and "+psycopg" not in url:
@@ -110,19 +149,269 @@ def _build_db_uri() -> str:
     return url
 
 
+# Hash de senha: trocar o método faz o login regravar o hash no próximo acesso.
+# (scrypt do Werkzeug 3 gera hash maior que as colunas senha_hash VARCHAR(128))
+SENHA_HASH_METODO = os.environ.get('SENHA_HASH_METODO', 'pbkdf2:sha256:600000')
+
+
+def gerar_hash_senha(senha: str) -> str:
+    return generate_password_hash(senha, method=SENHA_HASH_METODO)
+
+
+def hash_precisa_atualizar(senha_hash: str | None) -> bool:
+    return bool(senha_hash) and senha_hash.split('$', 1)[0] != SENHA_HASH_METODO
+
+
+class _TelemetriaPool:
+    """Contadores do pool de um engine (lidos em /api/admin/metricas)."""
+    LIMITES_MS = (1, 5, 10, 25, 50, 100, 250, 500, 1000, 5000, 30000)
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.baldes = [0] * (len(self.LIMITES_MS) + 1)   # histograma da espera no checkout
+        self.checkouts = 0
+        self.espera_total_s = 0.0
+        self.espera_max_s = 0.0
+        self.timeouts = 0
+        self.conexoes = 0              # conexões abertas dentro do checkout (overflow/reconexão)
+        self.conexao_total_s = 0.0
+        self.conexao_max_s = 0.0
+        self.pre_ping_falhas = 0
+        self.invalidacoes = 0
+        self.pico_em_uso = 0
+        self.ajustes: list[dict] = []
+        self.janelas_calmas = 0
+        self._janela = [0, 0, 0, 0]   # checkouts, esperas lentas, timeouts, pico em uso (modo adaptativo)
+
+    def registrar(self, espera_s: float, em_uso: int, timeout: bool = False, conexao_s: float = 0.0):
+        with self.lock:
+            if conexao_s:
+                self.conexoes += 1
+                self.conexao_total_s += conexao_s
+                self.conexao_max_s = max(self.conexao_max_s, conexao_s)
+            self.baldes[bisect.bisect_left(self.LIMITES_MS, espera_s * 1000)] += 1
+            self.checkouts += 1
+            self.espera_total_s += espera_s
+            self.espera_max_s = max(self.espera_max_s, espera_s)
+            self.pico_em_uso = max(self.pico_em_uso, em_uso)
+            j = self._janela
+            j[0] += 1
+            j[1] += espera_s * 1000 > app.config['DB_POOL_ESPERA_ALVO_MS']
+            j[3] = max(j[3], em_uso)
+            if timeout:
+                self.timeouts += 1
+                j[2] += 1
+
+    def fechar_janela(self) -> tuple[int, int, int, int]:
+        with self.lock:
+            janela, self._janela = tuple(self._janela), [0, 0, 0, 0]
+        return janela
+
+
+class PoolInstrumentado(QueuePool):
+    """
+    QueuePool que mede quanto cada checkout esperou por uma conexão. Só conta
+    a espera na fila: o connect de uma conexão nova (overflow, TCP+TLS até o
+    Postgres) é medido à parte, senão cada overflow pareceria fila e o modo
+    adaptativo abriria ainda mais overflow.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.telemetria = _TelemetriaPool()
+        self._medicao = threading.local()
+
+    def _create_connection(self):
+        inicio = time.perf_counter()
+        try:
+            return super()._create_connection()
+        finally:
+            m = self._medicao
+            m.conexao_s = getattr(m, 'conexao_s', 0.0) + (time.perf_counter() - inicio)
+
+    def _do_get(self):
+        m = self._medicao
+        if getattr(m, 'medindo', False):
+            # QueuePool._do_get chama a si mesmo quando perde a corrida pelo overflow
+            return super()._do_get()
+        m.medindo, m.conexao_s = True, 0.0
+        inicio = time.perf_counter()
+        try:
+            registro = super()._do_get()
+        except sa_exc.TimeoutError:
+            self.telemetria.registrar(time.perf_counter() - inicio - m.conexao_s, self.checkedout(),
+                                      timeout=True)
+            raise
+        finally:
+            m.medindo = False
+        espera = time.perf_counter() - inicio - m.conexao_s
+        self.telemetria.registrar(espera, self.checkedout(), conexao_s=m.conexao_s)
+        if espera >= 1.0:
+            app.logger.warning("Checkout do pool esperou %.2fs (%s)", espera, self.status())
+        return registro
+
+    def _invalidate(self, connection, exception=None, _checkin=True):
+        self.telemetria.invalidacoes += 1
+        return super()._invalidate(connection, exception, _checkin)
+
+    @property
+    def max_overflow(self) -> int:
+        return self._max_overflow
+
+    def ajustar_max_overflow(self, novo: int):
+        """
+        Muda o limite de overflow com o pool em uso (modo adaptativo). Conexões
+        de overflow já abertas acima do novo limite fecham na devolução.
+        """
+        if self._max_overflow < 0 or novo < 0:
+            return   # pool_size=0: overflow sem limite, não há o que ajustar
+        with self._overflow_lock:
+            self._max_overflow = novo
+
+    def capacidade(self) -> int:
+        """Conexões que o pool abre no máximo agora (pool_size + max_overflow)."""
+        return self.size() + self._max_overflow
+
+
 # SQLAlchemy
 app.config['SQLALCHEMY_DATABASE_URI'] = _build_db_uri()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# (o gunicorn.conf.py dimensiona as threads por worker com estes mesmos valores)
 app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'poolclass': PoolInstrumentado,
     'pool_pre_ping': True,
-    'pool_size': 5,
-    'max_overflow': 10,
-    'pool_timeout': 30,
+    'pool_size': int(os.environ.get('DB_POOL_SIZE', '5')),
+    'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', '10')),
+    'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', '30')),
     'pool_recycle': 1800,
 }
 
+
+def _opcoes_driver(url: str) -> dict:
+    """
+    psycopg 3 prepara no servidor o comando executado prepare_threshold vezes
+    na mesma conexão (padrão do driver: 5). Os comandos pré-montados geram
+    sempre o mesmo SQL e passam disso logo; as consultas avulsas ficam sem
+    PREPARE, em vez de encher o cache de 100 comandos da conexão e forçar
+    DEALLOCATEs. DB_PREPARE_THRESHOLD=N troca o limite; "off" desliga, p.ex.
+    atrás de um pgbouncer em modo transaction.
+    """
+    limite = os.environ.get('DB_PREPARE_THRESHOLD')
+    if not url.startswith('postgresql+psycopg') or not limite:
+        return {}
+    return {'connect_args': {'prepare_threshold': None if limite == 'off' else int(limite)}}
+
+
+app.config['SQLALCHEMY_ENGINE_OPTIONS'].update(_opcoes_driver(app.config['SQLALCHEMY_DATABASE_URI']))
+# Réplica de leitura (opcional): as views marcadas com @ler_da_replica leem dela,
+# menos nos REPLICA_JANELA_S segundos depois de uma escrita do próprio usuário.
+if os.environ.get('DATABASE_REPLICA_URL'):
+    _url_replica = _normalizar_db_uri(os.environ['DATABASE_REPLICA_URL'])
+    app.config['SQLALCHEMY_BINDS'] = {'replica': {
+        'url': _url_replica,
+        **{k: v for k, v in app.config['SQLALCHEMY_ENGINE_OPTIONS'].items() if k != 'connect_args'},
+        **_opcoes_driver(_url_replica),
+    }}
+app.config['REPLICA_JANELA_S'] = float(os.environ.get('REPLICA_JANELA_S', '15'))
+
+# Pool adaptativo (opcional): a cada DB_POOL_AJUSTE_S, cresce o max_overflow se
+# muitos checkouts esperaram mais que DB_POOL_ESPERA_ALVO_MS e encolhe quando
+# sobra conexão. Teto = DB_POOL_TETO (padrão: threads do gunicorn + conexões das
+# tarefas de fundo, com a mesma conta do gunicorn.conf.py; mais conexões que isso
+# nunca são usadas).
+app.config['DB_POOL_ADAPTATIVO'] = os.environ.get('DB_POOL_ADAPTATIVO', '0') == '1'
+app.config['DB_POOL_AJUSTE_S'] = float(os.environ.get('DB_POOL_AJUSTE_S', '10'))
+app.config['DB_POOL_ESPERA_ALVO_MS'] = float(os.environ.get('DB_POOL_ESPERA_ALVO_MS', '50'))
+
+
+def _threads_gunicorn() -> int:
+    if os.environ.get('GUNICORN_PERFIL') == 'sync':
+        return 1
+    opcoes = app.config['SQLALCHEMY_ENGINE_OPTIONS']
+    return int(os.environ.get('GUNICORN_THREADS')
+               or max(1, opcoes['pool_size'] + opcoes['max_overflow'] - CONEXOES_FUNDO))
+
+
+app.config['DB_POOL_TETO'] = int(os.environ.get('DB_POOL_TETO') or _threads_gunicorn() + CONEXOES_FUNDO)
+
+# Localização do app: grava em lote (write-behind) a cada N ms
+app.config['LOC_WRITE_BEHIND'] = os.environ.get('LOC_WRITE_BEHIND', '1') != '0'
+app.config['LOC_FLUSH_MS'] = int(os.environ.get('LOC_FLUSH_MS', '1000'))
+app.config['LOC_MAX_PONTOS_LOTE'] = int(os.environ.get('LOC_MAX_PONTOS_LOTE', '500'))
+
+# Histórico de localização: resolução total por N dias, 1 ponto/min até M dias
+app.config['LOC_HISTORICO'] = os.environ.get('LOC_HISTORICO', '1') != '0'
+app.config['LOC_HIST_DIAS_COMPLETO'] = int(os.environ.get('LOC_HIST_DIAS_COMPLETO', '7'))
+app.config['LOC_HIST_DIAS_RETENCAO'] = int(os.environ.get('LOC_HIST_DIAS_RETENCAO', '90'))
+
+# Índice espacial em memória (grade lat/lng) das posições dos cooperados
+app.config['GEO_CELULA_GRAUS'] = float(os.environ.get('GEO_CELULA_GRAUS', '0.01'))  # ~1,1 km
+app.config['GEO_SYNC_S'] = float(os.environ.get('GEO_SYNC_S', '5'))
+
+# Presença: cooperado fica online até PRESENCA_TTL_S sem heartbeat
+app.config['PRESENCA_TTL_S'] = int(os.environ.get('PRESENCA_TTL_S', '90'))
+app.config['PRESENCA_SWEEP_S'] = float(os.environ.get('PRESENCA_SWEEP_S', '5'))
+app.config['PRESENCA_SWEEP_GLOBAL_S'] = float(os.environ.get('PRESENCA_SWEEP_GLOBAL_S', '60'))
+
+# Cache token do app -> cooperado_id (TTL curto: outros workers não recebem a invalidação)
+app.config['APP_TOKEN_CACHE_TTL_S'] = float(os.environ.get('APP_TOKEN_CACHE_TTL_S', '60'))
+app.config['APP_TOKEN_CACHE_NEG_TTL_S'] = float(os.environ.get('APP_TOKEN_CACHE_NEG_TTL_S', '15'))
+app.config['APP_TOKEN_CACHE_MAX'] = int(os.environ.get('APP_TOKEN_CACHE_MAX', '20000'))
+app.config['APP_TOKEN_CACHE_NEG_MAX'] = int(os.environ.get('APP_TOKEN_CACHE_NEG_MAX', '2000'))
+
+# Identidade do usuário logado (nome etc.) em cache por worker
+app.config['IDENTIDADE_CACHE_TTL_S'] = float(os.environ.get('IDENTIDADE_CACHE_TTL_S', '30'))
+
+# Limites por endpoint: taxa (req/s) e rajada do token bucket, chave do balde
+# ('ip', 'app_token' ou 'sessao'), métodos limitados e máx. de requisições
+# simultâneas no worker. RATE_LIMITS_JSON (mesmo formato) sobrescreve por endpoint.
+app.config['RATE_LIMITS'] = {
+    'login': {'taxa': 0.2, 'rajada': 10, 'chave': 'ip', 'metodos': ['POST'], 'concorrencia': 4},
+    'api_app_localizacao': {'taxa': 1.0, 'rajada': 20, 'chave': 'app_token', 'concorrencia': 32},
+    'api_app_localizacao_lote': {'taxa': 0.5, 'rajada': 10, 'chave': 'app_token', 'concorrencia': 16},
+    'registrar_story_view': {'taxa': 2.0, 'rajada': 30, 'chave': 'sessao', 'concorrencia': 16},
+}
+for _ep, _cfg in json.loads(os.environ.get('RATE_LIMITS_JSON') or '{}').items():
+    app.config['RATE_LIMITS'][_ep] = {**app.config['RATE_LIMITS'].get(_ep, {}), **_cfg}
+# Endpoints que respondem 503 na hora quando o pool do banco está esgotado
+app.config['DB_GUARD_ENDPOINTS'] = set(app.config['RATE_LIMITS'])
+
+# Instrumentação por requisição: Server-Timing, linha de log JSON e, acima do
+# limite, o SQL executado (no máx. SLOW_REQUEST_MAX_SQL comandos)
+app.config['TIMING_LOG'] = os.environ.get('TIMING_LOG', '1') != '0'
+app.config['SLOW_REQUEST_MS'] = float(os.environ.get('SLOW_REQUEST_MS', '500'))
+app.config['SLOW_REQUEST_MAX_SQL'] = int(os.environ.get('SLOW_REQUEST_MAX_SQL', '50'))
+
+# Profiler por amostragem (ligado por admin em /api/admin/profiler). Com
+# PROFILER_TOKEN definido, o header X-Coopex-Profile: <token> perfila a requisição.
+app.config['PROFILER_TOKEN'] = os.environ.get('PROFILER_TOKEN') or None
+app.config['PROFILER_INTERVALO_MS'] = float(os.environ.get('PROFILER_INTERVALO_MS', '5'))
+app.config['PROFILER_MAX_ARQUIVOS'] = int(os.environ.get('PROFILER_MAX_ARQUIVOS', '50'))
+
 # Estáticos (cache padrão de 1 dia)
 app.config['SEND_FILE_MAX_AGE_DEFAULT'] = 24 * 60 * 60
+# CSS/JS extraídos dos templates para static/<ASSETS_SUBDIR> (nome = hash do conteúdo).
+# Blocos menores que ASSETS_MIN_BYTES não compensam uma requisição a mais.
+app.config['ASSETS_EXTRAIR'] = os.environ.get('ASSETS_EXTRAIR', '1') != '0'
+app.config['ASSETS_SUBDIR'] = 'build'
+app.config['ASSETS_MIN_BYTES'] = int(os.environ.get('ASSETS_MIN_BYTES', '512'))
+app.config['ASSETS_MAX_AGE'] = 365 * 24 * 60 * 60
+# Templates em produção: bytecode do Jinja em disco (compartilhado por workers e
+# restarts) e pré-compilação de todos os templates no boot
+_padrao_prod = '1' if app.config['PRODUCAO'] else '0'
+app.config['TEMPLATES_BYTECODE_CACHE'] = os.environ.get('TEMPLATES_BYTECODE_CACHE', _padrao_prod) != '0'
+app.config['TEMPLATES_PRECOMPILAR'] = os.environ.get('TEMPLATES_PRECOMPILAR', _padrao_prod) != '0'
+# Compressão (gzip; brotli se o módulo estiver instalado). Os níveis valem
+# para respostas dinâmicas; estáticos são comprimidos uma vez no nível máximo.
+app.config['COMPRESSAO'] = os.environ.get('COMPRESSAO', '1') != '0'
+app.config['COMPRESSAO_MIN_BYTES'] = int(os.environ.get('COMPRESSAO_MIN_BYTES', '1024'))
+app.config['COMPRESSAO_GZIP_NIVEL'] = int(os.environ.get('COMPRESSAO_GZIP_NIVEL', '5'))
+app.config['COMPRESSAO_BR_NIVEL'] = int(os.environ.get('COMPRESSAO_BR_NIVEL', '4'))
+# ETag/304 nas páginas de admin por versão de conteúdo (@get_condicional)
+app.config['ETAG_PAGINAS'] = os.environ.get('ETAG_PAGINAS', '1') != '0'
+# Cache de fragmentos de template ({% cache %}), por processo
+app.config['FRAGMENTOS_CACHE'] = os.environ.get('FRAGMENTOS_CACHE', '1') != '0'
+app.config['FRAGMENTOS_MAX_ITENS'] = int(os.environ.get('FRAGMENTOS_MAX_ITENS', '256'))
 
 # Pastas
 app.config['UPLOAD_FOLDER_COOPERADOS'] = 'static/uploads'
@@ -137,20 +426,60 @@ os.makedirs(app.config['UPLOAD_FOLDER_STORIES'], exist_ok=True)
 os.makedirs(app.config['UPLOAD_FOLDER_CATALOGOS'], exist_ok=True)
 os.makedirs(app.config['STATICS_FOLDER'], exist_ok=True)
 
-# Compressão Gzip (opcional)
-try:
-    from flask_compress import Compress
-    Compress(app)
-except Exception:
-    pass
 
-db = SQLAlchemy(app)
+# ========= ROTEAMENTO PRIMÁRIO / RÉPLICA =========
+def _tem_replica() -> bool:
+    return 'replica' in (app.config.get('SQLALCHEMY_BINDS') or {})
 
 
-# ====== garantir criação de tabelas em runtime (sem apagar nada) ======
-def ensure_schema():
-    """Cria colunas no banco se ainda não existirem (sem Alembic)."""
-    
+class SessaoRoteada(_SessaoFlaskSQLAlchemy):
+    """
+    Com g.usar_replica (views @ler_da_replica) as leituras vão para a réplica;
+    flush e INSERT/UPDATE/DELETE sempre vão para o primário, e depois da
+    primeira escrita da requisição as leituras também voltam para ele.
+    """
+
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if (bind is None and not self._flushing and not isinstance(clause, UpdateBase)
+                and has_request_context() and g.get('usar_replica') and not g.get('escreveu')):
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+
+@event.listens_for(SessaoRoteada, 'after_flush')
+def _marcar_escrita_flush(sessao, flush_context):
+    if has_request_context():
+        g.escreveu = True
+
+
+@event.listens_for(SessaoRoteada, 'do_orm_execute')
+def _marcar_escrita_dml(estado):
+    if (estado.is_insert or estado.is_update or estado.is_delete) and has_request_context():
+        g.escreveu = True
+
+
+def ler_da_replica(view):
+    """Relatórios/listagens só de leitura: usam a réplica se configurada, exceto
+    logo após uma escrita do mesmo usuário (read-your-writes via sessão)."""
+    @functools.wraps(view)
+    def wrapper(*args, **kwargs):
+        if _tem_replica():
+            ultima = session.get('_escrita_ts') or 0
+            g.usar_replica = time.time() - ultima > app.config['REPLICA_JANELA_S']
+        return view(*args, **kwargs)
+    return wrapper
+
+
+db = SQLAlchemy(app, session_options={'class_': SessaoRoteada})
+
+
+@app.after_request
+def _lembrar_escrita(resp: Response):
+    # o carimbo vai no cookie de sessão: vale em qualquer worker
+    if g.get('escreveu') and _tem_replica() and session.get('user_id'):
+        session['_escrita_ts'] = time.time()
+    return resp
+
 
 class LocalizacaoCooperado(db.Model):
     __tablename__ = 'localizacao_cooperado'
@@ -163,104 +492,13 @@ class LocalizacaoCooperado(db.Model):
     speed = db.Column(db.Float, nullable=True)
     online = db.Column(db.Boolean, default=False, index=True)
     fonte = db.Column(db.String(30), default='android_native')
-    atualizado_em = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    atualizado_em = db.Column(db.DateTime, default=datetime.utcnow, index=True)   # relógio do aparelho
+    # relógio do servidor na última escrita: os outros workers sincronizam por ela,
+    # porque pontos enviados atrasados chegam com atualizado_em antigo
+    gravado_em = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
     cooperado = db.relationship('Cooperado')
 
-with app.app_context():
-        # ===== cooperado =====
-        try:
-            cols_coop = {
-                r[0] for r in db.session.execute(text(
-                    "SELECT column_name FROM information_schema.columns "
-                    "WHERE table_name = 'cooperado'"
-                )).fetchall()
-            }
-        except Exception:
-            cols_coop = set()
-
-        alter_coop = []
-        if 'foto_data' not in cols_coop:
-            alter_coop.append("ADD COLUMN IF NOT EXISTS foto_data BYTEA")
-        if 'foto_mimetype' not in cols_coop:
-            alter_coop.append("ADD COLUMN IF NOT EXISTS foto_mimetype VARCHAR(50)")
-        if 'foto_filename' not in cols_coop:
-            alter_coop.append("ADD COLUMN IF NOT EXISTS foto_filename VARCHAR(120)")
-        if 'credito_atualizado_em' not in cols_coop:
-            alter_coop.append("ADD COLUMN IF NOT EXISTS credito_atualizado_em TIMESTAMP NULL")
-        if 'senha_hash' not in cols_coop:
-            alter_coop.append("ADD COLUMN IF NOT EXISTS senha_hash VARCHAR(128)")
-        if 'app_token' not in cols_coop:
-            alter_coop.append("ADD COLUMN IF NOT EXISTS app_token VARCHAR(120)")
-
-        if alter_coop:
-            try:
-                db.session.execute(text("ALTER TABLE cooperado " + ", ".join(alter_coop)))
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
-
-        try:
-            db.session.execute(text(
-                "CREATE UNIQUE INDEX IF NOT EXISTS ix_cooperado_app_token ON cooperado (app_token)"
-            ))
-            db.session.commit()
-        except Exception:
-            db.session.rollback()
-
-        # ===== estabelecimento =====
-        try:
-            cols_est = {
-                r[0] for r in db.session.execute(text(
-                    "SELECT column_name FROM information_schema.columns "
-                    "WHERE table_name = 'estabelecimento'"
-                )).fetchall()
-            }
-        except Exception:
-            cols_est = set()
-
-        alter_est = []
-        if 'logo_data' not in cols_est:
-            alter_est.append("ADD COLUMN IF NOT EXISTS logo_data BYTEA")
-        if 'logo_mimetype' not in cols_est:
-            alter_est.append("ADD COLUMN IF NOT EXISTS logo_mimetype VARCHAR(50)")
-        if 'logo_filename' not in cols_est:
-            alter_est.append("ADD COLUMN IF NOT EXISTS logo_filename VARCHAR(120)")
-
-        if alter_est:
-            try:
-                db.session.execute(text("ALTER TABLE estabelecimento " + ", ".join(alter_est)))
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
-
-        # ===== lancamento =====
-        try:
-            cols_lanc = {
-                r[0] for r in db.session.execute(text(
-                    "SELECT column_name FROM information_schema.columns "
-                    "WHERE table_name = 'lancamento'"
-                )).fetchall()
-            }
-        except Exception:
-            cols_lanc = set()
-
-        alter_lanc = []
-        if 'parcelas_total' not in cols_lanc:
-            alter_lanc.append("ADD COLUMN IF NOT EXISTS parcelas_total INTEGER DEFAULT 4")
-        if 'saldo_aberto' not in cols_lanc:
-            alter_lanc.append("ADD COLUMN IF NOT EXISTS saldo_aberto DOUBLE PRECISION")
-        if 'concluido' not in cols_lanc:
-            alter_lanc.append("ADD COLUMN IF NOT EXISTS concluido BOOLEAN DEFAULT FALSE")
-
-        if alter_lanc:
-            try:
-                db.session.execute(text("ALTER TABLE lancamento " + ", ".join(alter_lanc)))
-                db.session.commit()
-            except Exception:
-                db.session.rollback()
-
-
 # ========= MODELS =========
 class Cooperado(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -275,12 +513,20 @@ class Cooperado(db.Model):
     senha_hash = db.Column(db.String(128), nullable=True)
     app_token = db.Column(db.String(120), unique=True, nullable=True, index=True)
 
-    def ensure_app_token(self):
-        if not self.app_token:
-            self.app_token = secrets.token_urlsafe(32)
+    def ensure_app_token(self, rotacionar: bool = False):
+        """
+        Gera o token do app se faltar; rotacionar=True troca o atual. A troca
+        só sai do cache deste worker: nos outros o token antigo ainda vale por
+        até APP_TOKEN_CACHE_TTL_S.
+        """
+        if self.app_token and not rotacionar:
+            return
+        if self.app_token:
+            invalidar_cache_app_token(token=self.app_token)
+        self.app_token = secrets.token_urlsafe(32)
 
     def set_senha(self, senha: str):
-        self.senha_hash = generate_password_hash(senha)
+        self.senha_hash = gerar_hash_senha(senha)
 
     def checar_senha(self, senha: str) -> bool:
         return bool(self.senha_hash) and check_password_hash(self.senha_hash, senha)
@@ -301,7 +547,7 @@ class Estabelecimento(db.Model):
     logo_filename = db.Column(db.String(120), nullable=True)
 
     def set_senha(self, senha):
-        self.senha_hash = generate_password_hash(senha)
+        self.senha_hash = gerar_hash_senha(senha)
 
     def checar_senha(self, senha):
         return check_password_hash(self.senha_hash, senha)
@@ -314,7 +560,7 @@ class Admin(db.Model):
     senha_hash = db.Column(db.String(128), nullable=False)
 
     def set_senha(self, senha):
-        self.senha_hash = generate_password_hash(senha)
+        self.senha_hash = gerar_hash_senha(senha)
 
     def checar_senha(self, senha):
         return check_password_hash(self.senha_hash, senha)
@@ -346,6 +592,8 @@ class Lancamento(db.Model):
 
 Index('ix_lancamento_coop_estab_data',
       Lancamento.cooperado_id, Lancamento.estabelecimento_id, Lancamento.data.desc())
+# painel do estabelecimento / filtros por estabelecimento, ordenados por data
+Index('ix_lancamento_estab_data', Lancamento.estabelecimento_id, Lancamento.data.desc())
 class DescontoLancamento(db.Model):
     __tablename__ = 'desconto_lancamento'
     id = db.Column(db.Integer, primary_key=True)
@@ -353,6 +601,30 @@ class DescontoLancamento(db.Model):
     valor = db.Column(db.Float, nullable=False)
     criado_em = db.Column(db.DateTime, default=datetime.utcnow, index=True)  # UTC (naive)
     observacao = db.Column(db.String(255), nullable=True)
+    # cópia de lancamento.cooperado_id: o extrato lê os descontos do cooperado
+    # direto pelo índice, sem passar por todos os lançamentos dele
+    cooperado_id = db.Column(db.Integer, nullable=True)
+
+
+# ====== Ajustes de crédito feitos pelo admin (o crédito é definido em valor absoluto) ======
+class AjusteCredito(db.Model):
+    __tablename__ = 'ajuste_credito'
+    id = db.Column(db.Integer, primary_key=True)
+    cooperado_id = db.Column(db.Integer, db.ForeignKey('cooperado.id', ondelete='CASCADE'), nullable=False)
+    data = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)  # UTC (naive)
+    valor = db.Column(db.Float, nullable=False)               # diferença aplicada (+/-)
+    credito_resultante = db.Column(db.Float, nullable=False)
+    origem = db.Column(db.String(20), nullable=False)         # 'ajuste' | 'edicao' | 'cadastro'
+    admin_id = db.Column(db.Integer, nullable=True)
+
+    cooperado = db.relationship('Cooperado')
+
+
+# extrato do cooperado: cada fonte lida por (cooperado, data desc, id desc)
+Index('ix_lancamento_coop_data', Lancamento.cooperado_id, Lancamento.data.desc(), Lancamento.id.desc())
+Index('ix_desconto_coop_data', DescontoLancamento.cooperado_id,
+      DescontoLancamento.criado_em.desc(), DescontoLancamento.id.desc())
+Index('ix_ajuste_credito_coop_data', AjusteCredito.cooperado_id, AjusteCredito.data.desc(), AjusteCredito.id.desc())
 
 
 # ====== Catálogo de Itens por Estabelecimento ======
@@ -370,6 +642,11 @@ class CatalogoItem(db.Model):
 
     estabelecimento = db.relationship('Estabelecimento')
 
+    __table_args__ = (
+        # catálogo de um estabelecimento em ordem alfabética
+        db.Index('ix_catalogo_item_estab_nome', 'estabelecimento_id', 'nome'),
+    )
+
 
 # ====== Stories por Estabelecimento ======
 class StoryEstabelecimento(db.Model):
@@ -387,6 +664,17 @@ class StoryEstabelecimento(db.Model):
 
     estabelecimento = db.relationship('Estabelecimento')
 
+    __table_args__ = (
+        # stories de um estabelecimento (ativos / expirados)
+        db.Index('ix_story_estab_ativo_expira', 'estabelecimento_id', 'ativo', 'expira_em'),
+        # stories ativos de todos (painel do cooperado): índice parcial só com os ativos
+        db.Index(
+            'ix_story_ativos_expira', 'expira_em',
+            postgresql_where=text('ativo'),
+            sqlite_where=text('ativo = 1'),
+        ),
+    )
+
     # ---- Helpers p/ templates (igual seu HTML espera) ----
     @property
     def data_criacao_brasilia(self):
@@ -434,12 +722,477 @@ class StoryView(db.Model):
 
     __table_args__ = (
         db.UniqueConstraint('story_id', 'cooperado_id', name='uq_story_coop_view'),
+        # views/likes por story sem ler a tabela (index-only scan)
+        db.Index('ix_story_view_story_curtiu', 'story_id', 'curtiu'),
+    )
+
+
+# ====== Histórico de localização (particionado por dia no Postgres) ======
+class LocalizacaoHistorico(db.Model):
+    __tablename__ = 'localizacao_historico'
+    # PK (cooperado_id, registrado_em): serve a consulta de rota e descarta pontos repetidos.
+    # Sem FK de propósito: as partições diárias são apagadas inteiras (DROP) na retenção.
+    cooperado_id = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    registrado_em = db.Column(db.DateTime, primary_key=True)  # UTC (naive)
+    latitude = db.Column(db.Float, nullable=False)
+    longitude = db.Column(db.Float, nullable=False)
+    accuracy = db.Column(db.Float, nullable=True)
+    speed = db.Column(db.Float, nullable=True)
+
+    __table_args__ = {'postgresql_partition_by': 'RANGE (registrado_em)'}
+
+
+_PARTICOES_HIST_OK = set()
+
+
+def _nome_particao_historico(dia) -> str:
+    return f"localizacao_historico_p{dia:%Y%m%d}"
+
+
+def _garantir_particoes_historico(dias_a_frente: int = 2, dias=None):
+    """
+    Cria (se faltar) as partições diárias do histórico, de ontem até
+    hoje + dias_a_frente (ou exatamente os `dias` pedidos). Só faz algo no
+    Postgres; memoriza os dias já garantidos neste processo para não
+    repetir o DDL a cada flush.
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    if dias is None:
+        hoje = datetime.utcnow().date()
+        dias = [hoje + timedelta(days=i) for i in range(-1, dias_a_frente + 1)]
+    faltando = [d for d in dias if d not in _PARTICOES_HIST_OK]
+    if not faltando:
+        return
+    with db.engine.begin() as conn:
+        for d in faltando:
+            conn.execute(text(
+                f"CREATE TABLE IF NOT EXISTS {_nome_particao_historico(d)} "
+                f"PARTITION OF localizacao_historico "
+                f"FOR VALUES FROM ('{d:%Y-%m-%d}') TO ('{d + timedelta(days=1):%Y-%m-%d}')"
+            ))
+    _PARTICOES_HIST_OK.update(faltando)
+
+
+# ========= VERSÕES DE CONTEÚDO =========
+# Um contador por conjunto de dados compartilhado (lista de estabelecimentos,
+# catálogo, stories). Toda escrita pelo ORM nesses modelos incrementa o
+# contador na mesma transação, então qualquer worker sabe, com uma leitura de
+# 3 linhas, se o que ele tem em cache (fragmentos de template) ainda vale.
+class VersaoConteudo(db.Model):
+    __tablename__ = 'versao_conteudo'
+    chave = db.Column(db.String(40), primary_key=True)
+    versao = db.Column(db.BigInteger, nullable=False, default=0)
+
+
+_CONTEUDO_VERSIONADO = {
+    'Estabelecimento': 'estabelecimentos',
+    'CatalogoItem': 'catalogo',
+    'StoryEstabelecimento': 'stories',
+    'Cooperado': 'cooperados',
+    'Lancamento': 'lancamentos',
+    'DescontoLancamento': 'lancamentos',
+}
+CHAVES_CONTEUDO = tuple(dict.fromkeys(_CONTEUDO_VERSIONADO.values()))
+
+_SQL_VERSOES_CONTEUDO = select(VersaoConteudo.chave, VersaoConteudo.versao)
+_SQL_TOCAR_VERSOES = (
+    VersaoConteudo.__table__.update()
+    .where(VersaoConteudo.chave.in_(bindparam('chaves', expanding=True)))
+    .values(versao=VersaoConteudo.versao + 1)
+)
+
+
+def _chave_conteudo(obj_ou_mapper) -> str | None:
+    classe = getattr(obj_ou_mapper, 'class_', None) or type(obj_ou_mapper)
+    return _CONTEUDO_VERSIONADO.get(classe.__name__)
+
+
+def tocar_versoes_conteudo(conn, chaves) -> None:
+    """Incrementa as versões (na transação de `conn`); cria a linha que faltar."""
+    chaves = sorted(set(chaves))
+    if not chaves:
+        return
+    if conn.execute(_SQL_TOCAR_VERSOES, {'chaves': chaves}).rowcount < len(chaves):
+        existentes = {r.chave for r in conn.execute(
+            _SQL_VERSOES_CONTEUDO.where(VersaoConteudo.chave.in_(chaves)))}
+        faltando = [{'chave': c, 'versao': 1} for c in chaves if c not in existentes]
+        if faltando:
+            conn.execute(VersaoConteudo.__table__.insert(), faltando)
+
+
+def versoes_conteudo() -> dict:
+    """{chave: versão} de todos os conjuntos versionados (0 se nunca escrito)."""
+    versoes = dict.fromkeys(CHAVES_CONTEUDO, 0)
+    versoes.update(db.session.execute(_SQL_VERSOES_CONTEUDO).tuples().all())
+    return versoes
+
+
+@event.listens_for(SessaoRoteada, 'after_flush')
+def _tocar_versoes_flush(sessao, flush_context):
+    chaves = {_chave_conteudo(o) for o in itertools.chain(sessao.new, sessao.deleted)}
+    chaves.update(_chave_conteudo(o) for o in sessao.dirty if sessao.is_modified(o))
+    chaves.discard(None)
+    if chaves:
+        tocar_versoes_conteudo(sessao.connection(), chaves)
+
+
+@event.listens_for(SessaoRoteada, 'do_orm_execute')
+def _tocar_versoes_dml(estado):
+    # insert()/update()/delete() em massa pela sessão não passam pelo flush
+    if (estado.is_insert or estado.is_update or estado.is_delete) and estado.bind_mapper is not None:
+        chave = _chave_conteudo(estado.bind_mapper)
+        if chave:
+            tocar_versoes_conteudo(estado.session.connection(), [chave])
+
+
+# ========= COMANDOS PRÉ-MONTADOS (caminhos quentes) =========
+# Montados uma vez no import (ou uma vez por dialeto): cada chamada só passa
+# parâmetros, o SQLAlchemy reaproveita a compilação e o SQL sai sempre igual,
+# o que deixa o psycopg preparar o comando no servidor (DB_PREPARE_THRESHOLD).
+_SQL_COOP_POR_TOKEN = select(Cooperado.id).where(Cooperado.app_token == bindparam('token'))
+_SQL_ULTIMO_LANCAMENTO = select(func.max(Lancamento.id))
+_SQL_STORY_EXISTE = select(StoryEstabelecimento.id).where(StoryEstabelecimento.id == bindparam('story_id'))
+_SQL_STORY_STATS = select(
+    func.count(StoryView.id),
+    func.coalesce(func.sum(case((StoryView.curtiu.is_(True), 1), else_=0)), 0),
+).where(StoryView.story_id == bindparam('story_id'))
+
+
+def _sql_lancamentos_estab(com_inicio: bool, com_fim: bool):
+    stmt = (
+        select(
+            Lancamento.id, Lancamento.data, Lancamento.os_numero, Lancamento.valor,
+            Lancamento.descricao, Cooperado.nome.label('cooperado_nome'),
+        )
+        .join(Cooperado, Cooperado.id == Lancamento.cooperado_id)
+        .where(Lancamento.estabelecimento_id == bindparam('est_id'))
+    )
+    if com_inicio:
+        stmt = stmt.where(Lancamento.data >= bindparam('inicio'))
+    if com_fim:
+        stmt = stmt.where(Lancamento.data < bindparam('fim'))
+    return stmt.order_by(Lancamento.data.desc())
+
+
+# painel do estabelecimento: uma variante por combinação de filtro de data
+_SQL_LANCAMENTOS_ESTAB = {
+    (i, f): _sql_lancamentos_estab(i, f) for i in (False, True) for f in (False, True)
+}
+
+_COMANDOS_DIALETO: dict[tuple[str, str], object] = {}
+
+
+def _comando_dialeto(nome: str, construir):
+    """Comando que depende do dialeto (upserts): montado na 1ª chamada e guardado."""
+    dialeto = db.engine.dialect.name
+    stmt = _COMANDOS_DIALETO.get((nome, dialeto))
+    if stmt is None:
+        stmt = _COMANDOS_DIALETO[(nome, dialeto)] = construir(dialeto)
+    return stmt
+
+
+def _insert_dialeto(dialeto: str):
+    if dialeto == 'postgresql':
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialeto == 'sqlite':
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert
+
+
+def _construir_upsert_localizacao(dialeto: str):
+    tabela = LocalizacaoCooperado.__table__
+    dialect_insert = _insert_dialeto(dialeto)
+    if dialect_insert is None:
+        return None
+    stmt = dialect_insert(tabela)
+    return stmt.on_conflict_do_update(
+        index_elements=[tabela.c.cooperado_id],
+        set_={
+            c: stmt.excluded[c]
+            for c in ('latitude', 'longitude', 'accuracy', 'speed', 'online', 'fonte', 'atualizado_em',
+                      'gravado_em')
+        },
+        where=(
+            tabela.c.atualizado_em.is_(None)
+            | (stmt.excluded.atualizado_em >= tabela.c.atualizado_em)
+        ),
+    )
+
+
+def _construir_insert_historico(dialeto: str):
+    dialect_insert = _insert_dialeto(dialeto)
+    if dialect_insert is None:
+        return LocalizacaoHistorico.__table__.insert()
+    return dialect_insert(LocalizacaoHistorico.__table__).on_conflict_do_nothing()
+
+
+def _construir_upsert_story_view(dialeto: str, com_curtida: bool):
+    tabela = StoryView.__table__
+    dialect_insert = _insert_dialeto(dialeto)
+    if dialect_insert is None:
+        return None
+    stmt = dialect_insert(tabela).values(
+        story_id=bindparam('story_id'), cooperado_id=bindparam('cooperado_id'),
+        viu_em=bindparam('viu_em'), curtiu=bindparam('curtiu'),
+    )
+    set_ = {'viu_em': stmt.excluded.viu_em}
+    if com_curtida:
+        set_['curtiu'] = stmt.excluded.curtiu
+    return stmt.on_conflict_do_update(
+        index_elements=[tabela.c.story_id, tabela.c.cooperado_id], set_=set_,
+    ).returning(tabela.c.curtiu)
+
+
+# ========= MIGRAÇÕES DE SCHEMA =========
+# Rodam uma vez por deploy (`flask --app app migrar`, etapa de release), com
+# advisory lock no Postgres. O worker só confere a versão ao subir.
+# Toda migração precisa ser idempotente: a 1ª roda também em bancos que já
+# tinham o schema criado pelo antigo create_all + ALTERs do boot.
+_MIGRACOES: list[tuple[int, str, object]] = []
+_MIGRACAO_LOCK_ID = 0x636F6F70  # 'coop'
+
+schema_version = db.Table(
+    'schema_version',
+    db.Column('versao', db.Integer, primary_key=True, autoincrement=False),
+    db.Column('descricao', db.String(200), nullable=False),
+    db.Column('aplicada_em', db.DateTime, nullable=False, default=datetime.utcnow),
+)
+
+
+def migracao(versao: int, descricao: str):
+    def deco(fn):
+        _MIGRACOES.append((versao, descricao, fn))
+        _MIGRACOES.sort(key=lambda m: m[0])
+        return fn
+    return deco
+
+
+def _adicionar_colunas(conn, tabela: str, colunas: list[tuple[str, str]]):
+    """ALTER TABLE ... ADD COLUMN para as colunas que ainda não existem."""
+    from sqlalchemy import inspect as sa_inspect
+    existentes = {c['name'] for c in sa_inspect(conn).get_columns(tabela)}
+    for nome, ddl in colunas:
+        if nome not in existentes:
+            conn.execute(text(f"ALTER TABLE {tabela} ADD COLUMN {nome} {ddl}"))
+
+
+def _tipo_ddl(coluna) -> str:
+    return coluna.type.compile(dialect=db.engine.dialect)
+
+
+def _criar_indices(conn, tabelas, nomes: set):
+    """
+    Índices declarados nos models. No Postgres ficam para depois do commit da
+    migração e são criados com CREATE INDEX CONCURRENTLY (migrar() cuida
+    disso), para não travar as escritas na tabela durante o build; nos demais
+    bancos saem aqui mesmo, na transação da migração.
+    """
+    indices = [i for t in tabelas for i in t.indexes if i.name in nomes]
+    if conn.dialect.name == 'postgresql':
+        conn.info.setdefault('indices_concorrentes', []).extend(indices)
+        return
+    for indice in indices:
+        indice.create(conn, checkfirst=True)
+
+
+def _criar_indices_concorrentes(indices):
+    """CREATE INDEX CONCURRENTLY IF NOT EXISTS em autocommit (fora de transação)."""
+    if not indices:
+        return
+    with db.engine.connect().execution_options(isolation_level='AUTOCOMMIT') as conn:
+        for indice in indices:
+            # um CONCURRENTLY que falhou deixa o índice INVALID, e o IF NOT EXISTS pularia
+            invalido = conn.execute(text(
+                "SELECT 1 FROM pg_index i JOIN pg_class c ON c.oid = i.indexrelid "
+                "WHERE c.relname = :nome AND NOT i.indisvalid"
+            ), {'nome': indice.name}).first()
+            if invalido:
+                conn.execute(text(f'DROP INDEX CONCURRENTLY IF EXISTS "{indice.name}"'))
+            ddl = str(CreateIndex(indice, if_not_exists=True).compile(dialect=conn.dialect))
+            conn.execute(text(re.sub(r'^CREATE (UNIQUE )?INDEX ', r'CREATE \1INDEX CONCURRENTLY ', ddl)))
+
+
+def _atualizar_em_lotes(conn, tabela: str, sql_set: str, onde: str, lote: int = 10000):
+    """
+    UPDATE {tabela} SET {sql_set} WHERE {onde}, em faixas de id com commit a
+    cada faixa: nenhuma transação segura a tabela inteira. O `onde` precisa
+    tornar o backfill idempotente (ex.: "coluna IS NULL").
+    """
+    ini, fim = conn.execute(text(f"SELECT MIN(id), MAX(id) FROM {tabela}")).one()
+    conn.commit()
+    if ini is None:
+        return
+    for a in range(ini - 1, fim, lote):
+        conn.execute(text(
+            f"UPDATE {tabela} SET {sql_set} WHERE id > :a AND id <= :b AND ({onde})"
+        ), {'a': a, 'b': a + lote})
+        conn.commit()
+
+
+@migracao(1, 'schema base (tabelas originais e colunas adicionadas em runtime)')
+def _migracao_001(conn):
+    db.metadata.create_all(conn, tables=[
+        Cooperado.__table__, Estabelecimento.__table__, Admin.__table__,
+        Lancamento.__table__, DescontoLancamento.__table__, CatalogoItem.__table__,
+        StoryEstabelecimento.__table__, StoryView.__table__, LocalizacaoCooperado.__table__,
+    ])
+    c = Cooperado.__table__.c
+    _adicionar_colunas(conn, 'cooperado', [
+        ('foto_data', _tipo_ddl(c.foto_data)),
+        ('foto_mimetype', 'VARCHAR(50)'),
+        ('foto_filename', 'VARCHAR(120)'),
+        ('credito_atualizado_em', 'TIMESTAMP NULL'),
+        ('senha_hash', 'VARCHAR(128)'),
+        ('app_token', 'VARCHAR(120)'),
+    ])
+    conn.execute(text("CREATE UNIQUE INDEX IF NOT EXISTS ix_cooperado_app_token ON cooperado (app_token)"))
+    e = Estabelecimento.__table__.c
+    _adicionar_colunas(conn, 'estabelecimento', [
+        ('logo_data', _tipo_ddl(e.logo_data)),
+        ('logo_mimetype', 'VARCHAR(50)'),
+        ('logo_filename', 'VARCHAR(120)'),
+    ])
+    _adicionar_colunas(conn, 'lancamento', [
+        ('parcelas_total', 'INTEGER DEFAULT 4'),
+        ('saldo_aberto', _tipo_ddl(Lancamento.__table__.c.saldo_aberto)),
+        ('concluido', 'BOOLEAN DEFAULT FALSE'),
+    ])
+
+
+@migracao(2, 'histórico de localização particionado por dia')
+def _migracao_002(conn):
+    LocalizacaoHistorico.__table__.create(conn, checkfirst=True)
+
+
+@migracao(3, 'índices compostos/parciais das consultas quentes')
+def _migracao_003(conn):
+    _criar_indices(conn, (Lancamento.__table__, CatalogoItem.__table__,
+                          StoryEstabelecimento.__table__, StoryView.__table__), {
+        'ix_lancamento_estab_data', 'ix_catalogo_item_estab_nome',
+        'ix_story_estab_ativo_expira', 'ix_story_ativos_expira', 'ix_story_view_story_curtiu',
+    })
+
+
+def _semear_versoes_conteudo(conn):
+    existentes = {r.chave for r in conn.execute(_SQL_VERSOES_CONTEUDO)}
+    novas = [{'chave': c, 'versao': 1} for c in CHAVES_CONTEUDO if c not in existentes]
+    if novas:
+        conn.execute(VersaoConteudo.__table__.insert(), novas)
+
+
+@migracao(4, 'versões de conteúdo para cache de fragmentos')
+def _migracao_004(conn):
+    VersaoConteudo.__table__.create(conn, checkfirst=True)
+    _semear_versoes_conteudo(conn)
+
+
+@migracao(5, 'versões de conteúdo de cooperados e lançamentos (ETag das páginas)')
+def _migracao_005(conn):
+    _semear_versoes_conteudo(conn)
+
+
+@migracao(6, 'extrato: ajustes de crédito, cooperado no desconto e índices por data')
+def _migracao_006(conn):
+    AjusteCredito.__table__.create(conn, checkfirst=True)
+    _adicionar_colunas(conn, 'desconto_lancamento', [('cooperado_id', 'INTEGER')])
+    conn.commit()
+    _atualizar_em_lotes(
+        conn, 'desconto_lancamento',
+        "cooperado_id = (SELECT l.cooperado_id FROM lancamento l WHERE l.id = desconto_lancamento.lancamento_id)",
+        "cooperado_id IS NULL",
     )
+    # descontos antigos sem data entram no extrato na data do lançamento
+    _atualizar_em_lotes(
+        conn, 'desconto_lancamento',
+        "criado_em = (SELECT l.data FROM lancamento l WHERE l.id = desconto_lancamento.lancamento_id)",
+        "criado_em IS NULL",
+    )
+    _criar_indices(conn, (Lancamento.__table__, DescontoLancamento.__table__, AjusteCredito.__table__),
+                   {'ix_lancamento_coop_data', 'ix_desconto_coop_data', 'ix_ajuste_credito_coop_data'})
+
+
+@migracao(7, 'localização: carimbo do servidor na última escrita (sincronização entre workers)')
+def _migracao_007(conn):
+    _adicionar_colunas(conn, 'localizacao_cooperado', [('gravado_em', 'TIMESTAMP NULL')])
+    conn.commit()
+    _atualizar_em_lotes(conn, 'localizacao_cooperado', "gravado_em = atualizado_em", "gravado_em IS NULL")
+    _criar_indices(conn, (LocalizacaoCooperado.__table__,), {'ix_localizacao_cooperado_gravado_em'})
+
+
+def _versao_schema(conn) -> int:
+    return conn.execute(select(func.coalesce(func.max(schema_version.c.versao), 0))).scalar() or 0
+
+
+def versao_schema_esperada() -> int:
+    return _MIGRACOES[-1][0] if _MIGRACOES else 0
+
+
+def migrar(log=print) -> int:
+    """Aplica as migrações pendentes; cada uma na sua transação. Retorna a versão final."""
+    postgres = db.engine.dialect.name == 'postgresql'
+    with db.engine.connect() as conn:
+        if postgres:
+            conn.execute(text("SELECT pg_advisory_lock(:k)"), {'k': _MIGRACAO_LOCK_ID})
+            conn.commit()
+        try:
+            schema_version.create(conn, checkfirst=True)
+            conn.commit()
+            atual = _versao_schema(conn)
+            for versao, descricao, fn in _MIGRACOES:
+                if versao <= atual:
+                    continue
+                log(f"Aplicando migração {versao}: {descricao}")
+                fn(conn)
+                conn.commit()
+                # índices do Postgres: fora da transação, antes de marcar a versão
+                # (se o build falhar, a migração roda de novo; tudo nela é idempotente)
+                _criar_indices_concorrentes(conn.info.pop('indices_concorrentes', []))
+                conn.execute(schema_version.insert().values(
+                    versao=versao, descricao=descricao, aplicada_em=datetime.utcnow()
+                ))
+                conn.commit()
+                atual = versao
+        except Exception:
+            conn.rollback()
+            raise
+        finally:
+            if postgres:
+                conn.execute(text("SELECT pg_advisory_unlock(:k)"), {'k': _MIGRACAO_LOCK_ID})
+                conn.commit()
+    _garantir_particoes_historico()
+    return atual
+
+
+def _verificar_schema_no_boot():
+    """Boot do worker: uma leitura de schema_version (ou migra, se AUTO_MIGRATE=1)."""
+    if os.environ.get('AUTO_MIGRATE') == '1':
+        migrar(log=app.logger.info)
+        return
+    try:
+        with db.engine.connect() as conn:
+            atual = _versao_schema(conn)
+    except Exception:
+        app.logger.error("Tabela schema_version ausente: rode `flask --app app migrar`.")
+        return
+    if atual < versao_schema_esperada():
+        app.logger.error(
+            "Schema na versão %s, código espera %s: rode `flask --app app migrar`.",
+            atual, versao_schema_esperada()
+        )
+
+
+@app.cli.command('migrar')
+def migrar_cmd():
+    """Aplica as migrações de schema pendentes (etapa de release)."""
+    versao = migrar(log=click.echo)
+    click.echo(f"Schema na versão {versao}.")
 
 
 with app.app_context():
-    db.create_all()
-    ensure_schema()
+    _verificar_schema_no_boot()
 
 # ========= CONTEXT PROCESSOR =========
 @app.context_processor
@@ -464,6 +1217,647 @@ def is_cooperado():
     return session.get('user_tipo') == 'cooperado'
 
 
+# ========= MÉTRICAS / INSTRUMENTAÇÃO =========
+_METRICAS: dict = {}   # nome da seção -> função que devolve dict (endpoint /api/admin/metricas)
+
+
+def registrar_metricas(nome: str):
+    """Decorator: publica a função na resposta de /api/admin/metricas."""
+    def deco(fn):
+        _METRICAS[nome] = fn
+        return fn
+    return deco
+
+
+_LOG_REQUISICAO = logging.getLogger('coopex.requisicao')
+if not _LOG_REQUISICAO.handlers:
+    _h = logging.StreamHandler(sys.stderr)
+    _h.setFormatter(logging.Formatter('%(message)s'))
+    _LOG_REQUISICAO.addHandler(_h)
+    _LOG_REQUISICAO.setLevel(logging.INFO)
+    _LOG_REQUISICAO.propagate = False
+
+_TEMPOS_STATS: dict[str, dict] = {}   # endpoint -> acumulados p/ /api/admin/metricas
+_TEMPOS_LOCK = threading.Lock()
+_SEM_LOG_TIMING = ('static', 'statics_files')
+
+
+class _TemposRequisicao:
+    """Acumula tempo de banco/template da requisição corrente (fica em g.tempos)."""
+    __slots__ = ('inicio', 'db_s', 'db_n', 'tpl_s', 'tpl_n', 'sql', '_tpl_pilha')
+
+    def __init__(self):
+        self.inicio = time.perf_counter()
+        self.db_s = 0.0
+        self.db_n = 0
+        self.tpl_s = 0.0
+        self.tpl_n = 0
+        self.sql: list[tuple[float, str]] = []
+        self._tpl_pilha: list[float] = []
+
+
+def _tempos_atuais():
+    if not has_request_context():
+        return None
+    return g.get('tempos')
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def _sql_inicio(conn, cursor, statement, parameters, context, executemany):
+    if _tempos_atuais() is not None:
+        conn.info.setdefault('_sql_inicio', []).append(time.perf_counter())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def _sql_fim(conn, cursor, statement, parameters, context, executemany):
+    t = _tempos_atuais()
+    pilha = conn.info.get('_sql_inicio')
+    if t is None or not pilha:
+        return
+    dur = time.perf_counter() - pilha.pop()
+    t.db_s += dur
+    t.db_n += 1
+    if len(t.sql) < app.config['SLOW_REQUEST_MAX_SQL']:
+        t.sql.append((dur, statement))
+
+
+@event.listens_for(Engine, 'handle_error')
+def _sql_erro(ctx):
+    # comando que falhou não passa pelo after_cursor_execute
+    conn = ctx.connection
+    if conn is not None and conn.info.get('_sql_inicio'):
+        conn.info['_sql_inicio'].pop()
+
+
+def _template_inicio(sender, template, context, **extra):
+    t = _tempos_atuais()
+    if t is not None:
+        t._tpl_pilha.append(time.perf_counter())
+
+
+def _template_fim(sender, template, context, **extra):
+    t = _tempos_atuais()
+    if t is not None and t._tpl_pilha:
+        inicio = t._tpl_pilha.pop()
+        if not t._tpl_pilha:   # render_template aninhado já conta no de fora
+            t.tpl_s += time.perf_counter() - inicio
+        t.tpl_n += 1
+
+
+before_render_template.connect(_template_inicio, app)
+template_rendered.connect(_template_fim, app)
+
+
+@app.before_request
+def _iniciar_tempos():
+    g.tempos = _TemposRequisicao()
+
+
+def _registrar_tempos(resp: Response):
+    t = g.pop('tempos', None)
+    if t is None:
+        return
+    total_ms = (time.perf_counter() - t.inicio) * 1000
+    db_ms = t.db_s * 1000
+    tpl_ms = t.tpl_s * 1000
+    app_ms = max(total_ms - db_ms - tpl_ms, 0.0)
+
+    timing = [f'db;dur={db_ms:.1f};desc="{t.db_n} sql"']
+    if t.tpl_n:
+        timing.append(f'tpl;dur={tpl_ms:.1f}')
+    timing += [f'app;dur={app_ms:.1f}', f'total;dur={total_ms:.1f}']
+    resp.headers['Server-Timing'] = ', '.join(timing)
+
+    endpoint = request.endpoint or '-'
+    lenta = total_ms >= app.config['SLOW_REQUEST_MS']
+    with _TEMPOS_LOCK:
+        st = _TEMPOS_STATS.get(endpoint)
+        if st is None:
+            st = _TEMPOS_STATS[endpoint] = {'n': 0, 'total_ms': 0.0, 'max_ms': 0.0, 'db_ms': 0.0, 'sql': 0,
+                                            'lentas': 0}
+        st['n'] += 1
+        st['total_ms'] += total_ms
+        st['max_ms'] = max(st['max_ms'], total_ms)
+        st['db_ms'] += db_ms
+        st['sql'] += t.db_n
+        st['lentas'] += lenta
+
+    if not lenta and (not app.config['TIMING_LOG'] or endpoint in _SEM_LOG_TIMING):
+        return
+    linha = {
+        'evento': 'requisicao_lenta' if lenta else 'requisicao',
+        'metodo': request.method,
+        'rota': endpoint,
+        'path': request.path,
+        'status': resp.status_code,
+        'total_ms': round(total_ms, 1),
+        'db_ms': round(db_ms, 1),
+        'sql_n': t.db_n,
+        'tpl_ms': round(tpl_ms, 1),
+        'usuario': f"{session.get('user_tipo')}:{session.get('user_id')}" if session.get('user_id') else None,
+    }
+    if lenta:
+        linha['sql'] = [
+            {'ms': round(dur * 1000, 1), 'sql': ' '.join(stmt.split())[:2000]}
+            for dur, stmt in t.sql
+        ]
+        _LOG_REQUISICAO.warning(json.dumps(linha, ensure_ascii=False))
+    else:
+        _LOG_REQUISICAO.info(json.dumps(linha, ensure_ascii=False))
+
+
+def _copia_tempos() -> dict:
+    with _TEMPOS_LOCK:
+        return {ep: dict(st) for ep, st in _TEMPOS_STATS.items()}
+
+
+@registrar_metricas('tempos')
+def _metricas_tempos():
+    return {
+        ep: {
+            'n': st['n'],
+            'media_ms': round(st['total_ms'] / st['n'], 1),
+            'max_ms': round(st['max_ms'], 1),
+            'db_media_ms': round(st['db_ms'] / st['n'], 1),
+            'sql_media': round(st['sql'] / st['n'], 1),
+            'lentas': st['lentas'],
+        }
+        for ep, st in sorted(_copia_tempos().items(), key=lambda kv: -kv[1]['total_ms'])
+        if st['n']
+    }
+
+
+@registrar_metricas('replica')
+def _metricas_replica():
+    if not _tem_replica():
+        return {'configurada': False}
+    dados = {'configurada': True, 'janela_s': app.config['REPLICA_JANELA_S']}
+    engine = db.engines['replica']
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as conn:
+            atraso = conn.execute(text(
+                "SELECT EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())"
+            )).scalar()
+        dados['atraso_s'] = round(float(atraso), 3) if atraso is not None else None
+    return dados
+
+
+@event.listens_for(Engine, 'handle_error')
+def _contar_falha_pre_ping(ctx):
+    if ctx.is_pre_ping and ctx.engine is not None:
+        tel = getattr(ctx.engine.pool, 'telemetria', None)
+        if tel is not None:
+            tel.pre_ping_falhas += 1
+
+
+def _status_pool(engine) -> dict:
+    pool = engine.pool
+    tel = getattr(pool, 'telemetria', None)
+    dados = {
+        'classe': type(pool).__name__,
+        'tamanho': pool.size() if hasattr(pool, 'size') else None,
+        'max_overflow': getattr(pool, 'max_overflow', None),
+        'em_uso': pool.checkedout() if hasattr(pool, 'checkedout') else None,
+        'ociosas': pool.checkedin() if hasattr(pool, 'checkedin') else None,
+        'overflow': pool.overflow() if hasattr(pool, 'overflow') else None,
+    }
+    if tel is not None:
+        limites = [f'<={ms}ms' for ms in tel.LIMITES_MS] + [f'>{tel.LIMITES_MS[-1]}ms']
+        dados.update({
+            'checkouts': tel.checkouts,
+            'espera_media_ms': round(tel.espera_total_s / tel.checkouts * 1000, 2) if tel.checkouts else 0.0,
+            'espera_max_ms': round(tel.espera_max_s * 1000, 1),
+            'conexoes_novas': tel.conexoes,
+            'conexao_media_ms': round(tel.conexao_total_s / tel.conexoes * 1000, 2) if tel.conexoes else 0.0,
+            'conexao_max_ms': round(tel.conexao_max_s * 1000, 1),
+            'espera_histograma': dict(zip(limites, tel.baldes)),
+            'pico_em_uso': tel.pico_em_uso,
+            'timeouts': tel.timeouts,
+            'pre_ping_falhas': tel.pre_ping_falhas,
+            'invalidacoes': tel.invalidacoes,
+            'ajustes': tel.ajustes[-10:],
+        })
+    return dados
+
+
+@registrar_metricas('pool')
+def _metricas_pool():
+    dados = {'primario': _status_pool(db.engine)}
+    if _tem_replica():
+        dados['replica'] = _status_pool(db.engines['replica'])
+    dados['adaptativo'] = app.config['DB_POOL_ADAPTATIVO']
+    dados['teto'] = app.config['DB_POOL_TETO']
+    return dados
+
+
+def _ajustar_pool():
+    """Modo adaptativo: mexe só no max_overflow (o pool_size fixo fica sempre aberto)."""
+    for engine in db.engines.values():
+        pool = engine.pool
+        tel = getattr(pool, 'telemetria', None)
+        if tel is None or pool.max_overflow < 0:
+            continue
+        checkouts, lentas, timeouts, pico = tel.fechar_janela()
+        capacidade = pool.capacidade()
+        novo = pool.max_overflow
+        apertado = timeouts or (checkouts and lentas / checkouts > 0.05)
+        tel.janelas_calmas = 0 if (lentas or timeouts) else tel.janelas_calmas + 1
+        if apertado and capacidade < app.config['DB_POOL_TETO']:
+            novo = pool.max_overflow + min(2, app.config['DB_POOL_TETO'] - capacidade)
+        elif tel.janelas_calmas >= 6 and pool.max_overflow > 0 and pico + 2 < capacidade:
+            # só encolhe depois de ~1 min (6 janelas) sem espera, uma conexão por vez
+            novo = pool.max_overflow - 1
+            tel.janelas_calmas = 0
+        if novo != pool.max_overflow:
+            tel.ajustes.append({
+                'quando': datetime.utcnow().isoformat(timespec='seconds'),
+                'max_overflow': [pool.max_overflow, novo],
+                'checkouts': checkouts, 'lentas': lentas, 'timeouts': timeouts, 'pico': pico,
+            })
+            del tel.ajustes[:-50]
+            app.logger.info("Pool %s: max_overflow %d -> %d (checkouts=%d lentas=%d timeouts=%d pico=%d)",
+                            engine.url.database, pool.max_overflow, novo, checkouts, lentas, timeouts, pico)
+            pool.ajustar_max_overflow(novo)
+
+
+@app.before_request
+def _garantir_ajuste_pool():
+    if app.config['DB_POOL_ADAPTATIVO']:
+        _garantir_thread_fundo('pool', app.config['DB_POOL_AJUSTE_S'], _ajustar_pool)
+
+
+# ========= PROFILER SOB DEMANDA =========
+# Desligado não custa nada além de um `if` no before_request; ligado, uma thread
+# amostra a pilha da thread da requisição (sys._current_frames) e grava as pilhas
+# no formato "collapsed" (flamegraph.pl, speedscope) em instance/perfis.
+_PROFILER_ALVOS: dict[str, int] = {}   # endpoint -> requisições restantes (por worker)
+_PROFILER_LOCK = threading.Lock()
+_PROFILER_HEADER = 'X-Coopex-Profile'
+
+
+class _AmostradorPilha(threading.Thread):
+    def __init__(self, thread_id: int, intervalo_s: float):
+        super().__init__(name='coopex-profiler', daemon=True)
+        self.thread_id = thread_id
+        self.intervalo_s = intervalo_s
+        self.pilhas: dict[str, int] = {}
+        self.amostras = 0
+        self._parar = threading.Event()
+
+    def run(self):
+        while not self._parar.wait(self.intervalo_s):
+            frame = sys._current_frames().get(self.thread_id)
+            if frame is None:
+                continue
+            quadros = []
+            while frame is not None:
+                code = frame.f_code
+                quadros.append(f"{code.co_name} ({os.path.basename(code.co_filename)}:{frame.f_lineno})")
+                frame = frame.f_back
+            chave = ';'.join(reversed(quadros))
+            self.pilhas[chave] = self.pilhas.get(chave, 0) + 1
+            self.amostras += 1
+
+    def parar(self):
+        self._parar.set()
+        self.join(timeout=1)
+
+
+def _dir_perfis() -> str:
+    return os.path.join(app.instance_path, 'perfis')
+
+
+def _gravar_perfil(amostrador: _AmostradorPilha, endpoint: str, duracao_ms: float) -> str | None:
+    if not amostrador.pilhas:
+        return None
+    pasta = _dir_perfis()
+    os.makedirs(pasta, exist_ok=True)
+    nome = f"{datetime.now(UTC):%Y%m%dT%H%M%S%f}-{endpoint}-{os.getpid()}-{int(duracao_ms)}ms.folded"
+    with open(os.path.join(pasta, nome), 'w', encoding='utf-8') as f:
+        for pilha, n in sorted(amostrador.pilhas.items()):
+            f.write(f"{pilha} {n}\n")
+    antigos = sorted(x for x in os.listdir(pasta) if x.endswith('.folded'))
+    for x in antigos[:-app.config['PROFILER_MAX_ARQUIVOS']]:
+        try:
+            os.remove(os.path.join(pasta, x))
+        except OSError:
+            pass
+    return nome
+
+
+def _deve_perfilar(endpoint: str | None) -> bool:
+    token = app.config['PROFILER_TOKEN']
+    if token and secrets.compare_digest(request.headers.get(_PROFILER_HEADER, ''), token):
+        return True
+    with _PROFILER_LOCK:
+        restantes = _PROFILER_ALVOS.get(endpoint, 0)
+        if restantes <= 0:
+            return False
+        if restantes == 1:
+            del _PROFILER_ALVOS[endpoint]
+        else:
+            _PROFILER_ALVOS[endpoint] = restantes - 1
+    return True
+
+
+@app.before_request
+def _iniciar_profiler():
+    if not _PROFILER_ALVOS and not (app.config['PROFILER_TOKEN'] and _PROFILER_HEADER in request.headers):
+        return
+    if not _deve_perfilar(request.endpoint):
+        return
+    amostrador = _AmostradorPilha(threading.get_ident(), app.config['PROFILER_INTERVALO_MS'] / 1000.0)
+    g.profiler = (amostrador, time.perf_counter())
+    amostrador.start()
+
+
+@app.teardown_request
+def _finalizar_profiler(exc=None):
+    perfil = g.pop('profiler', None)
+    if perfil is None:
+        return
+    amostrador, inicio = perfil
+    amostrador.parar()
+    try:
+        _gravar_perfil(amostrador, request.endpoint or 'sem-endpoint', (time.perf_counter() - inicio) * 1000)
+    except OSError:
+        app.logger.exception("Falha ao gravar perfil de %s", request.endpoint)
+
+
+@app.route('/api/admin/profiler', methods=['GET', 'POST', 'DELETE'])
+def api_admin_profiler():
+    """GET lista perfis e alvos; POST {endpoint, n} perfila as próximas n requisições
+    do endpoint; DELETE desarma tudo. Alvos valem só para o worker que atendeu
+    (pid e escopo na resposta): com vários workers, repita o POST ou use o header
+    X-Coopex-Profile (PROFILER_TOKEN), que vale em qualquer um. Os perfis
+    listados são de todos os workers (pasta compartilhada)."""
+    if not is_admin():
+        return jsonify({'ok': False, 'error': 'sem permissão'}), 403
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or request.form
+        endpoint = (data.get('endpoint') or '').strip()
+        if endpoint not in app.view_functions:
+            return jsonify({'ok': False, 'error': 'endpoint inexistente'}), 400
+        try:
+            n = int(data.get('n') or 1)
+        except (TypeError, ValueError):
+            return jsonify({'ok': False, 'error': 'n inválido'}), 400
+        with _PROFILER_LOCK:
+            _PROFILER_ALVOS[endpoint] = max(1, min(n, 100))
+    elif request.method == 'DELETE':
+        with _PROFILER_LOCK:
+            _PROFILER_ALVOS.clear()
+
+    pasta = _dir_perfis()
+    arquivos = sorted((x for x in os.listdir(pasta) if x.endswith('.folded')), reverse=True) if os.path.isdir(pasta) else []
+    perfis = []
+    for x in arquivos:
+        try:
+            tamanho = os.path.getsize(os.path.join(pasta, x))
+        except FileNotFoundError:
+            continue   # rotacionado por outro worker depois do listdir
+        perfis.append({'nome': x, 'bytes': tamanho, 'url': url_for('api_admin_profiler_arquivo', nome=x)})
+    with _PROFILER_LOCK:
+        alvos = dict(_PROFILER_ALVOS)
+    resp = jsonify({
+        'ok': True,
+        'pid': os.getpid(),
+        'escopo': 'worker',
+        'alvos': alvos,
+        'perfis': perfis,
+    })
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+@app.get('/api/admin/profiler/<nome>')
+def api_admin_profiler_arquivo(nome):
+    if not is_admin():
+        return jsonify({'ok': False, 'error': 'sem permissão'}), 403
+    nome = secure_filename(nome)
+    if not nome.endswith('.folded'):
+        abort(404)
+    return send_from_directory(_dir_perfis(), nome, mimetype='text/plain', max_age=0)
+
+
+# ========= LIMITE DE TAXA / PROTEÇÃO DO POOL =========
+class TokenBucket:
+    """Token bucket por chave: `taxa` fichas/s, no máximo `rajada` acumuladas."""
+
+    def __init__(self, taxa: float, rajada: float):
+        self.taxa = float(taxa)
+        self.rajada = float(rajada)
+        self._lock = threading.Lock()
+        self._baldes: dict[str, list] = {}     # chave -> [fichas, ultimo_ts]
+        self._ultima_limpeza = time.monotonic()
+
+    def permitir(self, chave: str, custo: float = 1.0) -> tuple[bool, float]:
+        """(permitido, segundos até ter ficha)."""
+        agora = time.monotonic()
+        with self._lock:
+            balde = self._baldes.get(chave)
+            if balde is None:
+                balde = self._baldes[chave] = [self.rajada, agora]
+            else:
+                balde[0] = min(self.rajada, balde[0] + (agora - balde[1]) * self.taxa)
+                balde[1] = agora
+            if agora - self._ultima_limpeza > 60:
+                self._limpar(agora)
+            if balde[0] >= custo:
+                balde[0] -= custo
+                return True, 0.0
+            return False, (custo - balde[0]) / self.taxa if self.taxa > 0 else 60.0
+
+    def _limpar(self, agora: float):
+        # baldes que já encheram de novo não precisam ficar em memória
+        cheio_em = self.rajada / self.taxa if self.taxa > 0 else 3600.0
+        for k in [k for k, b in self._baldes.items() if agora - b[1] > cheio_em]:
+            del self._baldes[k]
+        self._ultima_limpeza = agora
+
+    def __len__(self):
+        return len(self._baldes)
+
+
+_LIMITADORES: dict[str, TokenBucket] = {}
+_CONCORRENCIA: dict[str, threading.BoundedSemaphore] = {}
+_LIMITES_STATS: dict[str, dict] = {}
+_LIMITES_LOCK = threading.Lock()   # workers gthread: várias requisições contam ao mesmo tempo
+
+
+def _stats_limite(endpoint: str) -> dict:
+    # chamar com _LIMITES_LOCK
+    st = _LIMITES_STATS.get(endpoint)
+    if st is None:
+        st = _LIMITES_STATS[endpoint] = {
+            'permitidas': 0, 'limitadas_429': 0, 'pool_esgotado_503': 0, 'concorrencia_503': 0,
+        }
+    return st
+
+
+def _contar_limite(endpoint: str, campo: str):
+    with _LIMITES_LOCK:
+        _stats_limite(endpoint)[campo] += 1
+
+
+def _chave_limite(tipo: str) -> str:
+    if tipo == 'app_token':
+        # balde por cooperado só com token válido (sai do cache de tokens); token
+        # inventado cai no balde do IP, senão cada token aleatório ganharia o seu
+        auth = (request.headers.get('Authorization') or '').strip()
+        if auth.lower().startswith('bearer ') and auth[7:].strip():
+            coop_id = coop_id_por_app_token(auth[7:].strip())
+            if coop_id:
+                return f'c:{coop_id}'
+    elif tipo == 'sessao' and session.get('user_id'):
+        return f"s:{session.get('user_tipo')}:{session.get('user_id')}"
+    return 'ip:' + (request.remote_addr or '-')
+
+
+def _pool_esgotado() -> bool:
+    pool = db.engine.pool
+    if not isinstance(pool, PoolInstrumentado) or pool.max_overflow < 0:
+        # pools sem limite (ex.: SQLite em memória/NullPool, pool_size=0)
+        return False
+    return pool.checkedout() >= pool.capacidade()
+
+
+def _resposta_recusada(status: int, msg: str, retry_after: float):
+    if request.endpoint == 'login':
+        flash(msg, 'danger')
+        resp = app.make_response((render_template('login.html'), status))
+    elif request.path.startswith('/api/') or request.is_json or request.endpoint == 'registrar_story_view':
+        resp = jsonify({'ok': False, 'error': msg})
+        resp.status_code = status
+    else:
+        resp = Response(msg, status=status, mimetype='text/plain')
+    resp.headers['Retry-After'] = str(max(1, int(math.ceil(retry_after))))
+    return resp
+
+
+@app.before_request
+def _limitar_requisicao():
+    endpoint = request.endpoint
+    cfg = app.config['RATE_LIMITS'].get(endpoint)
+    if cfg is None:
+        return None
+    if cfg.get('metodos') and request.method not in cfg['metodos']:
+        return None
+
+    limitador = _LIMITADORES.get(endpoint)
+    if limitador is None or (limitador.taxa, limitador.rajada) != (cfg['taxa'], cfg['rajada']):
+        limitador = _LIMITADORES[endpoint] = TokenBucket(cfg['taxa'], cfg['rajada'])
+    ok, espera = limitador.permitir(_chave_limite(cfg.get('chave', 'ip')))
+    if not ok:
+        _contar_limite(endpoint, 'limitadas_429')
+        return _resposta_recusada(429, 'Muitas requisições. Tente novamente em instantes.', espera)
+
+    if endpoint in app.config['DB_GUARD_ENDPOINTS'] and _pool_esgotado():
+        _contar_limite(endpoint, 'pool_esgotado_503')
+        return _resposta_recusada(503, 'Servidor ocupado. Tente novamente em instantes.', 1)
+
+    if cfg.get('concorrencia'):
+        sem = _CONCORRENCIA.get(endpoint)
+        if sem is None:
+            sem = _CONCORRENCIA.setdefault(endpoint, threading.BoundedSemaphore(int(cfg['concorrencia'])))
+        if not sem.acquire(blocking=False):
+            _contar_limite(endpoint, 'concorrencia_503')
+            return _resposta_recusada(503, 'Servidor ocupado. Tente novamente em instantes.', 1)
+        g.semaforo_limite = sem
+
+    _contar_limite(endpoint, 'permitidas')
+    return None
+
+
+@app.teardown_request
+def _liberar_concorrencia(exc=None):
+    sem = g.pop('semaforo_limite', None)
+    if sem is not None:
+        sem.release()
+
+
+@registrar_metricas('limites')
+def _metricas_limites():
+    with _LIMITES_LOCK:
+        contagens = {ep: dict(_stats_limite(ep)) for ep in app.config['RATE_LIMITS']}
+    return {
+        ep: {
+            **contagens[ep],
+            'baldes': len(_LIMITADORES[ep]) if ep in _LIMITADORES else 0,
+            'config': app.config['RATE_LIMITS'].get(ep),
+        }
+        for ep in app.config['RATE_LIMITS']
+    }
+
+
+@app.get('/api/admin/metricas')
+def api_admin_metricas():
+    if not is_admin():
+        return jsonify({'ok': False, 'error': 'sem permissão'}), 403
+    dados = {'ok': True, 'pid': os.getpid()}
+    for nome, fn in _METRICAS.items():
+        try:
+            dados[nome] = fn()
+        except Exception as e:
+            dados[nome] = {'erro': str(e)}
+    resp = jsonify(dados)
+    resp.headers['Cache-Control'] = 'no-store'
+    return resp
+
+
+# ========= IDENTIDADE DA REQUISIÇÃO =========
+# Só os campos que os templates/views usam do usuário logado (nada de foto/logo/hash).
+Principal = namedtuple('Principal', 'tipo id nome username')
+
+_IDENTIDADE_MODELOS = {
+    'admin': Admin,
+    'estabelecimento': Estabelecimento,
+    'cooperado': Cooperado,
+}
+_IDENTIDADE_CACHE: dict[tuple, tuple] = {}    # (tipo, id, versao) -> (Principal | None, expira_em)
+_IDENTIDADE_VERSAO: dict[tuple, int] = {}     # (tipo, id) -> versao
+_IDENTIDADE_SEM_CONTA = ('static', 'statics_files')
+
+
+def invalidar_identidade(tipo: str, user_id: int):
+    """Chamar ao editar/excluir a conta: muda a versão e a próxima requisição relê o banco."""
+    chave = (tipo, int(user_id))
+    _IDENTIDADE_VERSAO[chave] = _IDENTIDADE_VERSAO.get(chave, 0) + 1
+    for k in [k for k in _IDENTIDADE_CACHE if k[:2] == chave]:
+        _IDENTIDADE_CACHE.pop(k, None)
+
+
+def _carregar_principal(tipo: str, user_id: int):
+    modelo = _IDENTIDADE_MODELOS.get(tipo)
+    if modelo is None:
+        return None
+    versao = _IDENTIDADE_VERSAO.get((tipo, user_id), 0)
+    chave = (tipo, user_id, versao)
+    agora = time.time()
+    hit = _IDENTIDADE_CACHE.get(chave)
+    if hit is not None and hit[1] > agora:
+        return hit[0]
+
+    row = db.session.execute(
+        select(modelo.id, modelo.nome, modelo.username).where(modelo.id == user_id)
+    ).first()
+    principal = Principal(tipo, row.id, row.nome, row.username) if row else None
+    _IDENTIDADE_CACHE[chave] = (principal, agora + app.config['IDENTIDADE_CACHE_TTL_S'])
+    return principal
+
+
+@app.before_request
+def _carregar_identidade():
+    """Resolve o usuário logado uma vez por requisição (g.principal)."""
+    g.principal = None
+    if request.endpoint in _IDENTIDADE_SEM_CONTA:
+        return
+    tipo = session.get('user_tipo')
+    user_id = session.get('user_id')
+    if tipo and user_id:
+        g.principal = _carregar_principal(tipo, int(user_id))
+
+
 def _cache_headers(seconds=None, etag_base=None):
     if seconds is None:
         seconds = int(app.config.get('SEND_FILE_MAX_AGE_DEFAULT', 3600))
@@ -530,7 +1924,7 @@ def _get_cached_last_lanc_id():
     now_ts = time.time()
     if now_ts - _LAST_LANC_CACHE["ts"] <= _LAST_LANC_TTL and _LAST_LANC_CACHE["ts"] > 0:
         return _LAST_LANC_CACHE["value"], True
-    last_id = db.session.query(func.max(Lancamento.id)).scalar() or 0
+    last_id = db.session.execute(_SQL_ULTIMO_LANCAMENTO).scalar() or 0
     _LAST_LANC_CACHE["value"] = int(last_id)
     _LAST_LANC_CACHE["ts"] = now_ts
     return _LAST_LANC_CACHE["value"], False
@@ -548,26 +1942,466 @@ def _update_last_lanc_cache_with_value(v: int):
 # ========= ESTÁTICOS =========
 @app.route('/statics/<path:filename>')
 def statics_files(filename):
-    resp = send_from_directory(app.config['STATICS_FOLDER'], filename)
-    return _response_with_cache(resp, etag_base=f"statics/{filename}")
+    resp = _enviar_estatico(app.config['STATICS_FOLDER'], filename)
+    codificacao = resp.headers.get('Content-Encoding')
+    return _response_with_cache(resp, etag_base=f"statics/{filename}" + (f";{codificacao}" if codificacao else ''))
 
 
-# ========= HEADERS GERAIS =========
-@app.after_request
-def add_perf_headers(resp: Response):
-    resp.headers.setdefault("Connection", "keep-alive")
-    resp.headers.setdefault("Server-Timing", "app;desc=\"Coopex-API\"")
-    return resp
+# ========= ASSETS (CSS/JS EXTRAÍDOS DOS TEMPLATES) =========
+# Os blocos <style>/<script> sem Jinja são tirados do HTML na carga do template,
+# minificados e gravados em static/build/<hash>.css|js; o template passa a
+# referenciar o arquivo. O nome é o hash do conteúdo: o mesmo bloco em várias
+# páginas (cx-unified-*) vira um só arquivo, e qualquer mudança gera outro nome,
+# por isso o cache é `immutable`. Pré-gerar no deploy: `flask construir-assets`.
+try:
+    import rcssmin as _rcssmin
+except ImportError:
+    _rcssmin = None
+try:
+    import rjsmin as _rjsmin
+except ImportError:
+    _rjsmin = None
+
+_RE_BLOCO_ASSET = re.compile(r'<(style|script)\b([^>]*)>(.*?)</\1\s*>', re.S | re.I)
+_RE_JINJA = re.compile(r'\{[{%#]')
+_RE_CSS_COMENTARIO = re.compile(r'/\*.*?\*/', re.S)
+_RE_CSS_ESPACO = re.compile(r'\s*([{};,>])\s*')
+
+
+def _dir_assets() -> str:
+    return os.path.join(app.static_folder, app.config['ASSETS_SUBDIR'])
+
+
+def _minificar_css(texto: str) -> str:
+    if _rcssmin is not None:
+        return _rcssmin.cssmin(texto)
+    texto = _RE_CSS_COMENTARIO.sub('', texto)
+    texto = _RE_CSS_ESPACO.sub(r'\1', ' '.join(texto.split()))
+    return texto.replace(';}', '}').strip()
+
+
+def _minificar_js(texto: str) -> str:
+    """Sem rjsmin, só o que é seguro: indentação, linhas vazias e linhas só de
+    comentário `//` (fora de template literals, que ficam intactos)."""
+    if _rjsmin is not None:
+        return _rjsmin.jsmin(texto)
+    saida, em_literal = [], False
+    for linha in texto.splitlines():
+        crases = linha.count('`') - linha.count('\\`')
+        if em_literal:
+            saida.append(linha.rstrip())
+        else:
+            limpa = linha.strip()
+            if limpa and not limpa.startswith('//'):
+                saida.append(limpa)
+        if crases % 2:
+            em_literal = not em_literal
+    return '\n'.join(saida)
+
+
+def _gravar_asset(conteudo: str, ext: str) -> str:
+    """Grava (se ainda não existe) e devolve o caminho relativo a static/."""
+    dados = conteudo.encode('utf-8')
+    nome = f"{hashlib.sha256(dados).hexdigest()[:16]}.{ext}"
+    destino = os.path.join(_dir_assets(), nome)
+    if not os.path.exists(destino):
+        os.makedirs(_dir_assets(), exist_ok=True)
+        tmp = f"{destino}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(dados)
+        os.replace(tmp, destino)   # atômico: vários workers podem gerar o mesmo arquivo
+    return f"{app.config['ASSETS_SUBDIR']}/{nome}"
+
+
+def _extrair_assets(fonte: str, nome_template: str = '') -> str:
+    """Troca os blocos estáticos de CSS/JS da fonte do template por referências
+    aos arquivos gerados. Blocos com Jinja, com src ou type não-JS ficam inline."""
+    def trocar(m):
+        tag, attrs, corpo = m.group(1).lower(), m.group(2), m.group(3)
+        attrs_min = attrs.lower()
+        if ('src=' in attrs_min or _RE_JINJA.search(corpo) or _RE_JINJA.search(attrs)
+                or len(corpo.strip()) < app.config['ASSETS_MIN_BYTES']):
+            return m.group(0)
+        if tag == 'script' and 'type=' in attrs_min and 'javascript' not in attrs_min:
+            return m.group(0)
+        try:
+            if tag == 'style':
+                rel = _gravar_asset(_minificar_css(corpo), 'css')
+                return f'<link rel="stylesheet" href="{{{{ url_for(\'static\', filename=\'{rel}\') }}}}"{attrs}>'
+            rel = _gravar_asset(_minificar_js(corpo), 'js')
+            return f'<script src="{{{{ url_for(\'static\', filename=\'{rel}\') }}}}"{attrs}></script>'
+        except OSError as e:
+            # static/ somente leitura e sem pré-build: segue inline
+            app.logger.warning("assets: não foi possível gravar bloco de %s: %s", nome_template, e)
+            return m.group(0)
+    return _RE_BLOCO_ASSET.sub(trocar, fonte)
+
+
+class _LoaderAssets(FileSystemLoader):
+    """FileSystemLoader que entrega a fonte já sem o CSS/JS estático."""
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self._cache = {}   # (arquivo, mtime) -> fonte transformada
+
+    def get_source(self, environment, template):
+        fonte, arquivo, uptodate = super().get_source(environment, template)
+        if not app.config['ASSETS_EXTRAIR'] or not template.endswith('.html'):
+            return fonte, arquivo, uptodate
+        chave = (arquivo, os.path.getmtime(arquivo))
+        pronto = self._cache.get(chave)
+        if pronto is None:
+            pronto = self._cache[chave] = _extrair_assets(fonte, template)
+        return pronto, arquivo, uptodate
+
+
+app.jinja_loader = _LoaderAssets(os.path.join(app.root_path, app.template_folder))
+
+
+# ========= TEMPLATES EM PRODUÇÃO =========
+# Sem auto-reload (TEMPLATES_AUTO_RELOAD segue APP_ENV) o Jinja não faz stat dos
+# arquivos a cada render. O bytecode compilado vai para instance/jinja: o
+# primeiro processo compila, os demais (outros workers, próximo restart) só
+# carregam. A chave do bytecode inclui o checksum da fonte, então template
+# alterado é recompilado sozinho.
+def _dir_bytecode() -> str:
+    return os.path.join(app.instance_path, 'jinja')
+
+
+if app.config['TEMPLATES_BYTECODE_CACHE']:
+    os.makedirs(_dir_bytecode(), exist_ok=True)
+    app.jinja_options = {**app.jinja_options,
+                         'bytecode_cache': FileSystemBytecodeCache(_dir_bytecode())}
+
+
+# ========= CACHE DE FRAGMENTOS =========
+# {% cache 'nome', chave1, chave2 %}...{% endcache %}: o trecho é renderizado
+# uma vez por combinação de chaves e reaproveitado (LRU por processo). As
+# chaves devem ser versões do que o trecho mostra (versoes_conteudo()); o
+# corpo só roda no miss, então consultas preguiçosas feitas dentro dele
+# também só acontecem no miss. Nada específico do usuário pode entrar no trecho.
+_FRAGMENTOS: OrderedDict = OrderedDict()
+_FRAGMENTOS_LOCK = threading.Lock()
+_FRAGMENTOS_STATS = {'hits': 0, 'misses': 0}
+
+
+def fragmento(chave: tuple, renderizar):
+    """HTML do cache para `chave` ou, no miss, `renderizar()` (e guarda)."""
+    if not app.config['FRAGMENTOS_CACHE']:
+        return renderizar()
+    with _FRAGMENTOS_LOCK:
+        html = _FRAGMENTOS.get(chave)
+        if html is not None:
+            _FRAGMENTOS.move_to_end(chave)
+            _FRAGMENTOS_STATS['hits'] += 1
+            return html
+        _FRAGMENTOS_STATS['misses'] += 1
+    html = renderizar()   # fora do lock: dois misses simultâneos só renderizam duas vezes
+    with _FRAGMENTOS_LOCK:
+        _FRAGMENTOS[chave] = html
+        while len(_FRAGMENTOS) > app.config['FRAGMENTOS_MAX_ITENS']:
+            _FRAGMENTOS.popitem(last=False)
+    return html
+
+
+class FragmentoCache(Extension):
+    tags = {'cache'}
+
+    def parse(self, parser):
+        lineno = next(parser.stream).lineno
+        chave = [parser.parse_expression()]
+        while parser.stream.skip_if('comma'):
+            chave.append(parser.parse_expression())
+        corpo = parser.parse_statements(('name:endcache',), drop_needle=True)
+        return nodes.CallBlock(
+            self.call_method('_renderizar', [nodes.List(chave)]), [], [], corpo
+        ).set_lineno(lineno)
+
+    def _renderizar(self, chave, caller):
+        return fragmento(tuple(chave), caller)
+
+
+app.jinja_options = {**app.jinja_options,
+                     'extensions': [*app.jinja_options.get('extensions', ()), FragmentoCache]}
+
+
+@registrar_metricas('fragmentos')
+def _metricas_fragmentos():
+    with _FRAGMENTOS_LOCK:
+        return {'itens': len(_FRAGMENTOS), 'max_itens': app.config['FRAGMENTOS_MAX_ITENS'],
+                'ligado': app.config['FRAGMENTOS_CACHE'], **_FRAGMENTOS_STATS}
+
+
+def precompilar_templates() -> int:
+    """Carrega todos os templates no ambiente Jinja deste processo (e grava o
+    bytecode). Com o gunicorn em preload, roda no master e os workers herdam
+    os templates já compilados no fork."""
+    t0 = time.perf_counter()
+    nomes = [n for n in app.jinja_env.list_templates() if n.endswith('.html')]
+    for nome in nomes:
+        app.jinja_env.get_template(nome)
+    app.logger.info("templates: %d pré-compilados em %.0f ms", len(nomes), (time.perf_counter() - t0) * 1000)
+    return len(nomes)
+
+
+def _cache_assets(resp: Response):
+    """Arquivos de static/build/ têm nome = hash do conteúdo: cache de 1 ano, immutable."""
+    if request.endpoint != 'static' or resp.status_code not in (200, 304):
+        return
+    arquivo = (request.view_args or {}).get('filename') or ''
+    if arquivo.startswith(app.config['ASSETS_SUBDIR'] + '/'):
+        resp.headers['Cache-Control'] = f"public, max-age={app.config['ASSETS_MAX_AGE']}, immutable"
+
+
+@app.cli.command('construir-assets')
+def construir_assets_cmd():
+    """Extrai o CSS/JS de todos os templates para static/build (rodar no build/deploy)."""
+    loader = app.jinja_loader
+    total_antes = total_depois = 0
+    for nome in sorted(loader.list_templates()):
+        if not nome.endswith('.html'):
+            continue
+        with open(os.path.join(loader.searchpath[0], nome), encoding='utf-8') as f:
+            antes = len(f.read().encode('utf-8'))
+        depois = len(loader.get_source(app.jinja_env, nome)[0].encode('utf-8'))
+        total_antes, total_depois = total_antes + antes, total_depois + depois
+        click.echo(f"{nome:<32} {antes:>8} -> {depois:>8} bytes")
+    arquivos = os.listdir(_dir_assets()) if os.path.isdir(_dir_assets()) else []
+    click.echo(f"{'total':<32} {total_antes:>8} -> {total_depois:>8} bytes; "
+               f"{len(arquivos)} arquivo(s) em {_dir_assets()}")
+
+
+# ========= COMPRESSÃO =========
+# Estáticos de texto (CSS/JS/SVG/...): a versão .gz/.br é gerada uma vez (no
+# 1º acesso ou por `flask comprimir-estaticos` no build) ao lado do original e
+# servida conforme o Accept-Encoding. Respostas dinâmicas de texto são
+# comprimidas na hora com nível baixo (CPU limitada), em streaming quando a
+# resposta é streamed. Mídia já comprimida (mp3, jpeg, png, mp4...) passa direto.
+try:
+    import brotli as _brotli
+except ImportError:
+    _brotli = None
+
+_EXT_COMPRIMIVEIS = {'.css', '.js', '.mjs', '.map', '.svg', '.json', '.txt', '.html', '.xml', '.csv', '.ico'}
+_MIMES_COMPRIMIVEIS = {
+    'text/html', 'text/css', 'text/plain', 'text/csv', 'text/xml', 'text/javascript',
+    'application/json', 'application/javascript', 'application/xml', 'image/svg+xml',
+}
+_SUFIXO_CODIFICACAO = {'br': '.br', 'gzip': '.gz'}
 
 
-@app.route('/autologin')
-def autologin():
-    token = (request.args.get('token') or '').strip()
-    if not token:
-        return redirect(url_for('login'))
-    try:
-        data = sso_load_shared(token, max_age_seconds=60)
-    except SignatureExpired:
+def _codificacao_aceita() -> str | None:
+    """br (se o módulo brotli existir) ou gzip, conforme o Accept-Encoding do cliente."""
+    aceitas = request.accept_encodings
+    if _brotli is not None and aceitas['br']:
+        return 'br'
+    if aceitas['gzip']:
+        return 'gzip'
+    return None
+
+
+def _comprimir_bytes(dados: bytes, codificacao: str, nivel: int) -> bytes:
+    if codificacao == 'br':
+        return _brotli.compress(dados, quality=nivel)
+    c = zlib.compressobj(nivel, zlib.DEFLATED, 31)   # wbits 31 = formato gzip
+    return c.compress(dados) + c.flush()
+
+
+def _variante_comprimida(caminho: str, codificacao: str) -> str | None:
+    """Caminho do .gz/.br ao lado do original, (re)gerado se faltar ou estiver velho."""
+    destino = caminho + _SUFIXO_CODIFICACAO[codificacao]
+    try:
+        if os.path.exists(destino) and os.path.getmtime(destino) >= os.path.getmtime(caminho):
+            return destino
+        with open(caminho, 'rb') as f:
+            dados = f.read()
+        # offline e uma vez só: nível máximo
+        comprimido = _comprimir_bytes(dados, codificacao, 11 if codificacao == 'br' else 9)
+        tmp = f"{destino}.{os.getpid()}.tmp"
+        with open(tmp, 'wb') as f:
+            f.write(comprimido)
+        os.replace(tmp, destino)
+        return destino
+    except OSError as e:
+        app.logger.warning("compressão: não foi possível gerar %s: %s", destino, e)
+        return None
+
+
+def _enviar_estatico(diretorio: str, nome: str, max_age=None) -> Response:
+    """send_from_directory que prefere a variante pré-comprimida aceita pelo cliente."""
+    ext = os.path.splitext(nome)[1].lower()
+    codificacao = _codificacao_aceita() if app.config['COMPRESSAO'] and ext in _EXT_COMPRIMIVEIS else None
+    caminho = safe_join(diretorio, nome) if codificacao else None
+    if (caminho and os.path.isfile(caminho)
+            and os.path.getsize(caminho) >= app.config['COMPRESSAO_MIN_BYTES']):
+        variante = _variante_comprimida(caminho, codificacao)
+        if variante:
+            resp = send_file(variante, mimetype=mimetypes.guess_type(nome)[0] or 'application/octet-stream',
+                             max_age=max_age)
+            resp.headers['Content-Encoding'] = codificacao
+            resp.vary.add('Accept-Encoding')
+            return resp
+    resp = send_from_directory(diretorio, nome, max_age=max_age)
+    if ext in _EXT_COMPRIMIVEIS:
+        resp.vary.add('Accept-Encoding')
+    return resp
+
+
+def _static_comprimido(filename):
+    return _enviar_estatico(app.static_folder, filename, max_age=app.get_send_file_max_age(filename))
+
+
+app.view_functions['static'] = _static_comprimido
+
+
+def _comprimir_stream(partes, codificacao: str, nivel: int):
+    if codificacao == 'br':
+        c = _brotli.Compressor(quality=nivel)
+        for parte in partes:
+            saida = c.process(parte.encode('utf-8') if isinstance(parte, str) else parte)
+            if saida:
+                yield saida
+        yield c.finish()
+        return
+    c = zlib.compressobj(nivel, zlib.DEFLATED, 31)
+    for parte in partes:
+        saida = c.compress(parte.encode('utf-8') if isinstance(parte, str) else parte)
+        if saida:
+            yield saida
+    yield c.flush()
+
+
+def _comprimir_resposta(resp: Response):
+    """Comprime respostas dinâmicas de texto (HTML, JSON, CSV...) no after_request."""
+    if (not app.config['COMPRESSAO'] or resp.status_code != 200 or request.method == 'HEAD'
+            or resp.direct_passthrough or 'Content-Encoding' in resp.headers
+            or resp.mimetype not in _MIMES_COMPRIMIVEIS
+            or 'no-transform' in (resp.headers.get('Cache-Control') or '')):
+        return
+    resp.vary.add('Accept-Encoding')
+    codificacao = _codificacao_aceita()
+    if not codificacao:
+        return
+    nivel = app.config['COMPRESSAO_BR_NIVEL' if codificacao == 'br' else 'COMPRESSAO_GZIP_NIVEL']
+    if resp.is_streamed:
+        resp.response = _comprimir_stream(resp.response, codificacao, nivel)
+        resp.headers.pop('Content-Length', None)
+    else:
+        dados = resp.get_data()
+        if len(dados) < app.config['COMPRESSAO_MIN_BYTES']:
+            return
+        resp.set_data(_comprimir_bytes(dados, codificacao, nivel))
+    resp.headers['Content-Encoding'] = codificacao
+    etag, fraca = resp.get_etag()
+    if etag and not fraca:
+        resp.set_etag(etag, weak=True)   # outra representação: a ETag forte não vale mais
+
+
+@app.cli.command('comprimir-estaticos')
+def comprimir_estaticos_cmd():
+    """Gera as variantes .gz (e .br, com brotli instalado) dos estáticos de texto."""
+    codificacoes = ['gzip'] + (['br'] if _brotli is not None else [])
+    n = antes = depois = 0
+    for raiz_dir in (app.static_folder, app.config['STATICS_FOLDER']):
+        for raiz, _, arquivos in os.walk(raiz_dir):
+            for nome in arquivos:
+                caminho = os.path.join(raiz, nome)
+                if (os.path.splitext(nome)[1].lower() not in _EXT_COMPRIMIVEIS
+                        or os.path.getsize(caminho) < app.config['COMPRESSAO_MIN_BYTES']):
+                    continue
+                n += 1
+                antes += os.path.getsize(caminho)
+                tamanhos = [os.path.getsize(v) for v in
+                            (_variante_comprimida(caminho, c) for c in codificacoes) if v]
+                depois += min(tamanhos, default=os.path.getsize(caminho))
+    click.echo(f"{n} arquivo(s): {antes} -> {depois} bytes ({', '.join(codificacoes)})")
+
+
+# ========= GET CONDICIONAL (ETag pelas versões de conteúdo) =========
+# Páginas de admin recarregadas toda hora: a ETag sai das versões dos dados que
+# a página mostra (versoes_conteudo), do usuário, dos filtros da URL e da
+# versão do código/templates. Um If-None-Match igual devolve 304 antes de
+# qualquer consulta pesada ou render: custa só a leitura das versões.
+_CONDICIONAL_STATS = {'304': 0, '200': 0}
+_CONDICIONAL_LOCK = threading.Lock()   # workers gthread: várias requisições contam ao mesmo tempo
+
+
+@functools.lru_cache(maxsize=None)
+def _versao_codigo() -> str:
+    """Hash do app e dos templates: deploy novo invalida todas as ETags."""
+    h = hashlib.sha256()
+    loader = app.jinja_loader
+    arquivos = [os.path.abspath(__file__)] + [
+        os.path.join(loader.searchpath[0], n) for n in sorted(loader.list_templates())]
+    for caminho in arquivos:
+        with open(caminho, 'rb') as f:
+            h.update(f.read())
+    return h.hexdigest()[:16]
+
+
+def _etag_pagina(nome: str, chaves, versoes: dict) -> str:
+    p = g.get('principal')
+    partes = [
+        _versao_codigo(), nome,
+        f"{p.tipo}:{p.id}:{p.nome}" if p else '-',
+        *(f"{c}={versoes[c]}" for c in chaves),
+        *(f"{k}={v}" for k, v in sorted(request.args.items(multi=True))),
+    ]
+    return hashlib.sha256('\n'.join(partes).encode('utf-8')).hexdigest()[:32]
+
+
+def get_condicional(*chaves):
+    """Decorator: ETag da página pelas versões de `chaves` (ver CHAVES_CONTEUDO) e
+    304 quando o If-None-Match bate. Página com mensagem flash pendente não
+    participa (a mensagem só aparece uma vez)."""
+    def deco(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            if (not app.config['ETAG_PAGINAS'] or request.method != 'GET'
+                    or session.get('_flashes')):
+                return view(*args, **kwargs)
+            etag = _etag_pagina(view.__name__, chaves, versoes_conteudo())
+            if request.if_none_match.contains_weak(etag):
+                with _CONDICIONAL_LOCK:
+                    _CONDICIONAL_STATS['304'] += 1
+                resp = Response(status=304)
+            else:
+                resp = app.make_response(view(*args, **kwargs))
+                if resp.status_code != 200:
+                    return resp
+                with _CONDICIONAL_LOCK:
+                    _CONDICIONAL_STATS['200'] += 1
+            resp.set_etag(etag, weak=True)
+            resp.headers['Cache-Control'] = 'private, no-cache'
+            return resp
+        return wrapper
+    return deco
+
+
+@registrar_metricas('condicional')
+def _metricas_condicional():
+    with _CONDICIONAL_LOCK:
+        return dict(_CONDICIONAL_STATS)
+
+
+# ========= HEADERS GERAIS =========
+@app.after_request
+def add_perf_headers(resp: Response):
+    resp.headers.setdefault("Connection", "keep-alive")
+    _cache_assets(resp)
+    _registrar_tempos(resp)
+    _comprimir_resposta(resp)
+    return resp
+
+
+@app.route('/autologin')
+def autologin():
+    token = (request.args.get('token') or '').strip()
+    if not token:
+        return redirect(url_for('login'))
+    try:
+        data = sso_load_shared(token, max_age_seconds=60)
+    except SignatureExpired:
         flash('Link expirou. Clique novamente no portal.', 'danger')
         return redirect(url_for('login'))
     except BadSignature:
@@ -604,6 +2438,74 @@ def voltar_admin():
 
 
 # ========= LOGIN/LOGOUT =========
+_LOGIN_DESTINO = {
+    'admin': 'dashboard',
+    'estabelecimento': 'painel_estabelecimento',
+    'cooperado': 'painel_cooperado',
+}
+_LOGIN_TABELAS = {
+    'admin': Admin,
+    'estabelecimento': Estabelecimento,
+    'cooperado': Cooperado,
+}
+_HASH_FICTICIO = {}
+
+
+def _hash_ficticio() -> str:
+    """Hash descartável para gastar o mesmo tempo quando o usuário não existe."""
+    h = _HASH_FICTICIO.get(SENHA_HASH_METODO)
+    if h is None:
+        h = _HASH_FICTICIO[SENHA_HASH_METODO] = gerar_hash_senha(secrets.token_urlsafe(16))
+    return h
+
+
+def _buscar_principais(username: str):
+    """
+    Uma ida ao banco: procura o username em admin, estabelecimento e cooperado
+    (UNION ALL pelos índices únicos de username), na ordem de prioridade do login.
+    """
+    consulta = union_all(
+        select(literal('admin').label('tipo'), Admin.id, Admin.senha_hash,
+               literal(None, String).label('app_token'), literal(1).label('ordem'))
+        .where(Admin.username == username),
+        select(literal('estabelecimento'), Estabelecimento.id, Estabelecimento.senha_hash,
+               literal(None, String), literal(2))
+        .where(Estabelecimento.username == username),
+        select(literal('cooperado'), Cooperado.id, Cooperado.senha_hash,
+               Cooperado.app_token, literal(3))
+        .where(Cooperado.username == username),
+    ).order_by('ordem')
+    return db.session.execute(consulta).all()
+
+
+def autenticar_principal(username: str, senha: str):
+    """
+    Retorna (tipo, id) se usuário/senha conferem, senão None. Verifica o hash
+    uma vez (só repete se o mesmo username existir em mais de uma tabela) e
+    regrava o hash quando SENHA_HASH_METODO mudou.
+    """
+    rows = _buscar_principais(username)
+    if not rows:
+        check_password_hash(_hash_ficticio(), senha)
+        return None
+
+    for row in rows:
+        if not row.senha_hash or not check_password_hash(row.senha_hash, senha):
+            continue
+
+        valores = {}
+        if hash_precisa_atualizar(row.senha_hash):
+            valores['senha_hash'] = gerar_hash_senha(senha)
+        if row.tipo == 'cooperado' and not row.app_token:
+            valores['app_token'] = secrets.token_urlsafe(32)
+        if valores:
+            tabela = _LOGIN_TABELAS[row.tipo].__table__
+            db.session.execute(tabela.update().where(tabela.c.id == row.id).values(**valores))
+            db.session.commit()
+        return row.tipo, row.id
+    return None
+
+
 @app.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -615,29 +2517,12 @@ def login():
             flash('Informe usuário e senha.', 'danger')
             return render_template('login.html'), 400
 
-        # 1) Admin
-        user = Admin.query.filter_by(username=username).first()
-        if user and user.checar_senha(senha):
-            session['user_id'] = user.id
-            session['user_tipo'] = 'admin'
-            return redirect(url_for('dashboard'))
-
-        # 2) Estabelecimento
-        est = Estabelecimento.query.filter_by(username=username).first()
-        if est and est.checar_senha(senha):
-            session['user_id'] = est.id
-            session['user_tipo'] = 'estabelecimento'
-            return redirect(url_for('painel_estabelecimento'))
-
-        # 3) Cooperado
-        coop = Cooperado.query.filter_by(username=username).first()
-        if coop and coop.checar_senha(senha):
-            coop.ensure_app_token()
-            db.session.commit()
-
-            session['user_id'] = coop.id
-            session['user_tipo'] = 'cooperado'
-            return redirect(url_for('painel_cooperado'))
+        principal = autenticar_principal(username, senha)
+        if principal:
+            tipo, user_id = principal
+            session['user_id'] = user_id
+            session['user_tipo'] = tipo
+            return redirect(url_for(_LOGIN_DESTINO[tipo]))
 
         flash('Usuário ou senha inválidos.', 'danger')
         return render_template('login.html'), 401
@@ -650,10 +2535,11 @@ def logout():
     if is_cooperado():
         coop_id = session.get('user_id')
         if coop_id:
-            loc = LocalizacaoCooperado.query.filter_by(cooperado_id=coop_id).first()
-            if loc:
-                loc.online = False
-                db.session.commit()
+            # o sweeper de presença grava online=False em lote
+            _LOC_BUFFER.descartar(coop_id)
+            _PRESENCA.desconectar(coop_id)
+            _INDICE_GEO.remover(coop_id)
+            _garantir_thread_fundo('presenca', app.config['PRESENCA_SWEEP_S'], _varrer_presenca)
 
     session.clear()
     return redirect(url_for('login'))
@@ -662,10 +2548,12 @@ def logout():
 # ========= DASHBOARD (ADMIN) =========
 @app.route('/')
 @app.route('/dashboard')
+@ler_da_replica
+@get_condicional('cooperados', 'estabelecimentos', 'lancamentos')
 def dashboard():
     if not is_admin():
         return redirect(url_for('login'))
-    admin = Admin.query.get(session['user_id'])
+    admin = g.principal
     cooperados = cooperados_visiveis_query().order_by(Cooperado.nome).all()
     estabelecimentos = Estabelecimento.query.order_by(Estabelecimento.nome).all()
 
@@ -794,16 +2682,31 @@ def api_lancamento_info():
 
 # ========= COOPERADOS CRUD =========
 @app.route('/listar_cooperados')
+@get_condicional('cooperados')
 def listar_cooperados():
     if not is_admin():
         return redirect(url_for('login'))
-    admin = Admin.query.get(session['user_id'])
+    admin = g.principal
 
     cooperados = cooperados_visiveis_query().order_by(Cooperado.nome).all()
 
     return render_template('cooperados.html', admin=admin, cooperados=cooperados)
 
 
+def registrar_ajuste_credito(coop: Cooperado, novo_credito: float, origem: str):
+    """Define o crédito do cooperado e registra a diferença (entra no extrato)."""
+    agora = datetime.utcnow()
+    delta = float(novo_credito) - float(coop.credito or 0)
+    coop.credito = float(novo_credito)
+    coop.credito_atualizado_em = agora
+    if abs(delta) >= 0.005:
+        p = g.get('principal')
+        db.session.add(AjusteCredito(
+            cooperado=coop, data=agora, valor=round(delta, 2), credito_resultante=coop.credito,
+            origem=origem, admin_id=p.id if p and p.tipo == 'admin' else None,
+        ))
+
+
 @app.route('/cooperados/novo', methods=['GET', 'POST'])
 def novo_cooperado():
     if not is_admin():
@@ -840,11 +2743,12 @@ def novo_cooperado():
             return redirect(url_for('novo_cooperado'))
 
         cooperado = Cooperado(
-            nome=nome, username=username, credito=credito,
+            nome=nome, username=username, credito=0,
             foto=foto_filename, foto_data=foto_data,
             foto_mimetype=foto_mimetype, foto_filename=foto_filename
         )
         cooperado.set_senha(senha)
+        registrar_ajuste_credito(cooperado, credito, 'cadastro')
 
         db.session.add(cooperado)
         db.session.commit()
@@ -877,8 +2781,7 @@ def editar_cooperado(id):
                     request.form.get('credito', cooperado.credito) or cooperado.credito
                 )
                 if novo_credito != cooperado.credito:
-                    cooperado.credito = novo_credito
-                    cooperado.credito_atualizado_em = datetime.utcnow()  # salvo em UTC
+                    registrar_ajuste_credito(cooperado, novo_credito, 'edicao')
             except Exception:
                 flash('Crédito inválido.', 'danger')
                 return redirect(url_for('editar_cooperado', id=id))
@@ -912,6 +2815,7 @@ def editar_cooperado(id):
             cooperado.set_senha(senha)
 
         db.session.commit()
+        invalidar_identidade('cooperado', cooperado.id)
         flash('Cooperado alterado!', 'success')
         return redirect(url_for('listar_cooperados'))
     return render_template('cooperado_form.html', editar=True, cooperado=cooperado)
@@ -986,6 +2890,10 @@ def excluir_cooperado(cooperado_id):
                 {"cooperado_id": placeholder.id},
                 synchronize_session=False
             )
+            DescontoLancamento.query.filter_by(cooperado_id=cooperado.id).update(
+                {"cooperado_id": placeholder.id},
+                synchronize_session=False
+            )
 
         # 2) Remove vínculos que não são histórico financeiro (views/likes de stories)
         # (Se sua tabela story_view existir; você tem o model StoryView no app)
@@ -995,9 +2903,17 @@ def excluir_cooperado(cooperado_id):
             # Se por algum motivo não existir a tabela/model em runtime, não bloqueia a exclusão
             pass
 
+        AjusteCredito.query.filter_by(cooperado_id=cooperado.id).delete(synchronize_session=False)
+
+        # Posição atual do app (a do buffer também, para o flush não recriar a linha)
+        LocalizacaoCooperado.query.filter_by(cooperado_id=cooperado.id).delete(synchronize_session=False)
+        _LOC_BUFFER.descartar(cooperado.id)
+
         # 3) Agora pode excluir o cooperado
         db.session.delete(cooperado)
         db.session.commit()
+        invalidar_cache_app_token(coop_id=cooperado_id)
+        invalidar_identidade('cooperado', cooperado_id)
 
         flash("Cooperado excluído com sucesso.", "success")
 
@@ -1114,38 +3030,43 @@ def registrar_story_view():
     except Exception:
         return jsonify({"error": "story_id inválido"}), 400
 
-    story = StoryEstabelecimento.query.get_or_404(story_id)
+    if db.session.execute(_SQL_STORY_EXISTE, {'story_id': story_id}).scalar() is None:
+        abort(404)
     coop_id = session.get('user_id')
     if not coop_id:
         return jsonify({"error": "sem sessão"}), 403
 
     agora = datetime.utcnow()
 
-    sv = StoryView.query.filter_by(story_id=story_id, cooperado_id=coop_id).first()
-    if not sv:
-        sv = StoryView(
-            story_id=story_id,
-            cooperado_id=coop_id,
-            viu_em=agora
-        )
-        if liked is not None:
-            sv.curtiu = bool(liked)
-        db.session.add(sv)
+    upsert = _comando_dialeto(
+        'upsert_story_view' if liked is None else 'upsert_story_view_curtida',
+        lambda dialeto: _construir_upsert_story_view(dialeto, com_curtida=liked is not None),
+    )
+    if upsert is not None:
+        curtiu = db.session.execute(upsert, {
+            'story_id': story_id, 'cooperado_id': coop_id, 'viu_em': agora,
+            'curtiu': bool(liked) if liked is not None else False,
+        }).scalar()
     else:
+        sv = StoryView.query.filter_by(story_id=story_id, cooperado_id=coop_id).first()
+        if not sv:
+            sv = StoryView(story_id=story_id, cooperado_id=coop_id, viu_em=agora, curtiu=False)
+            db.session.add(sv)
         sv.viu_em = agora
         if liked is not None:
             sv.curtiu = bool(liked)
+        db.session.flush()
+        curtiu = sv.curtiu
 
     db.session.commit()
 
-    views = StoryView.query.filter_by(story_id=story_id).count()
-    likes = StoryView.query.filter_by(story_id=story_id, curtiu=True).count()
+    views, likes = db.session.execute(_SQL_STORY_STATS, {'story_id': story_id}).one()
 
     return jsonify({
         "ok": True,
         "views": views,
-        "likes": likes,
-        "liked": sv.curtiu
+        "likes": int(likes),
+        "liked": bool(curtiu)
     })
 
 
@@ -1166,11 +3087,10 @@ def ajustar_credito():
             c = Cooperado.query.get(int(cooperado_id))
             if c:
                 try:
-                    c.credito = float(novo_credito)
-                except Exception:
+                    registrar_ajuste_credito(c, float(novo_credito), 'ajuste')
+                except ValueError:
                     flash('Crédito inválido.', 'danger')
                     return redirect(url_for('ajustar_credito'))
-                c.credito_atualizado_em = datetime.utcnow()
                 db.session.commit()
                 flash('Crédito ajustado!', 'success')
                 return redirect(url_for('ajustar_credito'))
@@ -1190,11 +3110,10 @@ def ajustar_credito_individual(id):
         novo_credito = request.form.get('credito')
         if novo_credito is not None:
             try:
-                cooperado.credito = float(novo_credito)
-            except Exception:
+                registrar_ajuste_credito(cooperado, float(novo_credito), 'ajuste')
+            except ValueError:
                 flash('Crédito inválido.', 'danger')
                 return redirect(url_for('ajustar_credito_individual', id=id))
-            cooperado.credito_atualizado_em = datetime.utcnow()
             db.session.commit()
             flash('Crédito ajustado!', 'success')
             return redirect(url_for('listar_cooperados'))
@@ -1203,10 +3122,11 @@ def ajustar_credito_individual(id):
 
 # ========= ESTABELECIMENTOS CRUD =========
 @app.route('/listar_estabelecimentos')
+@get_condicional('estabelecimentos')
 def listar_estabelecimentos():
     if not is_admin():
         return redirect(url_for('login'))
-    admin = Admin.query.get(session['user_id'])
+    admin = g.principal
     estabelecimentos = Estabelecimento.query.order_by(Estabelecimento.nome).all()
     return render_template('estabelecimentos.html', admin=admin, estabelecimentos=estabelecimentos)
 
@@ -1291,6 +3211,7 @@ def editar_estabelecimento(id):
                 pass
 
         db.session.commit()
+        invalidar_identidade('estabelecimento', est.id)
         flash('Estabelecimento alterado!', 'success')
         return redirect(url_for('listar_estabelecimentos'))
     return render_template('estabelecimento_form.html', editar=True, estabelecimento=est)
@@ -1302,16 +3223,18 @@ def excluir_estabelecimento(id):
     est = Estabelecimento.query.get_or_404(id)
     db.session.delete(est)
     db.session.commit()
+    invalidar_identidade('estabelecimento', id)
     flash('Estabelecimento excluído!', 'success')
     return redirect(url_for('listar_estabelecimentos'))
 
 
 # ========= LANÇAMENTOS (ADMIN) =========
 @app.route('/lancamentos')
+@ler_da_replica
 def listar_lancamentos():
     if not is_admin():
         return redirect(url_for('login'))
-    admin = Admin.query.get(session['user_id'])
+    admin = g.principal
     cooperados = cooperados_visiveis_query().order_by(Cooperado.nome).all()
     estabelecimentos = Estabelecimento.query.order_by(Estabelecimento.nome).all()
     filtros = {
@@ -1351,6 +3274,7 @@ def listar_lancamentos():
 
 
 @app.route('/lancamentos/exportar')
+@ler_da_replica
 def exportar_lancamentos():
     if not is_admin():
         return redirect(url_for('login'))
@@ -1487,6 +3411,7 @@ def descontar_lancamento_admin(id):
     # registra histórico do desconto
     d = DescontoLancamento(
         lancamento_id=l.id,
+        cooperado_id=l.cooperado_id,
         valor=float(valor_f),
         observacao=obs
     )
@@ -1508,12 +3433,20 @@ def descontar_lancamento_admin(id):
 
 
 # ========= PAINEL ESTABELECIMENTO =========
+LancamentoPainel = namedtuple(
+    'LancamentoPainel', 'id data os_numero valor descricao cooperado_nome data_brasilia'
+)
+
+
 @app.route('/painel_estabelecimento', methods=['GET', 'POST'])
 def painel_estabelecimento():
     if not is_estabelecimento():
         return redirect(url_for('login'))
 
-    est = Estabelecimento.query.get(session['user_id'])
+    est = g.principal
+    if est is None:
+        session.clear()
+        return redirect(url_for('login'))
     cooperados = cooperados_visiveis_query().order_by(Cooperado.nome).all()
 
     # ========= Lançamento de crédito (incluindo data retroativa) =========
@@ -1582,17 +3515,17 @@ def painel_estabelecimento():
     df_s = request.args.get('data_fim')
     di_utc, df_utc_excl = local_bounds_to_utc_naive(di_s, df_s)
 
-    q = Lancamento.query.filter_by(estabelecimento_id=est.id)
-    if di_utc:
-        q = q.filter(Lancamento.data >= di_utc)
-    if df_utc_excl:
-        q = q.filter(Lancamento.data < df_utc_excl)
-
-    lancamentos = q.order_by(Lancamento.data.desc()).all()
+    # linhas leves (sem ORM) com o nome do cooperado já no JOIN
+    rows = db.session.execute(
+        _SQL_LANCAMENTOS_ESTAB[(di_utc is not None, df_utc_excl is not None)],
+        {'est_id': est.id, 'inicio': di_utc, 'fim': df_utc_excl},
+    ).all()
 
     # Exibição em Brasília
-    for l in lancamentos:
-        l.data_brasilia = to_brt(l.data).strftime('%d/%m/%Y %H:%M')
+    lancamentos = [
+        LancamentoPainel(*r, data_brasilia=to_brt(r.data).strftime('%d/%m/%Y %H:%M'))
+        for r in rows
+    ]
 
     # ========= Itens de catálogo para este estabelecimento =========
     catalogo_itens = CatalogoItem.query.filter_by(
@@ -1663,7 +3596,9 @@ def estab_catalogo_upload():
     if not is_estabelecimento():
         return redirect(url_for('login'))
 
-    est = Estabelecimento.query.get_or_404(session['user_id'])
+    est = g.principal
+    if est is None:
+        abort(404)
 
     file = (
         request.files.get('arquivo_catalogo')
@@ -1793,7 +3728,9 @@ def estab_catalogo_criar_item():
     if not is_estabelecimento():
         return redirect(url_for('login'))
 
-    est = Estabelecimento.query.get_or_404(session['user_id'])
+    est = g.principal
+    if est is None:
+        abort(404)
 
     # Tenta vários nomes de campo para ser compatível com o HTML
     nome = (
@@ -1940,7 +3877,9 @@ def estab_story_novo():
     if not is_estabelecimento():
         return redirect(url_for('login'))
 
-    est = Estabelecimento.query.get_or_404(session['user_id'])
+    est = g.principal
+    if est is None:
+        abort(404)
 
     # Pode vir com vários nomes diferentes do formulário
     midia = (
@@ -2200,6 +4139,51 @@ def estab_excluir_lancamento(id):
 
 
 # ========= PAINEL COOPERADO =========
+class ConteudoPainelCooperado:
+    """Estabelecimentos, catálogo e stories ativos do painel do cooperado,
+    consultados só no primeiro acesso (ou seja, só no miss do cache de fragmentos)."""
+
+    @functools.cached_property
+    def estab_por_id(self) -> dict:
+        return {e.id: e for e in Estabelecimento.query.order_by(Estabelecimento.nome).all()}
+
+    @functools.cached_property
+    def catalogo_itens(self) -> list:
+        if not self.estab_por_id:
+            return []
+        return CatalogoItem.query.filter(
+            CatalogoItem.estabelecimento_id.in_(list(self.estab_por_id))
+        ).order_by(
+            CatalogoItem.estabelecimento_id,
+            CatalogoItem.nome
+        ).all()
+
+    @functools.cached_property
+    def stories_ativos(self) -> list:
+        return StoryEstabelecimento.query.filter(
+            StoryEstabelecimento.ativo == True,
+            StoryEstabelecimento.expira_em > datetime.utcnow()
+        ).order_by(
+            StoryEstabelecimento.criado_em.asc()
+        ).all()
+
+
+_SQL_PROXIMA_EXPIRACAO_STORY = select(func.min(StoryEstabelecimento.expira_em)).where(
+    StoryEstabelecimento.ativo.is_(True), StoryEstabelecimento.expira_em > bindparam('agora'))
+_JANELA_STORIES = [(None, None)]   # [(versão, próxima expiração)] deste processo
+
+
+def janela_stories(versao: int) -> tuple:
+    """Chave de cache do conjunto de stories ativos: além da versão, o conjunto
+    muda sozinho quando um story expira, então a chave inclui a próxima expiração."""
+    agora = datetime.utcnow()
+    v, ate = _JANELA_STORIES[0]
+    if v != versao or (ate is not None and agora >= ate):
+        ate = db.session.execute(_SQL_PROXIMA_EXPIRACAO_STORY, {'agora': agora}).scalar()
+        _JANELA_STORIES[0] = (versao, ate)
+    return versao, ate
+
+
 @app.route('/painel_cooperado')
 def painel_cooperado():
     if not is_cooperado():
@@ -2212,8 +4196,11 @@ def painel_cooperado():
     df_s = request.args.get('data_fim') or ''
     di_utc, df_utc_excl = local_bounds_to_utc_naive(di_s, df_s)
 
-    # Lançamentos do cooperado (normal, como antes)
-    q = Lancamento.query.filter(Lancamento.cooperado_id == coop.id)
+    # Lançamentos do cooperado (normal, como antes). Os estabelecimentos vêm
+    # numa consulta só (IN): com o catálogo em cache eles não estão mais na
+    # sessão, e o lazy load faria um SELECT por estabelecimento.
+    q = Lancamento.query.options(selectinload(Lancamento.estabelecimento)).filter(
+        Lancamento.cooperado_id == coop.id)
     if di_utc:
         q = q.filter(Lancamento.data >= di_utc)
     if df_utc_excl:
@@ -2228,27 +4215,10 @@ def painel_cooperado():
     total_lanc = len(lancamentos)
 
     # ========= ESTABs / CATÁLOGOS / STORIES =========
-    estab_list = Estabelecimento.query.order_by(Estabelecimento.nome).all()
-    estab_por_id = {e.id: e for e in estab_list}
-    est_ids = [e.id for e in estab_list]
-
-    if est_ids:
-        catalogo_itens_coop = CatalogoItem.query.filter(
-            CatalogoItem.estabelecimento_id.in_(est_ids)
-        ).order_by(
-            CatalogoItem.estabelecimento_id,
-            CatalogoItem.nome
-        ).all()
-    else:
-        catalogo_itens_coop = []
-
-    agora_utc = datetime.utcnow()
-    stories_ativos_coop = StoryEstabelecimento.query.filter(
-        StoryEstabelecimento.ativo == True,
-        StoryEstabelecimento.expira_em > agora_utc
-    ).order_by(
-        StoryEstabelecimento.criado_em.asc()
-    ).all()
+    # Iguais para todo cooperado: o template guarda os trechos em cache pelas
+    # versões e só consulta (preguiçosamente) quando alguma mudou.
+    versoes = versoes_conteudo()
+    versoes['stories'] = janela_stories(versoes['stories'])
 
     try:
         return render_template(
@@ -2259,9 +4229,8 @@ def painel_cooperado():
             total_lanc=total_lanc,
             data_inicio=di_s,
             data_fim=df_s,
-            catalogo_itens_coop=catalogo_itens_coop,
-            stories_ativos_coop=stories_ativos_coop,
-            estab_por_id=estab_por_id,
+            compartilhado=ConteudoPainelCooperado(),
+            versoes=versoes,
             app_token=coop.app_token
         )
     except TemplateNotFound:
@@ -2379,50 +4348,541 @@ def painel_cooperado():
 
 
 
-@app.post('/api/app/localizacao')
-def api_app_localizacao():
-    data = request.get_json(silent=True) or {}
+# ========= TAREFAS DE FUNDO (por processo) =========
+_THREADS_FUNDO = {}
+_THREADS_FUNDO_LOCK = threading.Lock()
+
+
+def _garantir_thread_fundo(nome: str, intervalo_s: float, fn):
+    """
+    Sobe (uma vez por processo) uma thread daemon que roda fn() a cada
+    intervalo_s dentro do app_context. Guarda o pid para recriar a thread
+    depois de um fork do gunicorn (threads não sobrevivem ao fork). nome tem
+    de estar em TAREFAS_FUNDO (tarefas_fundo.py), que dimensiona pool e threads.
+    """
+    pid = os.getpid()
+    atual = _THREADS_FUNDO.get(nome)
+    if atual and atual[0] == pid and atual[1].is_alive():
+        return
+    with _THREADS_FUNDO_LOCK:
+        atual = _THREADS_FUNDO.get(nome)
+        if atual and atual[0] == pid and atual[1].is_alive():
+            return
+        if nome not in TAREFAS_FUNDO:
+            raise ValueError(f"tarefa de fundo {nome!r} fora de TAREFAS_FUNDO")
+
+        def _loop():
+            while True:
+                time.sleep(intervalo_s)
+                try:
+                    with app.app_context():
+                        fn()
+                except Exception:
+                    app.logger.exception("Falha na tarefa de fundo %s", nome)
+
+        t = threading.Thread(target=_loop, name=f"coopex-{nome}", daemon=True)
+        t.start()
+        _THREADS_FUNDO[nome] = (pid, t)
+
+
+# ========= LOCALIZAÇÃO: INGESTÃO EM LOTE (write-behind) =========
+def _parse_ts_ponto(v) -> datetime:
+    """
+    Timestamp de um ponto do app -> datetime UTC (naive).
+    Aceita epoch em segundos ou milissegundos, ou ISO-8601. Datas no futuro
+    (relógio do aparelho adiantado) ou inválidas viram "agora".
+    """
+    agora = datetime.utcnow()
+    if v is None or v == '':
+        return agora
+    try:
+        if isinstance(v, (int, float)) or str(v).replace('.', '', 1).isdigit():
+            f = float(v)
+            if f > 1e11:  # milissegundos
+                f = f / 1000.0
+            dt = datetime.fromtimestamp(f, tz=UTC).replace(tzinfo=None)
+        else:
+            dt = datetime.fromisoformat(str(v).strip().replace('Z', '+00:00'))
+            if dt.tzinfo is not None:
+                dt = dt.astimezone(UTC).replace(tzinfo=None)
+    except (ValueError, OverflowError, OSError):
+        return agora
+    return min(dt, agora)
+
+
+def _epoch_utc(dt: datetime) -> float:
+    return dt.replace(tzinfo=UTC).timestamp()
+
+
+def _ponto_localizacao(coop_id: int, p: dict, fonte: str) -> dict | None:
+    """Normaliza um ponto recebido do app numa linha de localizacao_cooperado."""
+    lat = p.get('latitude')
+    lng = p.get('longitude')
+    if lat is None or lng is None:
+        return None
+    try:
+        lat = float(lat)
+        lng = float(lng)
+        accuracy = float(p.get('accuracy') or 0)
+        speed = float(p.get('speed') or 0)
+    except (TypeError, ValueError):
+        return None
+    if not (-90.0 <= lat <= 90.0 and -180.0 <= lng <= 180.0):
+        return None
+    return {
+        'cooperado_id': int(coop_id),
+        'latitude': lat,
+        'longitude': lng,
+        'accuracy': accuracy,
+        'speed': speed,
+        'online': True,
+        'fonte': fonte,
+        'atualizado_em': _parse_ts_ponto(p.get('timestamp', p.get('ts'))),
+    }
+
 
+def _upsert_localizacoes(linhas: list[dict]):
+    """
+    Grava várias localizações com um INSERT ... ON CONFLICT (cooperado_id)
+    pré-montado, executado em executemany.
+    Só sobrescreve se o ponto for mais novo que o salvo (outro worker pode ter
+    gravado um ponto mais recente antes).
+    """
+    if not linhas:
+        return
+    tabela = LocalizacaoCooperado.__table__
+    stmt = _comando_dialeto('upsert_localizacao', _construir_upsert_localizacao)
+
+    if stmt is not None:
+        # executemany do mesmo comando (um SQL só, qualquer que seja o tamanho do lote)
+        with db.engine.begin() as conn:
+            # carimbo já com a conexão em mãos: a espera pelo pool não atrasa o commit em relação a ele
+            agora = datetime.utcnow()
+            conn.execute(stmt, [{**linha, 'gravado_em': agora} for linha in linhas])
+        return
+
+    # Outros bancos: upsert linha a linha na mesma transação
+    with db.engine.begin() as conn:
+        agora = datetime.utcnow()
+        for linha in ({**l, 'gravado_em': agora} for l in linhas):
+            res = conn.execute(
+                tabela.update()
+                .where(tabela.c.cooperado_id == linha['cooperado_id'])
+                .values(**linha)
+            )
+            if not res.rowcount:
+                conn.execute(tabela.insert().values(**linha))
+
+
+def _inserir_historico(linhas: list[dict], lote: int = 1000):
+    """Insere pontos no histórico em lotes (executemany), ignorando repetidos."""
+    # ponto de antes da retenção (app offline por dias, epoch 0, segundos x ms
+    # trocados) não tem partição e seria apagado na próxima manutenção
+    hoje = datetime.utcnow().date()
+    limite = hoje - timedelta(days=app.config['LOC_HIST_DIAS_RETENCAO'])
+    limite = datetime(limite.year, limite.month, limite.day)
+    linhas = [l for l in linhas if l['atualizado_em'] >= limite]
+    if not linhas:
+        return
+    stmt = _comando_dialeto('insert_historico', _construir_insert_historico)
+    _garantir_particoes_historico()
+    # pontos atrasados caem em dias fora da janela padrão (ontem .. hoje+2)
+    _garantir_particoes_historico(dias=sorted({l['atualizado_em'].date() for l in linhas}))
+
+    registros = [
+        {
+            'cooperado_id': l['cooperado_id'],
+            'registrado_em': l['atualizado_em'],
+            'latitude': l['latitude'],
+            'longitude': l['longitude'],
+            'accuracy': l['accuracy'],
+            'speed': l['speed'],
+        }
+        for l in linhas
+    ]
+    with db.engine.begin() as conn:
+        for i in range(0, len(registros), lote):
+            conn.execute(stmt, registros[i:i + lote])
+
+
+class _BufferLocalizacao:
+    """
+    Buffer write-behind das localizações do app. Guarda só o ponto mais novo
+    por cooperado e grava tudo num upsert multi-linha a cada LOC_FLUSH_MS.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._pendentes: dict[int, dict] = {}
+        self._historico: list[dict] = []
+
+    def adicionar(self, linha: dict, historico: bool = True):
+        with self._lock:
+            atual = self._pendentes.get(linha['cooperado_id'])
+            if atual is None or linha['atualizado_em'] >= atual['atualizado_em']:
+                self._pendentes[linha['cooperado_id']] = linha
+            if historico:
+                self._historico.append(linha)
+
+    def _drenar(self) -> tuple[list[dict], list[dict]]:
+        with self._lock:
+            linhas = list(self._pendentes.values())
+            historico = self._historico
+            self._pendentes = {}
+            self._historico = []
+        return linhas, historico
+
+    def flush(self):
+        linhas, historico = self._drenar()
+        if linhas:
+            try:
+                _upsert_localizacoes(linhas)
+            except IntegrityError:
+                # cooperado excluído com ponto no buffer (FK): grava um a um e descarta o inválido
+                for linha in linhas:
+                    try:
+                        _upsert_localizacoes([linha])
+                    except IntegrityError:
+                        app.logger.warning(
+                            "Localização descartada: cooperado_id=%s não existe", linha['cooperado_id']
+                        )
+                        historico = [h for h in historico if h['cooperado_id'] != linha['cooperado_id']]
+            except Exception:
+                # mantém os pontos para a próxima rodada (sem sobrescrever pontos mais novos)
+                for linha in linhas:
+                    self.adicionar(linha, historico=False)
+                with self._lock:
+                    self._historico[:0] = historico
+                raise
+        if historico:
+            # histórico é "melhor esforço": se falhar, perde só este lote
+            _inserir_historico(historico)
+        return len(linhas)
+
+    def descartar(self, coop_id: int):
+        """Esquece a posição pendente (ex.: logout), mantendo o histórico."""
+        with self._lock:
+            self._pendentes.pop(coop_id, None)
+
+    def __len__(self):
+        return len(self._pendentes) + len(self._historico)
+
+
+_LOC_BUFFER = _BufferLocalizacao()
+
+
+def _flush_localizacoes():
+    _LOC_BUFFER.flush()
+
+
+@atexit.register
+def _flush_localizacoes_na_saida():
+    if not len(_LOC_BUFFER):
+        return
+    try:
+        with app.app_context():
+            _LOC_BUFFER.flush()
+    except Exception:
+        pass
+
+
+def _ingerir_localizacoes(linhas: list[dict]):
+    """Ponto único de entrada das localizações recebidas do app."""
+    if not linhas:
+        return
+    _alimentar_indice_espacial(linhas)
+    _registrar_heartbeats(linhas)
+    historico = app.config['LOC_HISTORICO']
+    if not app.config['LOC_WRITE_BEHIND']:
+        atual = {}
+        for linha in linhas:
+            ant = atual.get(linha['cooperado_id'])
+            if ant is None or linha['atualizado_em'] >= ant['atualizado_em']:
+                atual[linha['cooperado_id']] = linha
+        _upsert_localizacoes(list(atual.values()))
+        if historico:
+            _inserir_historico(linhas)
+        return
+    for linha in linhas:
+        _LOC_BUFFER.adicionar(linha, historico=historico)
+    _garantir_thread_fundo(
+        'loc_flush', app.config['LOC_FLUSH_MS'] / 1000.0, _flush_localizacoes
+    )
+
+
+# ========= AUTENTICAÇÃO DO APP (cache de token) =========
+# Válidos em LRU (estouro tira só o menos usado); inválidos num mapa separado e
+# menor, para uma enxurrada de tokens inventados não empurrar os válidos para fora.
+_TOKEN_CACHE: OrderedDict = OrderedDict()       # token -> (cooperado_id, expira_em)
+_TOKEN_CACHE_NEG: OrderedDict = OrderedDict()   # token -> expira_em
+_TOKEN_CACHE_LOCK = threading.Lock()
+
+
+def coop_id_por_app_token(token: str) -> int | None:
+    """
+    Resolve o token do app para o id do cooperado. Em regime, sai do cache do
+    worker (zero leituras no banco); na falta, lê só a coluna id pelo índice
+    único de app_token. Tokens inválidos também ficam em cache por pouco tempo.
+    """
+    agora = time.time()
+    with _TOKEN_CACHE_LOCK:
+        hit = _TOKEN_CACHE.get(token)
+        if hit is not None and hit[1] > agora:
+            _TOKEN_CACHE.move_to_end(token)
+            return hit[0]
+        neg = _TOKEN_CACHE_NEG.get(token)
+        if neg is not None and neg > agora:
+            return None
+
+    coop_id = db.session.execute(_SQL_COOP_POR_TOKEN, {'token': token}).scalar()
+
+    with _TOKEN_CACHE_LOCK:
+        if coop_id:
+            _TOKEN_CACHE[token] = (coop_id, agora + app.config['APP_TOKEN_CACHE_TTL_S'])
+            _TOKEN_CACHE.move_to_end(token)
+            while len(_TOKEN_CACHE) > app.config['APP_TOKEN_CACHE_MAX']:
+                _TOKEN_CACHE.popitem(last=False)
+        else:
+            _TOKEN_CACHE.pop(token, None)
+            _TOKEN_CACHE_NEG[token] = agora + app.config['APP_TOKEN_CACHE_NEG_TTL_S']
+            _TOKEN_CACHE_NEG.move_to_end(token)
+            while len(_TOKEN_CACHE_NEG) > app.config['APP_TOKEN_CACHE_NEG_MAX']:
+                _TOKEN_CACHE_NEG.popitem(last=False)
+    return coop_id
+
+
+def invalidar_cache_app_token(token: str | None = None, coop_id: int | None = None):
+    """
+    Tira do cache um token (rotação) ou todos os tokens de um cooperado
+    (exclusão). Só vale para este worker: os demais continuam aceitando o
+    token antigo até APP_TOKEN_CACHE_TTL_S.
+    """
+    with _TOKEN_CACHE_LOCK:
+        if token is not None:
+            _TOKEN_CACHE.pop(token, None)
+        if coop_id is not None:
+            for k in [k for k, v in _TOKEN_CACHE.items() if v[0] == coop_id]:
+                del _TOKEN_CACHE[k]
+
+
+def _coop_id_por_app_token(data: dict):
+    """
+    Autentica o app pelo header Authorization: Bearer <token>.
+    Retorna (cooperado_id, None) ou (None, resposta_de_erro).
+    """
     auth = (request.headers.get('Authorization') or '').strip()
     token = ''
     if auth.lower().startswith('bearer '):
         token = auth[7:].strip()
 
+    if not token:
+        return None, (jsonify({'ok': False, 'error': 'token ausente'}), 401)
+
+    coop_id = coop_id_por_app_token(token)
+    if not coop_id:
+        return None, (jsonify({'ok': False, 'error': 'token inválido'}), 401)
+
     user_id = str(data.get('user_id') or '').strip()
-    lat = data.get('latitude')
-    lng = data.get('longitude')
-    accuracy = data.get('accuracy')
-    speed = data.get('speed')
-    source = (data.get('source') or 'android_native').strip()
+    if user_id and str(coop_id) != user_id:
+        return None, (jsonify({'ok': False, 'error': 'user_id não confere'}), 403)
 
-    if not token:
-        return jsonify({'ok': False, 'error': 'token ausente'}), 401
+    return coop_id, None
 
-    coop = Cooperado.query.filter_by(app_token=token).first()
-    if not coop:
-        return jsonify({'ok': False, 'error': 'token inválido'}), 401
 
-    if user_id and str(coop.id) != user_id:
-        return jsonify({'ok': False, 'error': 'user_id não confere'}), 403
+@app.post('/api/app/localizacao')
+def api_app_localizacao():
+    data = request.get_json(silent=True) or {}
+
+    coop_id, erro = _coop_id_por_app_token(data)
+    if erro:
+        return erro
 
-    if lat is None or lng is None:
+    if data.get('latitude') is None or data.get('longitude') is None:
         return jsonify({'ok': False, 'error': 'latitude/longitude ausentes'}), 400
 
-    loc = LocalizacaoCooperado.query.filter_by(cooperado_id=coop.id).first()
-    if not loc:
-        loc = LocalizacaoCooperado(cooperado_id=coop.id)
-        db.session.add(loc)
-
-    loc.latitude = float(lat)
-    loc.longitude = float(lng)
-    loc.accuracy = float(accuracy or 0)
-    loc.speed = float(speed or 0)
-    loc.online = True
-    loc.fonte = source
-    loc.atualizado_em = datetime.utcnow()
+    source = (data.get('source') or 'android_native').strip()
+    linha = _ponto_localizacao(coop_id, data, source)
+    if not linha:
+        return jsonify({'ok': False, 'error': 'latitude/longitude inválidas'}), 400
 
-    db.session.commit()
-    return jsonify({'ok': True, 'cooperado_id': coop.id}), 200
+    _ingerir_localizacoes([linha])
+    return jsonify({'ok': True, 'cooperado_id': coop_id}), 200
+
+
+@app.post('/api/app/localizacao/lote')
+def api_app_localizacao_lote():
+    """
+    Recebe vários pontos de um mesmo aparelho:
+    {"user_id": 1, "source": "android_native",
+     "pontos": [{"latitude": .., "longitude": .., "accuracy": .., "speed": .., "timestamp": 1700000000000}, ...]}
+    Só o ponto mais novo vira a posição "atual" do cooperado.
+    """
+    data = request.get_json(silent=True) or {}
+
+    coop_id, erro = _coop_id_por_app_token(data)
+    if erro:
+        return erro
+
+    pontos = data.get('pontos')
+    if not isinstance(pontos, list) or not pontos:
+        return jsonify({'ok': False, 'error': 'pontos ausentes'}), 400
+    if len(pontos) > app.config['LOC_MAX_PONTOS_LOTE']:
+        return jsonify({'ok': False, 'error': 'pontos demais no lote'}), 413
+
+    source = (data.get('source') or 'android_native').strip()
+    linhas = [
+        linha for linha in (
+            _ponto_localizacao(coop_id, p, source) for p in pontos if isinstance(p, dict)
+        ) if linha
+    ]
+    if not linhas:
+        return jsonify({'ok': False, 'error': 'nenhum ponto válido'}), 400
+
+    _ingerir_localizacoes(linhas)
+    return jsonify({
+        'ok': True,
+        'cooperado_id': coop_id,
+        'recebidos': len(pontos),
+        'aceitos': len(linhas),
+    }), 200
+
+
+# ========= EXTRATO DO COOPERADO =========
+# Lançamentos (débito), descontos (crédito devolvido) e ajustes do admin num
+# fluxo só, do mais novo para o mais antigo. Cada fonte é lida pelo seu índice
+# (cooperado, data desc, id desc) com LIMIT; o saldo corrente sai de uma window
+# function ancorada no saldo de cima da página (na primeira, o crédito atual,
+# lido no mesmo comando que os movimentos).
+_EXTRATO_TIPOS = {1: 'lancamento', 2: 'desconto', 3: 'ajuste'}
+_EXTRATO_LIMITE_MAX = 200
+
+
+def _ramo_extrato(k: int, tabela, data, valor, com_cursor: bool, **extras):
+    k_sql = literal_column(str(k), db.Integer)
+    colunas = [k_sql.label('k'), tabela.c.id.label('id'), data.label('data'), valor.label('valor')]
+    for nome, tipo in (('lancamento_id', db.Integer), ('estabelecimento_id', db.Integer),
+                       ('os_numero', db.String), ('detalhe', db.String)):
+        col = extras.get(nome)
+        colunas.append((col if col is not None else cast(null(), tipo)).label(nome))
+    stmt = select(*colunas).where(tabela.c.cooperado_id == bindparam('coop_id'))
+    if com_cursor:
+        # (data, k, id) < cursor, com data <= c_data na frente para o índice fazer o range
+        stmt = stmt.where(data <= bindparam('c_data', type_=db.DateTime), or_(
+            data < bindparam('c_data', type_=db.DateTime),
+            k_sql < bindparam('c_k', type_=db.Integer),
+            and_(k_sql == bindparam('c_k', type_=db.Integer), tabela.c.id < bindparam('c_id', type_=db.Integer)),
+        ))
+    return select(stmt.order_by(data.desc(), tabela.c.id.desc()).limit(bindparam('n')).subquery())
+
+
+def _sql_extrato(com_cursor: bool):
+    lanc, desc, ajuste = Lancamento.__table__, DescontoLancamento.__table__, AjusteCredito.__table__
+    mov = union_all(
+        _ramo_extrato(1, lanc, lanc.c.data, -lanc.c.valor, com_cursor,
+                      lancamento_id=lanc.c.id, estabelecimento_id=lanc.c.estabelecimento_id,
+                      os_numero=lanc.c.os_numero, detalhe=lanc.c.descricao),
+        _ramo_extrato(2, desc, desc.c.criado_em, desc.c.valor, com_cursor,
+                      lancamento_id=desc.c.lancamento_id, detalhe=desc.c.observacao),
+        _ramo_extrato(3, ajuste, ajuste.c.data, ajuste.c.valor, com_cursor, detalhe=ajuste.c.origem),
+    ).subquery('mov')
+    ordem = (mov.c.data.desc(), mov.c.k.desc(), mov.c.id.desc())
+    if com_cursor:
+        topo = bindparam('saldo', type_=db.Float)
+    else:
+        # mesmo snapshot dos movimentos: um lançamento gravado entre duas leituras
+        # separadas deixaria o saldo da página inteira deslocado
+        topo = func.coalesce(
+            select(Cooperado.credito).where(Cooperado.id == bindparam('coop_id')).scalar_subquery(), 0)
+    # saldo depois de cada movimento = saldo do topo da página - soma dos mais novos que ele
+    saldo = topo - func.coalesce(func.sum(mov.c.valor).over(order_by=ordem, rows=(None, -1)), 0)
+    return (
+        select(mov, saldo.label('saldo'), topo.label('saldo_topo'),
+               Estabelecimento.nome.label('estabelecimento_nome'))
+        .outerjoin(Estabelecimento, Estabelecimento.id == mov.c.estabelecimento_id)
+        .order_by(*ordem)
+        .limit(bindparam('n'))
+    )
+
+
+_SQL_EXTRATO = {c: _sql_extrato(c) for c in (False, True)}
+
+
+def _serializador_extrato():
+    return URLSafeSerializer(app.secret_key, salt='coopex-extrato-v1')
+
+
+def _ler_cursor_extrato(cursor: str, coop_id: int) -> dict:
+    """Posição e saldo guardados no cursor; BadSignature se inválido ou de outro cooperado."""
+    try:
+        c_coop, c_data, c_k, c_id, saldo = _serializador_extrato().loads(cursor)
+        params = {'c_data': datetime.fromisoformat(c_data), 'c_k': int(c_k), 'c_id': int(c_id),
+                  'saldo': float(saldo)}
+    except (ValueError, TypeError) as e:
+        raise BadSignature('cursor malformado') from e
+    if c_coop != coop_id:
+        raise BadSignature('cursor de outro cooperado')
+    return params
+
+
+def extrato_cooperado(coop: Cooperado, limite: int, cursor: str | None = None) -> dict:
+    """Uma página do extrato. O cursor (assinado) guarda a posição e o saldo
+    em que a página anterior parou, então as páginas seguintes não dependem
+    de movimentos novos que entrem no meio da navegação."""
+    params = {'coop_id': coop.id, 'n': limite + 1}
+    if cursor:
+        params.update(_ler_cursor_extrato(cursor, coop.id))
+
+    rows = db.session.execute(_SQL_EXTRATO[bool(cursor)], params).all()
+    pagina, tem_mais = rows[:limite], len(rows) > limite
+    if rows:
+        saldo_topo = rows[0].saldo_topo
+    else:
+        saldo_topo = params['saldo'] if cursor else float(coop.credito or 0)
+    proximo = None
+    if tem_mais:
+        u = pagina[-1]
+        proximo = _serializador_extrato().dumps(
+            [coop.id, u.data.isoformat(), u.k, u.id, u.saldo - u.valor])
+    return {
+        'saldo_topo': round(saldo_topo, 2),
+        'itens': [{
+            'tipo': _EXTRATO_TIPOS[r.k],
+            'id': r.id,
+            'data': to_brt(r.data).isoformat(timespec='seconds'),
+            'valor': round(r.valor, 2),
+            'saldo': round(r.saldo, 2),
+            'lancamento_id': r.lancamento_id,
+            'estabelecimento': r.estabelecimento_nome,
+            'os_numero': r.os_numero,
+            'detalhe': r.detalhe,
+        } for r in pagina],
+        'proximo_cursor': proximo,
+    }
+
+
+@app.get('/api/cooperado/extrato')
+@ler_da_replica
+def api_cooperado_extrato():
+    if is_cooperado():
+        coop_id = session.get('user_id')
+    elif is_admin():
+        coop_id = request.args.get('cooperado_id', type=int)
+        if not coop_id:
+            return jsonify({'ok': False, 'error': 'cooperado_id obrigatório'}), 400
+    else:
+        return jsonify({'ok': False, 'error': 'sem sessão'}), 403
+
+    coop = db.session.get(Cooperado, coop_id)
+    if not coop:
+        return jsonify({'ok': False, 'error': 'cooperado não encontrado'}), 404
+
+    limite = request.args.get('limite', 50, type=int)
+    limite = max(1, min(limite, _EXTRATO_LIMITE_MAX))
+    try:
+        pagina = extrato_cooperado(coop, limite, request.args.get('cursor') or None)
+    except BadSignature:
+        return jsonify({'ok': False, 'error': 'cursor inválido'}), 400
+    return jsonify({'ok': True, 'cooperado_id': coop.id, **pagina})
 
 
 @app.get('/api/cooperado/localizacao_status')
@@ -2442,9 +4902,7 @@ def api_cooperado_localizacao_status():
             'mensagem': 'Aguardando localização...'
         })
 
-    agora = datetime.utcnow()
-    delta = (agora - loc.atualizado_em).total_seconds()
-    online = delta <= 90
+    online = cooperado_online(coop.id, loc)
 
     return jsonify({
         'ok': True,
@@ -2459,11 +4917,1009 @@ def api_cooperado_localizacao_status():
     })
 
 
+# ========= PRESENÇA (online/offline) =========
+class Presenca:
+    """
+    Presença dos cooperados no worker: cada heartbeat empurra a expiração
+    para ts + ttl num heap; expirados() devolve quem passou do prazo em
+    O(k log n), sem varrer todo mundo. Consultas de um cooperado são O(1).
+    """
+
+    def __init__(self, ttl_s: int):
+        self.ttl = ttl_s
+        self._lock = threading.Lock()
+        self._expira: dict[int, float] = {}     # id -> epoch de expiração
+        self._heap: list[tuple[float, int]] = []
+        self._saidas: set[int] = set()          # logouts a gravar
+
+    def heartbeat(self, coop_id: int, ts: float | None = None):
+        expira = (ts if ts is not None else time.time()) + self.ttl
+        if expira <= time.time():
+            return
+        with self._lock:
+            if expira > self._expira.get(coop_id, 0.0):
+                self._expira[coop_id] = expira
+                heapq.heappush(self._heap, (expira, coop_id))
+            self._saidas.discard(coop_id)
+
+    def desconectar(self, coop_id: int):
+        with self._lock:
+            self._expira.pop(coop_id, None)
+            self._saidas.add(coop_id)
+
+    def online(self, coop_id: int) -> bool | None:
+        """True/False se este worker sabe; None se nunca recebeu heartbeat dele."""
+        expira = self._expira.get(coop_id)
+        if expira is not None:
+            return expira > time.time()
+        if coop_id in self._saidas:
+            return False
+        return None
+
+    def online_ids(self) -> set[int]:
+        agora = time.time()
+        return {cid for cid, exp in list(self._expira.items()) if exp > agora}
+
+    def expirados(self, agora: float | None = None) -> list[int]:
+        agora = agora if agora is not None else time.time()
+        saida = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= agora:
+                expira, cid = heapq.heappop(self._heap)
+                # entradas antigas do heap (heartbeat mais novo já empurrou) são ignoradas
+                if self._expira.get(cid) == expira:
+                    del self._expira[cid]
+                    saida.append(cid)
+        return saida
+
+    def drenar_saidas(self) -> list[int]:
+        with self._lock:
+            saidas = list(self._saidas)
+            self._saidas.clear()
+        return saidas
+
+
+_PRESENCA = Presenca(app.config['PRESENCA_TTL_S'])
+_PRESENCA_ESTADO = {'ultima_global': 0.0}
+
+
+def _registrar_heartbeats(linhas: list[dict]):
+    for linha in linhas:
+        _PRESENCA.heartbeat(linha['cooperado_id'], _epoch_utc(linha['atualizado_em']))
+    _garantir_thread_fundo('presenca', app.config['PRESENCA_SWEEP_S'], _varrer_presenca)
+
+
+def _varrer_presenca():
+    """
+    Marca offline, em lote, quem expirou neste worker e quem fez logout.
+    O filtro por atualizado_em evita desligar quem mandou heartbeat para
+    outro worker. De tempos em tempos faz também uma varredura global
+    (órfãos de workers reiniciados), usando o índice de online.
+    """
+    t = LocalizacaoCooperado.__table__
+    agora_ts = time.time()
+    corte = datetime.utcnow() - timedelta(seconds=_PRESENCA.ttl)
+
+    expirados = _PRESENCA.expirados(agora_ts)
+    saidas = _PRESENCA.drenar_saidas()
+    global_ = agora_ts - _PRESENCA_ESTADO['ultima_global'] >= app.config['PRESENCA_SWEEP_GLOBAL_S']
+    if not (expirados or saidas or global_):
+        return
+
+    with db.engine.begin() as conn:
+        if expirados:
+            conn.execute(
+                t.update()
+                .where(t.c.cooperado_id.in_(expirados), t.c.online.is_(True), t.c.atualizado_em < corte)
+                .values(online=False, gravado_em=datetime.utcnow())
+            )
+        if saidas:
+            conn.execute(
+                t.update()
+                .where(t.c.cooperado_id.in_(saidas), t.c.online.is_(True))
+                .values(online=False, gravado_em=datetime.utcnow())
+            )
+        if global_:
+            conn.execute(
+                t.update()
+                .where(t.c.online.is_(True), t.c.atualizado_em < corte)
+                .values(online=False, gravado_em=datetime.utcnow())
+            )
+    if global_:
+        _PRESENCA_ESTADO['ultima_global'] = agora_ts
+
+
+def cooperado_online(coop_id: int, loc: "LocalizacaoCooperado | None" = None) -> bool:
+    """Presença do worker (O(1)); se ele não conhece o cooperado, vale a coluna online."""
+    estado = _PRESENCA.online(coop_id)
+    if estado is not None:
+        return estado
+    if loc is None:
+        loc = LocalizacaoCooperado.query.filter_by(cooperado_id=coop_id).first()
+    return bool(loc and loc.online)
+
+
+def cooperados_online_ids() -> list[int]:
+    """Quem está online em todos os workers (consulta pelo índice de online)."""
+    t = LocalizacaoCooperado.__table__
+    return list(db.session.execute(select(t.c.cooperado_id).where(t.c.online.is_(True))).scalars())
+
+
+# ========= ÍNDICE ESPACIAL (memória, por worker) =========
+_RAIO_TERRA_M = 6371008.8
+_METROS_POR_GRAU_LAT = 110574.0
+
+
+def _distancia_m(lat1, lng1, lat2, lng2) -> float:
+    """Distância haversine em metros."""
+    p1 = math.radians(lat1)
+    p2 = math.radians(lat2)
+    dp = p2 - p1
+    dl = math.radians(lng2 - lng1)
+    a = math.sin(dp / 2) ** 2 + math.cos(p1) * math.cos(p2) * math.sin(dl / 2) ** 2
+    return 2 * _RAIO_TERRA_M * math.asin(min(1.0, math.sqrt(a)))
+
+
+class IndiceEspacial:
+    """
+    Grade regular de células lat/lng com a posição mais recente de cada
+    cooperado. nearest() expande anéis de células a partir do ponto até ter
+    k candidatos mais próximos que qualquer célula ainda não visitada.
+    """
+
+    def __init__(self, celula_graus: float = 0.01):
+        self.celula = float(celula_graus)
+        self._lock = threading.RLock()
+        self._pos: dict[int, tuple] = {}          # id -> (lat, lng, ts_epoch, speed, celula, seq)
+        self._grade: dict[tuple, set] = {}        # celula -> {ids}
+        self._removidos: dict[int, float] = {}    # id -> ts_epoch da última posição antes de sair
+        self._seq = 0                             # versão do índice (cresce a cada atualização)
+
+    def _celula_de(self, lat, lng) -> tuple:
+        return (math.floor(lat / self.celula), math.floor(lng / self.celula))
+
+    def atualizar(self, coop_id: int, lat: float, lng: float, ts: float, speed: float = 0.0) -> bool:
+        """Grava a posição se for mais nova que a atual. Retorna True se gravou.
+        A mesma posição relida do banco (mesmo ts) não muda o seq, senão o
+        delta da frota devolveria todo mundo a cada sincronização."""
+        cel = self._celula_de(lat, lng)
+        with self._lock:
+            atual = self._pos.get(coop_id)
+            if atual is None:
+                removido = self._removidos.get(coop_id)
+                if removido is not None:
+                    if ts <= removido:
+                        return False    # a linha antiga do banco não traz de volta quem saiu
+                    del self._removidos[coop_id]
+            else:
+                if ts <= atual[2]:
+                    return False
+                if atual[4] != cel:
+                    ids = self._grade.get(atual[4])
+                    if ids is not None:
+                        ids.discard(coop_id)
+                        if not ids:
+                            del self._grade[atual[4]]
+            self._seq += 1
+            self._pos[coop_id] = (lat, lng, ts, speed, cel, self._seq)
+            self._grade.setdefault(cel, set()).add(coop_id)
+        return True
+
+    def remover(self, coop_id: int, ate: float | None = None):
+        """Tira o cooperado; com ate, só se a posição no índice não for mais nova."""
+        with self._lock:
+            atual = self._pos.get(coop_id)
+            if atual is None or (ate is not None and atual[2] > ate):
+                return
+            del self._pos[coop_id]
+            ids = self._grade.get(atual[4])
+            if ids is not None:
+                ids.discard(coop_id)
+                if not ids:
+                    del self._grade[atual[4]]
+            self._seq += 1
+            self._removidos[coop_id] = atual[2]
+
+    def posicao(self, coop_id: int):
+        atual = self._pos.get(coop_id)
+        return atual[:4] if atual else None
+
+    def __len__(self):
+        return len(self._pos)
+
+    @property
+    def seq(self) -> int:
+        return self._seq
+
+    def entradas(self, desde_seq: int = 0) -> tuple[int, list[tuple]]:
+        """(seq atual, [(id, lat, lng, ts, speed, seq)]) das entradas alteradas depois de desde_seq."""
+        with self._lock:
+            saida = [
+                (cid, p[0], p[1], p[2], p[3], p[5])
+                for cid, p in self._pos.items() if p[5] > desde_seq
+            ]
+            return self._seq, saida
+
+    def _candidatos(self, cels, lat, lng, ts_min, saida: list):
+        for cel in cels:
+            for cid in self._grade.get(cel, ()):
+                p = self._pos[cid]
+                if ts_min is not None and p[2] < ts_min:
+                    continue
+                saida.append((_distancia_m(lat, lng, p[0], p[1]), cid, p[0], p[1], p[2], p[3]))
+
+    def nearest(self, lat: float, lng: float, k: int = 10, max_age: float | None = None,
+                agora: float | None = None) -> list[dict]:
+        """Os k cooperados mais próximos (com posição mais nova que max_age segundos)."""
+        ts_min = None
+        if max_age is not None:
+            ts_min = (agora if agora is not None else time.time()) - max_age
+        ci, cj = self._celula_de(lat, lng)
+        achados: list[tuple] = []
+        with self._lock:
+            n_celulas = len(self._grade)
+            r = 0
+            while True:
+                if (2 * r + 1) ** 2 > 4 * n_celulas:
+                    # o anel já cobre mais células que as ocupadas: varre só as ocupadas
+                    achados = []
+                    self._candidatos(list(self._grade.keys()), lat, lng, ts_min, achados)
+                    break
+                if r == 0:
+                    anel = [(ci, cj)]
+                else:
+                    anel = [(ci + di, cj + dj)
+                            for di in range(-r, r + 1)
+                            for dj in (-r, r)]
+                    anel += [(ci + di, cj + dj)
+                             for di in (-r, r)
+                             for dj in range(-r + 1, r)]
+                self._candidatos(anel, lat, lng, ts_min, achados)
+                if len(achados) >= k:
+                    # qualquer ponto fora dos anéis visitados está a pelo menos r células
+                    lat_lim = min(abs(lat) + (r + 1) * self.celula, 89.9)
+                    alcance = r * self.celula * min(
+                        _METROS_POR_GRAU_LAT,
+                        111320.0 * math.cos(math.radians(lat_lim)),
+                    )
+                    achados.sort()
+                    if achados[k - 1][0] <= alcance:
+                        break
+                r += 1
+        achados.sort()
+        return [
+            {'cooperado_id': cid, 'distancia_m': round(d, 1), 'latitude': la,
+             'longitude': ln, 'ts': ts, 'speed': sp}
+            for d, cid, la, ln, ts, sp in achados[:k]
+        ]
+
+    def bbox(self, lat_min: float, lng_min: float, lat_max: float, lng_max: float,
+             max_age: float | None = None, agora: float | None = None) -> list[dict]:
+        """Cooperados dentro do retângulo (lat_min, lng_min) - (lat_max, lng_max)."""
+        ts_min = None
+        if max_age is not None:
+            ts_min = (agora if agora is not None else time.time()) - max_age
+        c0 = self._celula_de(lat_min, lng_min)
+        c1 = self._celula_de(lat_max, lng_max)
+        saida = []
+        with self._lock:
+            n_cels = (c1[0] - c0[0] + 1) * (c1[1] - c0[1] + 1)
+            if n_cels > len(self._grade):
+                cels = list(self._grade.keys())
+            else:
+                cels = [(i, j) for i in range(c0[0], c1[0] + 1) for j in range(c0[1], c1[1] + 1)]
+            for cel in cels:
+                for cid in self._grade.get(cel, ()):
+                    la, ln, ts, sp = self._pos[cid][:4]
+                    if ts_min is not None and ts < ts_min:
+                        continue
+                    if lat_min <= la <= lat_max and lng_min <= ln <= lng_max:
+                        saida.append({'cooperado_id': cid, 'latitude': la, 'longitude': ln,
+                                      'ts': ts, 'speed': sp})
+        return saida
+
+
+_INDICE_GEO = IndiceEspacial(app.config['GEO_CELULA_GRAUS'])
+_INDICE_GEO_ESTADO = {'pid': None, 'sincronizado_em': None}
+_INDICE_GEO_LOCK = threading.Lock()
+# gravado_em é carimbado antes do commit: uma escrita ainda aberta durante a
+# leitura anterior entra na próxima por esta margem
+_INDICE_GEO_MARGEM = timedelta(seconds=10)
+
+
+def _sincronizar_indice_espacial(completo: bool = False):
+    """
+    Traz para o índice as posições gravadas na tabela (inclusive por outros
+    workers). completo=True reconstrói a partir da tabela inteira; senão lê só
+    o que foi gravado desde a última sincronização (índice em gravado_em, o
+    relógio do servidor: um lote atrasado do app tem atualizado_em antigo).
+    """
+    t = LocalizacaoCooperado.__table__
+    inicio = datetime.utcnow()
+    desde = _INDICE_GEO_ESTADO['sincronizado_em']
+    q = (
+        select(t.c.cooperado_id, t.c.latitude, t.c.longitude, t.c.speed, t.c.atualizado_em, t.c.online)
+        .where(t.c.latitude.isnot(None), t.c.longitude.isnot(None), t.c.atualizado_em.isnot(None))
+    )
+    if not completo and desde is not None:
+        q = q.where(t.c.gravado_em > desde - _INDICE_GEO_MARGEM)
+    with db.engine.connect() as conn:
+        for cid, lat, lng, speed, em, online in conn.execute(q):
+            if online:
+                _INDICE_GEO.atualizar(cid, lat, lng, _epoch_utc(em), speed or 0.0)
+            else:
+                # logout/expiração gravados por qualquer worker
+                _INDICE_GEO.remover(cid, _epoch_utc(em))
+    _INDICE_GEO_ESTADO['sincronizado_em'] = inicio
+
+
+def indice_espacial() -> IndiceEspacial:
+    """Índice do worker; na 1ª chamada do processo reconstrói a partir da tabela."""
+    pid = os.getpid()
+    if _INDICE_GEO_ESTADO['pid'] != pid:
+        with _INDICE_GEO_LOCK:
+            if _INDICE_GEO_ESTADO['pid'] != pid:
+                _INDICE_GEO_ESTADO['sincronizado_em'] = None
+                _sincronizar_indice_espacial(completo=True)
+                _INDICE_GEO_ESTADO['pid'] = pid
+    _garantir_thread_fundo('geo_sync', app.config['GEO_SYNC_S'], _sincronizar_indice_espacial)
+    return _INDICE_GEO
+
+
+def _alimentar_indice_espacial(linhas: list[dict]):
+    for linha in linhas:
+        _INDICE_GEO.atualizar(
+            linha['cooperado_id'], linha['latitude'], linha['longitude'],
+            _epoch_utc(linha['atualizado_em']), linha['speed'],
+        )
+
+
+def _coop_nomes(ids) -> dict:
+    if not ids:
+        return {}
+    rows = db.session.query(Cooperado.id, Cooperado.nome).filter(Cooperado.id.in_(list(ids))).all()
+    return {cid: nome for cid, nome in rows}
+
+
+@app.get('/api/admin/cooperados/proximos')
+def api_admin_cooperados_proximos():
+    """?lat=&lng=&k=10&max_age=90 -> cooperados mais próximos com posição recente."""
+    if not is_admin():
+        return jsonify({'ok': False, 'error': 'sem permissão'}), 403
+    lat = request.args.get('lat', type=float)
+    lng = request.args.get('lng', type=float)
+    if lat is None or lng is None:
+        return jsonify({'ok': False, 'error': 'lat/lng obrigatórios'}), 400
+    k = max(1, min(request.args.get('k', 10, type=int), 100))
+    max_age = request.args.get('max_age', 90, type=float)
+
+    itens = indice_espacial().nearest(lat, lng, k=k, max_age=max_age or None)
+    nomes = _coop_nomes(i['cooperado_id'] for i in itens)
+    for i in itens:
+        i['nome'] = nomes.get(i['cooperado_id'], '')
+    return jsonify({'ok': True, 'itens': itens})
+
+
+@app.get('/api/admin/cooperados/area')
+def api_admin_cooperados_area():
+    """?lat_min=&lng_min=&lat_max=&lng_max=&max_age=90 -> cooperados no retângulo."""
+    if not is_admin():
+        return jsonify({'ok': False, 'error': 'sem permissão'}), 403
+    try:
+        lat_min, lng_min, lat_max, lng_max = (
+            float(request.args[c]) for c in ('lat_min', 'lng_min', 'lat_max', 'lng_max')
+        )
+    except (KeyError, ValueError):
+        return jsonify({'ok': False, 'error': 'lat_min/lng_min/lat_max/lng_max obrigatórios'}), 400
+    max_age = request.args.get('max_age', 90, type=float)
+
+    itens = indice_espacial().bbox(lat_min, lng_min, lat_max, lng_max, max_age=max_age or None)
+    nomes = _coop_nomes(i['cooperado_id'] for i in itens)
+    for i in itens:
+        i['nome'] = nomes.get(i['cooperado_id'], '')
+    return jsonify({'ok': True, 'itens': itens})
+
+
+# ========= MAPA DA FROTA (admin) =========
+def _cursor_frota(marca: datetime, agora: float) -> str:
+    return f"{int(_epoch_utc(marca) * 1000)}.{int(agora * 1000)}"
+
+
+def _ler_cursor_frota(cursor: str | None):
+    """
+    (marca de gravado_em, epoch do poll) do cursor; None se não veio ou é
+    inválido (manda tudo). A marca é do banco, então vale em qualquer worker.
+    """
+    if not cursor:
+        return None
+    try:
+        marca_ms, t_ms = cursor.split('.')
+        marca = datetime.fromtimestamp(int(marca_ms) / 1000.0, tz=UTC).replace(tzinfo=None)
+        return marca, int(t_ms) / 1000.0
+    except (ValueError, OverflowError, OSError):
+        return None
+
+
+_LOC_TABELA = LocalizacaoCooperado.__table__
+# delta da frota: o que foi gravado (posição nova, logout, expiração marcada) depois da marca
+_SQL_FROTA_GRAVADOS = select(
+    _LOC_TABELA.c.cooperado_id, _LOC_TABELA.c.latitude, _LOC_TABELA.c.longitude, _LOC_TABELA.c.speed, _LOC_TABELA.c.atualizado_em, _LOC_TABELA.c.online,
+).where(
+    _LOC_TABELA.c.gravado_em > bindparam('desde', type_=db.DateTime),
+    _LOC_TABELA.c.latitude.isnot(None), _LOC_TABELA.c.longitude.isnot(None), _LOC_TABELA.c.atualizado_em.isnot(None),
+)
+# ... e quem passou do TTL entre os dois polls sem nenhuma escrita nova
+_SQL_FROTA_EXPIRADOS = select(_LOC_TABELA.c.cooperado_id).where(
+    _LOC_TABELA.c.atualizado_em >= bindparam('corte_anterior', type_=db.DateTime),
+    _LOC_TABELA.c.atualizado_em < bindparam('corte', type_=db.DateTime),
+)
+
+
+def _frota_binaria(ids, lats, lngs, spds, tss, off) -> bytes:
+    """
+    Formato binário (little-endian):
+    'CPXF' | u8 versão=1 | u32 n | i32 ids[n] | f32 lat[n] | f32 lng[n] |
+    f32 speed[n] | u32 ts[n] | u32 n_off | i32 off[n_off]
+    """
+    partes = [b'CPXF', struct.pack('<BI', 1, len(ids))]
+    for tipo, valores in (('i', ids), ('f', lats), ('f', lngs), ('f', spds), ('I', tss)):
+        arr = array(tipo, valores)
+        if sys.byteorder != 'little':
+            arr.byteswap()
+        partes.append(arr.tobytes())
+    arr_off = array('i', off)
+    if sys.byteorder != 'little':
+        arr_off.byteswap()
+    partes.append(struct.pack('<I', len(off)))
+    partes.append(arr_off.tobytes())
+    return b''.join(partes)
+
+
+@app.get('/api/admin/frota')
+def api_admin_frota():
+    """
+    Posições de todos os cooperados online em colunas:
+    {"cursor", "completo", "ttl", "ids": [], "lat": [], "lng": [], "spd": [], "ts": [], "off": []}
+    Passe ?since=<cursor da resposta anterior> para receber só quem se mexeu
+    (e em "off" quem ficou offline ou saiu) desde o último poll. ?formato=bin
+    devolve o mesmo conteúdo em binário (cursor no header X-Frota-Cursor).
+    A foto completa vem do índice espacial do worker; o delta lê do banco só
+    as linhas gravadas depois do cursor (índice em gravado_em), então o poll
+    seguinte pode cair em qualquer worker.
+    """
+    if not is_admin():
+        return jsonify({'ok': False, 'error': 'sem permissão'}), 403
+
+    ttl = _PRESENCA.ttl
+    agora = time.time()
+    corte = agora - ttl
+
+    anterior = _ler_cursor_frota(request.args.get('since'))
+    ids, lats, lngs, spds, tss, off = [], [], [], [], [], []
+
+    def incluir(cid, la, ln, sp, ts):
+        ids.append(cid)
+        lats.append(round(la, 5))
+        lngs.append(round(ln, 5))
+        spds.append(round(sp or 0.0, 1))
+        tss.append(int(ts))
+
+    if anterior:
+        marca_anterior, poll_anterior = anterior
+        marca = datetime.utcnow()
+        vistos = set()
+        rows = db.session.execute(_SQL_FROTA_GRAVADOS, {'desde': marca_anterior - _INDICE_GEO_MARGEM})
+        for cid, la, ln, sp, em, online in rows:
+            vistos.add(cid)
+            ts = _epoch_utc(em)
+            if online and ts >= corte:
+                incluir(cid, la, ln, sp, ts)
+            else:
+                off.append(cid)
+        expirados = db.session.execute(_SQL_FROTA_EXPIRADOS, {
+            'corte_anterior': datetime.fromtimestamp(poll_anterior - ttl, tz=UTC).replace(tzinfo=None),
+            'corte': datetime.fromtimestamp(corte, tz=UTC).replace(tzinfo=None),
+        }).scalars()
+        off.extend(cid for cid in expirados if cid not in vistos)
+    else:
+        idx = indice_espacial()
+        # o que for gravado depois da última sincronização do índice vem no próximo delta
+        marca = _INDICE_GEO_ESTADO['sincronizado_em'] or datetime.utcnow()
+        _, entradas = idx.entradas(0)
+        for cid, la, ln, ts, sp, _ in entradas:
+            if ts >= corte:
+                incluir(cid, la, ln, sp, ts)
+
+    cursor = _cursor_frota(marca, agora)
+
+    if request.args.get('formato') == 'bin':
+        resp = Response(_frota_binaria(ids, lats, lngs, spds, tss, off), mimetype='application/octet-stream')
+        resp.headers['X-Frota-Cursor'] = cursor
+        resp.headers['X-Frota-Completo'] = '0' if anterior else '1'
+        resp.headers['X-Frota-TTL'] = str(ttl)
+    else:
+        payload = {
+            'ok': True,
+            'cursor': cursor,
+            'completo': not anterior,
+            'ttl': ttl,
+            'ids': ids, 'lat': lats, 'lng': lngs, 'spd': spds, 'ts': tss,
+            'off': off,
+        }
+        if not anterior or request.args.get('nomes') == '1':
+            nomes = _coop_nomes(ids)
+            payload['nomes'] = {str(cid): nomes.get(cid, '') for cid in ids}
+        resp = jsonify(payload)
+
+    resp.headers['Cache-Control'] = 'no-store, no-cache, must-revalidate, max-age=0'
+    return resp
+
+
+# ========= HISTÓRICO DE LOCALIZAÇÃO: MANUTENÇÃO E ROTA =========
+def _expr_minuto_historico() -> str:
+    if db.engine.dialect.name == 'postgresql':
+        return "date_trunc('minute', registrado_em)"
+    return "strftime('%Y-%m-%d %H:%M', registrado_em)"
+
+
+def manutencao_historico(agora: datetime | None = None, dias_reprocessar: int = 2) -> dict:
+    """
+    Aplica a retenção do histórico de localização:
+    - até LOC_HIST_DIAS_COMPLETO dias: resolução total (não mexe);
+    - até LOC_HIST_DIAS_RETENCAO dias: mantém só o 1º ponto de cada minuto;
+    - mais antigo: apaga (DROP da partição diária no Postgres).
+    Rodar 1x por dia. dias_reprocessar define quantos dias, a partir do limite
+    de resolução total, são reduzidos a cada rodada (aumente para recuperar
+    dias em que o job não rodou).
+    """
+    agora = agora or datetime.utcnow()
+    hoje = agora.date()
+    limite_completo = hoje - timedelta(days=app.config['LOC_HIST_DIAS_COMPLETO'])
+    limite_retencao = hoje - timedelta(days=app.config['LOC_HIST_DIAS_RETENCAO'])
+    dialeto = db.engine.dialect.name
+    resultado = {'reduzidos': 0, 'apagados': 0, 'particoes_removidas': []}
+
+    with db.engine.begin() as conn:
+        # 1) Retenção: remove o que passou do limite
+        if dialeto == 'postgresql':
+            particoes = conn.execute(text(
+                "SELECT c.relname FROM pg_inherits i "
+                "JOIN pg_class c ON c.oid = i.inhrelid "
+                "JOIN pg_class p ON p.oid = i.inhparent "
+                "WHERE p.relname = 'localizacao_historico'"
+            )).scalars().all()
+            for nome in particoes:
+                try:
+                    dia = datetime.strptime(nome.rsplit('_p', 1)[1], '%Y%m%d').date()
+                except (IndexError, ValueError):
+                    continue
+                if dia < limite_retencao:
+                    conn.execute(text(f"DROP TABLE IF EXISTS {nome}"))
+                    resultado['particoes_removidas'].append(nome)
+        else:
+            res = conn.execute(
+                text("DELETE FROM localizacao_historico WHERE registrado_em < :lim"),
+                {'lim': datetime(limite_retencao.year, limite_retencao.month, limite_retencao.day)}
+            )
+            resultado['apagados'] = res.rowcount or 0
+
+        # 2) Downsampling: 1 ponto por minuto nos dias que saíram da resolução total
+        minuto = _expr_minuto_historico()
+        for i in range(dias_reprocessar, 0, -1):
+            dia = limite_completo - timedelta(days=i)
+            if dia < limite_retencao:
+                continue
+            ini = datetime(dia.year, dia.month, dia.day)
+            fim = ini + timedelta(days=1)
+            res = conn.execute(text(
+                "DELETE FROM localizacao_historico "
+                "WHERE registrado_em >= :ini AND registrado_em < :fim "
+                "AND (cooperado_id, registrado_em) IN ("
+                "  SELECT cooperado_id, registrado_em FROM ("
+                "    SELECT cooperado_id, registrado_em, "
+                f"          row_number() OVER (PARTITION BY cooperado_id, {minuto} "
+                "                             ORDER BY registrado_em) AS rn "
+                "    FROM localizacao_historico "
+                "    WHERE registrado_em >= :ini AND registrado_em < :fim"
+                "  ) x WHERE x.rn > 1"
+                ")"
+            ), {'ini': ini, 'fim': fim})
+            resultado['reduzidos'] += res.rowcount or 0
+
+    _garantir_particoes_historico()
+    return resultado
+
+
+@app.cli.command('manutencao-historico')
+@click.option('--dias-reprocessar', default=2, show_default=True,
+              help='Quantos dias além do limite de resolução total reduzir para 1 ponto/min.')
+def manutencao_historico_cmd(dias_reprocessar):
+    """Downsampling e retenção do histórico de localização (rodar diariamente)."""
+    res = manutencao_historico(dias_reprocessar=dias_reprocessar)
+    click.echo(
+        f"reduzidos={res['reduzidos']} apagados={res['apagados']} "
+        f"particoes_removidas={','.join(res['particoes_removidas']) or '-'}"
+    )
+
+
+def _parse_datahora_local(s: str | None) -> datetime | None:
+    """
+    'YYYY-MM-DDTHH:MM[:SS]' ou 'YYYY-MM-DD' (horário de Brasília, como vem de
+    <input type=datetime-local>) ou ISO com fuso -> UTC naive.
+    """
+    if not s:
+        return None
+    try:
+        dt = datetime.fromisoformat(s.strip().replace('Z', '+00:00'))
+    except ValueError:
+        return None
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=BR_TZ)
+    return dt.astimezone(UTC).replace(tzinfo=None)
+
+
+@app.get('/api/admin/cooperados/<int:coop_id>/rota')
+def api_admin_cooperado_rota(coop_id):
+    """
+    Trajeto de um cooperado numa janela de tempo (ex.: durante uma OS).
+    ?inicio=2024-05-01T08:00&fim=2024-05-01T12:00 (Brasília) ou
+    ?lancamento_id=N[&margem_min=60] (janela em volta da data do lançamento).
+    Resposta compacta: pontos = [[epoch_s, lat, lng, speed], ...].
+    """
+    if not is_admin():
+        return jsonify({'ok': False, 'error': 'sem permissão'}), 403
+
+    inicio = _parse_datahora_local(request.args.get('inicio'))
+    fim = _parse_datahora_local(request.args.get('fim'))
+
+    lanc_id = request.args.get('lancamento_id', type=int)
+    if lanc_id:
+        l = Lancamento.query.get_or_404(lanc_id)
+        if l.cooperado_id != coop_id:
+            return jsonify({'ok': False, 'error': 'lançamento é de outro cooperado'}), 400
+        margem = timedelta(minutes=max(0, min(request.args.get('margem_min', 60, type=int), 1440)))
+        inicio, fim = l.data - margem, l.data + margem
+
+    if not inicio or not fim or fim <= inicio:
+        return jsonify({'ok': False, 'error': 'janela inválida (inicio/fim)'}), 400
+    if fim - inicio > timedelta(days=7):
+        return jsonify({'ok': False, 'error': 'janela máxima de 7 dias'}), 400
+
+    limite = max(1, min(request.args.get('limite', 5000, type=int), 20000))
+    h = LocalizacaoHistorico
+    rows = (
+        db.session.query(h.registrado_em, h.latitude, h.longitude, h.speed)
+        .filter(h.cooperado_id == coop_id, h.registrado_em >= inicio, h.registrado_em < fim)
+        .order_by(h.registrado_em)
+        .limit(limite)
+        .all()
+    )
+
+    pontos = [
+        [int(r.registrado_em.replace(tzinfo=UTC).timestamp()), r.latitude, r.longitude, r.speed or 0]
+        for r in rows
+    ]
+    return jsonify({
+        'ok': True,
+        'cooperado_id': coop_id,
+        'inicio': to_brt(inicio).isoformat(),
+        'fim': to_brt(fim).isoformat(),
+        'truncado': len(pontos) >= limite,
+        'pontos': pontos,
+    })
+
+
+# ========= DADOS SINTÉTICOS (carga / escala) =========
+# `flask --app app gerar-dados --escala media` popula o banco apontado por
+# DATABASE_URL (mesmo _build_db_uri do app) com volume de produção. Mesma
+# semente + mesma --referencia num banco vazio = mesmos dados.
+ESCALAS_DADOS = {
+    'pequena': dict(cooperados=500, estabelecimentos=20, lancamentos=50_000, itens_por_estab=250,
+                    stories_por_estab=25, views_por_story=40, pings=20_000),
+    'media': dict(cooperados=3_000, estabelecimentos=150, lancamentos=500_000, itens_por_estab=400,
+                  stories_por_estab=30, views_por_story=60, pings=300_000),
+    'grande': dict(cooperados=10_000, estabelecimentos=400, lancamentos=3_000_000, itens_por_estab=500,
+                   stories_por_estab=50, views_por_story=100, pings=2_000_000),
+}
+_LOTE_DADOS = 20_000
+_CENTRO_DADOS = (-23.5505, -46.6333)
+_NOMES_DADOS = ('Ana', 'Bruno', 'Carla', 'Diego', 'Eduarda', 'Felipe', 'Gabriela', 'Henrique', 'Isabela',
+                'João', 'Karina', 'Lucas', 'Mariana', 'Nicolas', 'Otávio', 'Paula', 'Rafael', 'Sofia',
+                'Thiago', 'Vitória', 'William', 'Yasmin')
+_SOBRENOMES_DADOS = ('Silva', 'Santos', 'Oliveira', 'Souza', 'Rodrigues', 'Ferreira', 'Alves', 'Pereira',
+                     'Lima', 'Gomes', 'Costa', 'Ribeiro', 'Martins', 'Carvalho', 'Almeida', 'Lopes')
+_RAMOS_DADOS = ('Auto Peças', 'Oficina', 'Posto', 'Borracharia', 'Lava Jato', 'Farmácia', 'Mercado',
+                'Restaurante', 'Elétrica', 'Motopeças')
+_PRODUTOS_DADOS = ('Óleo 5W30', 'Filtro de óleo', 'Pastilha de freio', 'Pneu aro 14', 'Bateria 60Ah',
+                   'Lâmpada H4', 'Palheta', 'Vela de ignição', 'Correia dentada', 'Amortecedor',
+                   'Fluido de freio', 'Aditivo radiador', 'Kit relação', 'Câmara de ar', 'Lavagem completa')
+_MARCAS_DADOS = ('Bosch', 'Mobil', 'Pirelli', 'Moura', 'NGK', 'Cofap', 'Tecfil', 'Philips', 'Shell', None)
+_CATEGORIAS_DADOS = ('Peças', 'Lubrificantes', 'Pneus', 'Elétrica', 'Serviços', None)
+# peso relativo das transações por hora local (Brasília) e por dia da semana (seg=0)
+_PESO_HORA_DADOS = (1, 1, 1, 1, 1, 2, 6, 14, 22, 26, 28, 32, 34, 30, 26, 24, 26, 30, 32, 26, 16, 8, 4, 2)
+_PESO_DIA_SEMANA_DADOS = (1.0, 1.0, 1.05, 1.1, 1.3, 1.15, 0.45)
+
+
+def token_app_sintetico(semente: int, cooperado_id: int) -> str:
+    """Token do app gerado para o cooperado sintético (previsível para benchmarks)."""
+    return hashlib.sha256(f'coopex-sint:{semente}:{cooperado_id}'.encode()).hexdigest()[:43]
+
+
+def _png_ruido(rnd: random.Random, lado: int) -> bytes:
+    """PNG RGB de ruído (não comprime): tamanho parecido com foto/logo real."""
+    def chunk(tipo, dados):
+        return struct.pack('>I', len(dados)) + tipo + dados + struct.pack('>I', zlib.crc32(tipo + dados))
+    linhas = b''.join(b'\x00' + rnd.randbytes(lado * 3) for _ in range(lado))
+    return (b'\x89PNG\r\n\x1a\n'
+            + chunk(b'IHDR', struct.pack('>IIBBBBB', lado, lado, 8, 2, 0, 0, 0))
+            + chunk(b'IDAT', zlib.compress(linhas, 1))
+            + chunk(b'IEND', b''))
+
+
+def _inserir_em_massa(conn, tabela, colunas: tuple, linhas: list) -> int:
+    """COPY no Postgres (psycopg 3), executemany em lote nos demais bancos."""
+    if not linhas:
+        return 0
+    if conn.dialect.name == 'postgresql':
+        with conn.connection.dbapi_connection.cursor() as cur:
+            with cur.copy(f"COPY {tabela.name} ({', '.join(colunas)}) FROM STDIN") as cp:
+                for linha in linhas:
+                    cp.write_row(linha)
+    elif conn.dialect.name == 'sqlite':
+        # direto no sqlite3: o processamento de parâmetros do SQLAlchemy custa mais que o INSERT.
+        # DateTime vai no mesmo formato texto que o SQLAlchemy grava.
+        datas = [i for i, c in enumerate(colunas) if isinstance(tabela.c[c].type, db.DateTime)]
+        if datas:
+            linhas = [list(linha) for linha in linhas]
+            for linha in linhas:
+                for i in datas:
+                    if linha[i] is not None:
+                        linha[i] = linha[i].isoformat(' ', 'microseconds')
+        conn.connection.dbapi_connection.executemany(
+            f"INSERT INTO {tabela.name} ({', '.join(colunas)}) VALUES ({', '.join('?' * len(colunas))})",
+            linhas,
+        )
+    else:
+        conn.execute(tabela.insert(), [dict(zip(colunas, linha)) for linha in linhas])
+    return len(linhas)
+
+
+def _ajustar_sequencias(*tabelas):
+    # ids explícitos no COPY não avançam o SERIAL
+    if db.engine.dialect.name != 'postgresql':
+        return
+    with db.engine.begin() as conn:
+        for t in tabelas:
+            conn.execute(text(
+                f"SELECT setval(pg_get_serial_sequence('{t.name}', 'id'), "
+                f"COALESCE((SELECT MAX(id) FROM {t.name}), 0) + 1, false)"
+            ))
+
+
+def gerar_dados(cooperados: int, estabelecimentos: int, lancamentos: int, itens_por_estab: int,
+                stories_por_estab: int, views_por_story: int, pings: int, semente: int = 42,
+                senha: str = 'senha123', referencia: datetime | None = None, dias: int = 365,
+                log=print) -> dict:
+    """
+    Gera cooperados (com foto e token do app), estabelecimentos (com logo e
+    catálogo), lançamentos com horário de Brasília realista e descontos
+    parciais, stories com views/curtidas e pings de localização. Os ids
+    continuam a partir do maior id existente. Devolve linhas por tabela.
+    """
+    rnd = random.Random(semente)
+    ref = (referencia or datetime.utcnow()).replace(microsecond=0)
+    t0 = time.perf_counter()
+    contagem = {}
+    hash_senha = gerar_hash_senha(senha)
+
+    def base(modelo):
+        return db.session.execute(select(func.coalesce(func.max(modelo.id), 0))).scalar()
+    b_coop, b_est, b_lanc, b_story = (base(m) for m in (Cooperado, Estabelecimento, Lancamento, StoryEstabelecimento))
+    db.session.commit()
+    ids_coop = range(b_coop + 1, b_coop + cooperados + 1)
+    ids_est = range(b_est + 1, b_est + estabelecimentos + 1)
+
+    def etapa(nome, tabela, colunas, gerador):
+        n = 0
+        lote = []
+        with db.engine.begin() as conn:
+            for linha in gerador:
+                lote.append(linha)
+                if len(lote) >= _LOTE_DADOS:
+                    n += _inserir_em_massa(conn, tabela, colunas, lote)
+                    lote = []
+            n += _inserir_em_massa(conn, tabela, colunas, lote)
+        contagem[nome] = contagem.get(nome, 0) + n
+        log(f"{nome}: {n} linhas ({time.perf_counter() - t0:.1f}s)")
+
+    fotos = [_png_ruido(rnd, 96) for _ in range(16)]
+    logos = [_png_ruido(rnd, 128) for _ in range(8)]
+
+    def gen_cooperados():
+        for cid in ids_coop:
+            com_foto = rnd.random() < 0.85
+            yield (
+                cid, f'{rnd.choice(_NOMES_DADOS)} {rnd.choice(_SOBRENOMES_DADOS)} {cid}', f'coop{cid}',
+                round(rnd.uniform(200, 5000), 2), ref - timedelta(days=rnd.randrange(60)),
+                rnd.choice(fotos) if com_foto else None, 'image/png' if com_foto else None,
+                f'coop{cid}.png' if com_foto else None, hash_senha, token_app_sintetico(semente, cid),
+            )
+    etapa('cooperado', Cooperado.__table__,
+          ('id', 'nome', 'username', 'credito', 'credito_atualizado_em', 'foto_data', 'foto_mimetype',
+           'foto_filename', 'senha_hash', 'app_token'),
+          gen_cooperados())
+
+    def gen_estabelecimentos():
+        for eid in ids_est:
+            yield (eid, f'{rnd.choice(_RAMOS_DADOS)} {rnd.choice(_SOBRENOMES_DADOS)} {eid}', f'est{eid}',
+                   hash_senha, rnd.choice(logos), 'image/png', f'logo{eid}.png')
+    etapa('estabelecimento', Estabelecimento.__table__,
+          ('id', 'nome', 'username', 'senha_hash', 'logo_data', 'logo_mimetype', 'logo_filename'),
+          gen_estabelecimentos())
+
+    def gen_itens():
+        for eid in ids_est:
+            n = max(1, int(rnd.gauss(itens_por_estab, itens_por_estab / 4)))
+            for i in range(n):
+                criado = ref - timedelta(days=rnd.randrange(365), seconds=rnd.randrange(86400))
+                yield (eid, f'{rnd.choice(_PRODUTOS_DADOS)} #{i}', rnd.choice(_MARCAS_DADOS),
+                       rnd.choice(_CATEGORIAS_DADOS), round(rnd.uniform(5, 900), 2), criado, criado)
+    etapa('catalogo_item', CatalogoItem.__table__,
+          ('estabelecimento_id', 'nome', 'marca', 'categoria', 'valor', 'criado_em', 'atualizado_em'),
+          gen_itens())
+
+    # Lançamentos em blocos, cada bloco seguido dos seus descontos (4 parcelas semanais,
+    # pagas conforme a idade do lançamento; ~10% ficam sem desconto nenhum).
+    hoje_local = ref.replace(tzinfo=UTC).astimezone(BR_TZ).date()
+    dias_l = [hoje_local - timedelta(days=i) for i in range(dias)]
+    cum_dias = list(itertools.accumulate(_PESO_DIA_SEMANA_DADOS[d.weekday()] for d in dias_l))
+    cum_horas = list(itertools.accumulate(_PESO_HORA_DADOS))
+    desloc = {d: BR_TZ.utcoffset(datetime(d.year, d.month, d.day, 12)) for d in dias_l}
+    col_lanc = ('id', 'data', 'os_numero', 'cooperado_id', 'estabelecimento_id', 'valor', 'descricao',
+                'parcelas_total', 'saldo_aberto', 'concluido')
+    col_desc = ('lancamento_id', 'cooperado_id', 'valor', 'criado_em', 'observacao')
+    n_lanc = n_desc = 0
+    for inicio in range(0, lancamentos, _LOTE_DADOS):
+        l_rows, d_rows = [], []
+        ids = range(b_lanc + 1 + inicio, b_lanc + 1 + min(inicio + _LOTE_DADOS, lancamentos))
+        sorteio_dias = rnd.choices(dias_l, cum_weights=cum_dias, k=len(ids))
+        sorteio_horas = rnd.choices(range(24), cum_weights=cum_horas, k=len(ids))
+        for lid, d, h in zip(ids, sorteio_dias, sorteio_horas):
+            # hora local de Brasília -> UTC naive
+            data = datetime(d.year, d.month, d.day, h, rnd.randrange(60), rnd.randrange(60)) - desloc[d]
+            if data > ref:   # horas de "hoje" que ainda não passaram
+                data -= timedelta(days=1)
+            valor = round(min(max(rnd.lognormvariate(4.2, 0.8), 5.0), 3000.0), 2)
+            idade_sem = (ref - data).days // 7
+            pagas = 0 if rnd.random() < 0.1 else min(4, max(0, idade_sem - rnd.randrange(2)))
+            parcela = round(valor / 4, 2)
+            pago = 0.0
+            parcelas = []
+            for k in range(pagas):
+                v = round(valor - 3 * parcela, 2) if k == 3 else parcela
+                pago += v
+                parcelas.append((v, data + timedelta(days=7 * (k + 1)), f'Parcela {k + 1}/4'))
+            coop = ids_coop[int(len(ids_coop) * rnd.random() ** 1.7)]
+            d_rows.extend((lid, coop, *parc) for parc in parcelas)
+            l_rows.append((
+                lid, data, f'{lid:07d}', coop,
+                ids_est[int(len(ids_est) * rnd.random() ** 1.3)], valor,
+                f'OS {lid}' if rnd.random() < 0.4 else None, 4, round(max(valor - pago, 0.0), 2), pagas == 4,
+            ))
+        with db.engine.begin() as conn:
+            n_lanc += _inserir_em_massa(conn, Lancamento.__table__, col_lanc, l_rows)
+            n_desc += _inserir_em_massa(conn, DescontoLancamento.__table__, col_desc, d_rows)
+        if (inicio // _LOTE_DADOS) % 25 == 0 or n_lanc == lancamentos:
+            log(f"lancamento: {n_lanc}/{lancamentos}, descontos: {n_desc} ({time.perf_counter() - t0:.1f}s)")
+    contagem['lancamento'], contagem['desconto_lancamento'] = n_lanc, n_desc
+
+    stories = []   # (id, criado_em, expira_em)
+
+    def gen_stories():
+        sid = b_story
+        for eid in ids_est:
+            for _ in range(stories_por_estab):
+                sid += 1
+                criado = ref - timedelta(days=rnd.randrange(90), seconds=rnd.randrange(86400))
+                expira = criado + timedelta(days=rnd.randint(1, 7))
+                video = rnd.random() < 0.15
+                stories.append((sid, criado, expira))
+                yield (sid, eid, 'video' if video else 'imagem', f'sint_{sid}.{"mp4" if video else "jpg"}',
+                       'video/mp4' if video else 'image/jpeg', f'Oferta {sid}', None, criado, expira,
+                       expira > ref and rnd.random() > 0.05)
+    etapa('story_estabelecimento', StoryEstabelecimento.__table__,
+          ('id', 'estabelecimento_id', 'tipo', 'filename', 'mimetype', 'titulo', 'legenda', 'criado_em',
+           'expira_em', 'ativo'),
+          gen_stories())
+
+    def gen_views():
+        for sid, criado, expira in stories:
+            k = min(len(ids_coop), max(0, int(rnd.gauss(views_por_story, views_por_story / 3))))
+            janela = max(60, int((min(expira, ref) - criado).total_seconds()))
+            for cid in rnd.sample(ids_coop, k):
+                yield (sid, cid, criado + timedelta(seconds=rnd.randrange(janela)), rnd.random() < 0.25)
+    etapa('story_view', StoryView.__table__, ('story_id', 'cooperado_id', 'viu_em', 'curtiu'), gen_views())
+
+    # Pings: ~30% da frota rodando nas últimas 48h (um ponto a cada 15-30 s);
+    # a posição atual de cada cooperado é o último ponto do seu trajeto.
+    frota = rnd.sample(ids_coop, max(1, len(ids_coop) * 3 // 10)) if pings else []
+    por_coop = pings // len(frota) if frota else 0
+    ultimo = {}
+
+    def gen_pings():
+        for cid in frota:
+            lat = _CENTRO_DADOS[0] + rnd.uniform(-0.15, 0.15)
+            lon = _CENTRO_DADOS[1] + rnd.uniform(-0.15, 0.15)
+            ts = ref - timedelta(seconds=rnd.randrange(3600, 48 * 3600))
+            for _ in range(por_coop):
+                vel = max(0.0, rnd.gauss(9, 5))
+                lat += rnd.gauss(0, 0.0006)
+                lon += rnd.gauss(0, 0.0006)
+                ts += timedelta(seconds=rnd.randint(15, 30))
+                yield (cid, ts, round(lat, 6), round(lon, 6), round(rnd.uniform(3, 25), 1), round(vel, 1))
+            ultimo[cid] = (lat, lon, ts)
+    if frota:
+        _garantir_particoes_historico(dias=[(ref - timedelta(days=i)).date() for i in range(-2, 4)])
+        etapa('localizacao_historico', LocalizacaoHistorico.__table__,
+              ('cooperado_id', 'registrado_em', 'latitude', 'longitude', 'accuracy', 'speed'), gen_pings())
+
+    def gen_localizacoes():
+        for cid in ids_coop:
+            lat, lon, ts = ultimo.get(cid) or (
+                _CENTRO_DADOS[0] + rnd.uniform(-0.2, 0.2), _CENTRO_DADOS[1] + rnd.uniform(-0.2, 0.2),
+                ref - timedelta(hours=rnd.randint(3, 24 * 30)))
+            yield (cid, round(lat, 6), round(lon, 6), round(rnd.uniform(3, 25), 1), 0.0, False, 'sintetico', ts,
+                   ts)
+    etapa('localizacao_cooperado', LocalizacaoCooperado.__table__,
+          ('cooperado_id', 'latitude', 'longitude', 'accuracy', 'speed', 'online', 'fonte', 'atualizado_em',
+           'gravado_em'),
+          gen_localizacoes())
+
+    _ajustar_sequencias(Cooperado.__table__, Estabelecimento.__table__, Lancamento.__table__,
+                        StoryEstabelecimento.__table__)
+    with db.engine.begin() as conn:
+        tocar_versoes_conteudo(conn, CHAVES_CONTEUDO)   # inserts diretos não passam pelo ORM
+        conn.execute(text('ANALYZE'))
+    log(f"Concluído em {time.perf_counter() - t0:.1f}s")
+    return contagem
+
+
+@app.cli.command('gerar-dados')
+@click.option('--escala', type=click.Choice(sorted(ESCALAS_DADOS)), default='pequena', show_default=True)
+@click.option('--semente', default=42, show_default=True)
+@click.option('--cooperados', type=int, help='Sobrescreve a escala.')
+@click.option('--estabelecimentos', type=int, help='Sobrescreve a escala.')
+@click.option('--lancamentos', type=int, help='Sobrescreve a escala.')
+@click.option('--pings', type=int, help='Sobrescreve a escala.')
+@click.option('--senha', default='senha123', show_default=True, help='Senha de todos os usuários gerados.')
+@click.option('--referencia', type=click.DateTime(['%Y-%m-%d']), help='Data "de hoje" dos dados (UTC).')
+@click.option('--anexar', is_flag=True, help='Permite gerar num banco que já tem cooperados.')
+@click.option('--sim', is_flag=True, help='Não pede confirmação.')
+def gerar_dados_cmd(escala, semente, cooperados, estabelecimentos, lancamentos, pings, senha, referencia,
+                    anexar, sim):
+    """Popula o banco com dados sintéticos (carga/escala). NUNCA use no banco de produção."""
+    params = dict(ESCALAS_DADOS[escala])
+    for nome, valor in (('cooperados', cooperados), ('estabelecimentos', estabelecimentos),
+                        ('lancamentos', lancamentos), ('pings', pings)):
+        if valor is not None:
+            params[nome] = valor
+    # sem DATABASE_URL o app cai no banco de produção (_build_db_uri): nada de migrar/popular lá
+    if not os.environ.get('DATABASE_URL'):
+        raise click.ClickException('Defina DATABASE_URL com um banco descartável (local ou de teste).')
+    click.echo(f"Banco: {db.engine.url.render_as_string(hide_password=True)}")
+    if not sim:
+        click.confirm(f"Migrar e gerar {params} com semente {semente} neste banco?", abort=True)
+    migrar(log=click.echo)
+    if not anexar and db.session.execute(select(func.count(Cooperado.id))).scalar():
+        raise click.ClickException('O banco já tem cooperados; use --anexar para somar os dados sintéticos.')
+    contagem = gerar_dados(semente=semente, senha=senha, referencia=referencia, log=click.echo, **params)
+    click.echo(' '.join(f"{k}={v}" for k, v in contagem.items()))
+
+
 # ========= CRIA BANCO + ADMIN MASTER =========
 def criar_banco_e_admin():
     with app.app_context():
-        db.create_all()
-        ensure_schema()
+        migrar()
         if not Admin.query.filter_by(username='coopex').first():
             admin = Admin(nome='Administrador Master', username='coopex')
             admin.set_senha('coopex05289')
@@ -2472,6 +5928,11 @@ def criar_banco_e_admin():
             print('Admin criado: coopex / coopex05289')
 
 
+# Por último: os templates só compilam depois de todos os filtros/globais registrados
+if app.config['TEMPLATES_PRECOMPILAR']:
+    precompilar_templates()
+
+
 # ========= MAIN =========
 if __name__ == '__main__':
     criar_banco_e_admin()
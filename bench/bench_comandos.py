@@ -0,0 +1,150 @@
+"""
+Microbenchmark dos caminhos quentes: versão antiga (query ORM montada a cada
+chamada / INSERT multi-VALUES) x comandos pré-montados do app. Mede CPU e
+latência por chamada no mesmo banco e com os mesmos dados.
+
+    python bench/bench_comandos.py                                   # SQLite temporário
+    DATABASE_URL=postgresql://... python bench/bench_comandos.py     # banco descartável!
+    DB_PREPARE_THRESHOLD=off DATABASE_URL=... python bench/bench_comandos.py   # sem prepare
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{tempfile.mkdtemp()}/comandos.db")
+os.environ.setdefault('AUTO_MIGRATE', '1')
+
+from sqlalchemy import func, select  # noqa: E402
+
+import app as coopex  # noqa: E402
+from app import Cooperado, Lancamento, LocalizacaoCooperado, StoryView, db  # noqa: E402
+
+SEMENTE = 7
+
+
+# ---- versões antigas (como estavam antes dos comandos pré-montados) ----
+def token_antigo(token):
+    return db.session.execute(select(Cooperado.id).where(Cooperado.app_token == token)).scalar()
+
+
+def token_novo(token):
+    return db.session.execute(coopex._SQL_COOP_POR_TOKEN, {'token': token}).scalar()
+
+
+def ultimo_id_antigo():
+    return db.session.query(func.max(Lancamento.id)).scalar()
+
+
+def ultimo_id_novo():
+    return db.session.execute(coopex._SQL_ULTIMO_LANCAMENTO).scalar()
+
+
+def lista_estab_antiga(est_id):
+    rows = Lancamento.query.filter_by(estabelecimento_id=est_id).order_by(Lancamento.data.desc()).all()
+    return [(l.id, l.cooperado.nome) for l in rows]
+
+
+def lista_estab_nova(est_id):
+    rows = db.session.execute(coopex._SQL_LANCAMENTOS_ESTAB[(False, False)], {'est_id': est_id}).all()
+    return [(r.id, r.cooperado_nome) for r in rows]
+
+
+def story_view_antiga(story_id, coop_id):
+    sv = StoryView.query.filter_by(story_id=story_id, cooperado_id=coop_id).first()
+    if not sv:
+        sv = StoryView(story_id=story_id, cooperado_id=coop_id, viu_em=datetime.utcnow())
+        db.session.add(sv)
+    else:
+        sv.viu_em = datetime.utcnow()
+    db.session.commit()
+    StoryView.query.filter_by(story_id=story_id).count()
+    StoryView.query.filter_by(story_id=story_id, curtiu=True).count()
+
+
+def story_view_nova(story_id, coop_id):
+    upsert = coopex._comando_dialeto(
+        'upsert_story_view', lambda d: coopex._construir_upsert_story_view(d, com_curtida=False))
+    db.session.execute(upsert, {'story_id': story_id, 'cooperado_id': coop_id,
+                                'viu_em': datetime.utcnow(), 'curtiu': False}).scalar()
+    db.session.commit()
+    db.session.execute(coopex._SQL_STORY_STATS, {'story_id': story_id}).one()
+
+
+def upsert_loc_antigo(linhas):
+    tabela = LocalizacaoCooperado.__table__
+    dialect_insert = coopex._insert_dialeto(db.engine.dialect.name)
+    stmt = dialect_insert(tabela).values(linhas)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=[tabela.c.cooperado_id],
+        set_={c: stmt.excluded[c] for c in ('latitude', 'longitude', 'accuracy', 'speed', 'online',
+                                             'fonte', 'atualizado_em')},
+        where=(tabela.c.atualizado_em.is_(None) | (stmt.excluded.atualizado_em >= tabela.c.atualizado_em)),
+    )
+    with db.engine.begin() as conn:
+        conn.execute(stmt)
+
+
+def upsert_loc_novo(linhas):
+    coopex._upsert_localizacoes(linhas)
+
+
+def medir(fn, gerar_args, n):
+    for _ in range(min(20, n)):
+        fn(*gerar_args())
+    tempos = []
+    cpu0 = time.process_time()
+    for _ in range(n):
+        args = gerar_args()
+        t0 = time.perf_counter()
+        fn(*args)
+        tempos.append((time.perf_counter() - t0) * 1e6)
+        db.session.remove()
+    cpu = (time.process_time() - cpu0) / n * 1e6
+    return statistics.median(tempos), cpu
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('-n', type=int, default=2000, help='chamadas por caso (lista: n/40)')
+    args = ap.parse_args()
+    rnd = random.Random(SEMENTE)
+    v = coopex.ESCALAS_DADOS['pequena']
+    with coopex.app.app_context():
+        coopex.gerar_dados(semente=SEMENTE, log=lambda *a: None, **v)
+        n_coop, n_est = v['cooperados'], v['estabelecimentos']
+        n_story = n_est * v['stories_por_estab']
+        tokens = [coopex.token_app_sintetico(SEMENTE, i) for i in range(1, n_coop + 1)]
+
+        def pontos():
+            return ([{
+                'cooperado_id': rnd.randint(1, n_coop), 'latitude': -23.5, 'longitude': -46.6,
+                'accuracy': 5.0, 'speed': 1.0, 'online': True, 'fonte': 'bench',
+                'atualizado_em': datetime.utcnow(),
+            } for _ in range(rnd.randint(1, 40))],)
+
+        casos = [
+            ('token do app', token_antigo, token_novo, lambda: (rnd.choice(tokens),), args.n),
+            ('último id de lançamento', ultimo_id_antigo, ultimo_id_novo, lambda: (), args.n),
+            ('story view (upsert+stats)', story_view_antiga, story_view_nova,
+             lambda: (rnd.randint(1, n_story), rnd.randint(1, n_coop)), args.n // 2),
+            ('lançamentos do estab.', lista_estab_antiga, lista_estab_nova,
+             lambda: (rnd.randint(1, n_est),), max(5, args.n // 40)),
+            ('upsert localização (lote 1-40)', upsert_loc_antigo, upsert_loc_novo, pontos, args.n // 4),
+        ]
+        print(f"dialeto={db.engine.dialect.name} prepare_threshold="
+              f"{os.environ.get('DB_PREPARE_THRESHOLD', '1')}")
+        print(f"{'caso':<32} {'p50 antes':>10} {'p50 agora':>10} {'cpu antes':>10} {'cpu agora':>10}  (µs/chamada)")
+        for nome, antigo, novo, gerar, n in casos:
+            p50_a, cpu_a = medir(antigo, gerar, n)
+            p50_n, cpu_n = medir(novo, gerar, n)
+            print(f"{nome:<32} {p50_a:>10.0f} {p50_n:>10.0f} {cpu_a:>10.0f} {cpu_n:>10.0f}")
+
+
+if __name__ == '__main__':
+    main()
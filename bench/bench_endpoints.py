@@ -0,0 +1,204 @@
+"""
+Benchmark reproduzível dos endpoints quentes: sobe o app em processo
+(test_client, sem rede), popula o banco com volume realista a partir de uma
+semente fixa e mede latência (p50/p95/p99) e nº de comandos SQL por
+requisição (lidos do Server-Timing). Grava um relatório JSON com chaves
+estáveis para comparar entre commits.
+
+    python bench/bench_endpoints.py --escala pequena --saida antes.json
+    python bench/bench_endpoints.py --escala pequena --saida depois.json --comparar antes.json
+    DATABASE_URL=postgresql://... python bench/bench_endpoints.py   # banco descartável!
+"""
+import argparse
+import json
+import os
+import platform
+import random
+import re
+import statistics
+import subprocess
+import sys
+import tempfile
+import time
+from datetime import datetime, timedelta
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, RAIZ)
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+os.environ.setdefault('AUTO_MIGRATE', '1')
+os.environ.setdefault('TIMING_LOG', '0')
+os.environ.setdefault('SLOW_REQUEST_MS', '1e9')
+os.environ.setdefault('RATE_LIMITS_JSON', json.dumps({
+    ep: {'taxa': 1e6, 'rajada': 1e6, 'concorrencia': 1000}
+    for ep in ('login', 'api_app_localizacao', 'api_app_localizacao_lote', 'registrar_story_view')
+}))
+
+import app as coopex  # noqa: E402
+from app import Admin, db  # noqa: E402
+
+SENHA = 'bench'
+RE_DB = re.compile(r'db;dur=([\d.]+);desc="(\d+) sql"')
+
+
+def popular(v: dict, semente: int):
+    """Mesmo gerador do `flask gerar-dados`, com um admin para o benchmark."""
+    coopex.gerar_dados(semente=semente, senha=SENHA, log=lambda msg: print(msg, file=sys.stderr), **v)
+    admin = Admin(nome='Admin', username='bench_admin')
+    admin.set_senha(SENHA)
+    db.session.add(admin)
+    db.session.commit()
+
+
+def _cliente(username):
+    c = coopex.app.test_client()
+    r = c.post('/login', data={'username': username, 'senha': SENHA})
+    assert r.status_code == 302, (username, r.status_code)
+    return c
+
+
+def cenarios(v: dict, semente: int):
+    rnd = random.Random(semente + 1)
+    n_stories = v['estabelecimentos'] * v['stories_por_estab']
+    hoje = datetime.now(coopex.BR_TZ).date()
+    ini = (hoje - timedelta(days=30)).isoformat()
+    admin, est, coop = _cliente('bench_admin'), _cliente('est3'), _cliente('coop5')
+    tokens = [coopex.token_app_sintetico(semente, i) for i in range(1, v['cooperados'] + 1)]
+    filtro = f'estabelecimento_id=3&data_inicio={ini}'
+
+    def localizacao():
+        return coopex.app.test_client().post('/api/app/localizacao', headers={
+            'Authorization': f'Bearer {rnd.choice(tokens)}',
+        }, json={
+            'latitude': -23.55 + rnd.uniform(-0.1, 0.1), 'longitude': -46.63 + rnd.uniform(-0.1, 0.1),
+        })
+
+    def lancar():
+        return est.post('/painel_estabelecimento', data={
+            'cooperado_id': rnd.randint(1, v['cooperados']), 'valor': '1,00', 'os_numero': 'bench',
+        })
+
+    # (nome, chamada, repetições relativas): exportação é ordens de grandeza mais cara
+    return [
+        ('dashboard', lambda: admin.get('/dashboard'), 1),
+        ('dashboard (estab+30d)', lambda: admin.get(f'/dashboard?{filtro}'), 1),
+        ('listar_lancamentos (estab+30d)', lambda: admin.get(f'/lancamentos?{filtro}'), 1),
+        ('listar_lancamentos (cooperado)', lambda: admin.get('/lancamentos?cooperado_id=5'), 1),
+        ('exportar_lancamentos (estab+30d)', lambda: admin.get(f'/lancamentos/exportar?{filtro}'), 0.25),
+        ('painel_estabelecimento GET', lambda: est.get('/painel_estabelecimento'), 1),
+        ('painel_estabelecimento POST', lancar, 1),
+        ('painel_cooperado', lambda: coop.get('/painel_cooperado'), 1),
+        ('api_app_localizacao', localizacao, 4),
+        ('registrar_story_view', lambda: coop.post('/story/view', json={
+            'story_id': rnd.randint(1, n_stories), 'liked': rnd.random() < 0.3}), 4),
+    ]
+
+
+def _pct(amostras, p):
+    xs = sorted(amostras)
+    return xs[min(len(xs) - 1, int(round(p / 100 * (len(xs) - 1))))]
+
+
+def medir(chamar, repeticoes: int, aquecimento: int = 2) -> dict:
+    for _ in range(aquecimento):
+        chamar()
+    tempos, sqls, dbs, status, tamanhos = [], [], [], {}, []
+    for _ in range(repeticoes):
+        t0 = time.perf_counter()
+        resp = chamar()
+        corpo = resp.get_data()
+        tempos.append((time.perf_counter() - t0) * 1000)
+        tamanhos.append(len(corpo))
+        status[str(resp.status_code)] = status.get(str(resp.status_code), 0) + 1
+        m = RE_DB.search(resp.headers.get('Server-Timing', ''))
+        if m:
+            dbs.append(float(m.group(1)))
+            sqls.append(int(m.group(2)))
+    return {
+        'n': repeticoes,
+        'p50_ms': round(_pct(tempos, 50), 2),
+        'p95_ms': round(_pct(tempos, 95), 2),
+        'p99_ms': round(_pct(tempos, 99), 2),
+        'media_ms': round(statistics.fmean(tempos), 2),
+        'sql_por_req': round(statistics.fmean(sqls), 1) if sqls else None,
+        'db_ms_media': round(statistics.fmean(dbs), 2) if dbs else None,
+        'bytes_media': int(statistics.fmean(tamanhos)),
+        'status': status,
+    }
+
+
+def _commit():
+    try:
+        rev = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=RAIZ,
+                             capture_output=True, text=True, check=True).stdout.strip()
+        sujo = subprocess.run(['git', 'status', '--porcelain', '--untracked-files=no'], cwd=RAIZ,
+                              capture_output=True, text=True).stdout.strip()
+        return rev + ('-sujo' if sujo else '')
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def comparar(atual: dict, anterior: dict):
+    print(f"\n{'cenário':<36} {'p50 antes':>10} {'p50 agora':>10} {'Δ%':>7} {'sql antes':>10} {'sql agora':>10}")
+    for nome, r in atual['endpoints'].items():
+        a = anterior.get('endpoints', {}).get(nome)
+        if not a:
+            print(f"{nome:<36} {'-':>10} {r['p50_ms']:>10.2f}")
+            continue
+        delta = (r['p50_ms'] - a['p50_ms']) / a['p50_ms'] * 100 if a['p50_ms'] else 0.0
+        print(f"{nome:<36} {a['p50_ms']:>10.2f} {r['p50_ms']:>10.2f} {delta:>+7.1f} "
+              f"{a['sql_por_req'] if a['sql_por_req'] is not None else '-':>10} "
+              f"{r['sql_por_req'] if r['sql_por_req'] is not None else '-':>10}")
+
+
+def main():
+    ap = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    ap.add_argument('--escala', choices=sorted(coopex.ESCALAS_DADOS), default='pequena')
+    ap.add_argument('--repeticoes', type=int, default=30)
+    ap.add_argument('--semente', type=int, default=2024)
+    ap.add_argument('--saida', help='arquivo JSON do relatório')
+    ap.add_argument('--comparar', help='relatório JSON anterior para mostrar a diferença')
+    args = ap.parse_args()
+    v = coopex.ESCALAS_DADOS[args.escala]
+
+    with coopex.app.app_context():
+        t0 = time.perf_counter()
+        popular(v, args.semente)
+        carga_s = time.perf_counter() - t0
+        print(f"Banco populado ({args.escala}) em {carga_s:.1f}s", file=sys.stderr)
+
+        resultados = {}
+        for nome, chamar, peso in cenarios(v, args.semente):
+            resultados[nome] = medir(chamar, max(3, int(args.repeticoes * peso)))
+            r = resultados[nome]
+            print(f"{nome:<36} p50 {r['p50_ms']:>8.2f}  p95 {r['p95_ms']:>8.2f}  p99 {r['p99_ms']:>8.2f} ms"
+                  f"  sql {r['sql_por_req']}  status {r['status']}", file=sys.stderr)
+        coopex._LOC_BUFFER.flush()
+
+        relatorio = {
+            'meta': {
+                'commit': _commit(),
+                'quando': datetime.now(coopex.BR_TZ).isoformat(timespec='seconds'),
+                'dialeto': db.engine.dialect.name,
+                'escala': args.escala,
+                'volumes': v,
+                'semente': args.semente,
+                'repeticoes': args.repeticoes,
+                'python': platform.python_version(),
+                'carga_s': round(carga_s, 1),
+            },
+            'endpoints': resultados,
+        }
+
+    texto = json.dumps(relatorio, indent=2, sort_keys=True, ensure_ascii=False)
+    if args.saida:
+        with open(args.saida, 'w', encoding='utf-8') as f:
+            f.write(texto + '\n')
+    else:
+        print(texto)
+    if args.comparar:
+        with open(args.comparar, encoding='utf-8') as f:
+            comparar(relatorio, json.load(f))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,180 @@
+"""
+Requisições/s de cada perfil do gunicorn.conf.py (sync, gthread,
+gthread-preload) com a mesma carga mista:
+  50% POST /api/app/localizacao, 30% GET /lancamentos (admin), 20% GET /login
+
+Usa um SQLite temporário e simula a latência de rede de um Postgres remoto
+com um sleep por statement (--latencia-ms), que é o que faz um worker sync
+ficar parado esperando o banco.
+
+    python bench/bench_gunicorn.py [--segundos 15] [--clientes 16] [--latencia-ms 5]
+"""
+import argparse
+import http.client
+import json
+import os
+import random
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+RAIZ = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+PERFIS = ('sync', 'gthread', 'gthread-preload')
+
+CONF_BENCH = '''
+exec(open({conf!r}).read())
+_post_fork_original = post_fork
+
+
+def post_fork(server, worker):
+    _post_fork_original(server, worker)
+    import time as _t
+    from sqlalchemy import event
+    from app import app, db
+    atraso = int(os.environ.get('BENCH_LATENCIA_MS', '0')) / 1000.0
+    if atraso:
+        with app.app_context():
+            event.listen(db.engine, 'before_cursor_execute', lambda *a, **k: _t.sleep(atraso))
+'''
+
+
+def _preparar_banco(env):
+    codigo = '''
+import app as m
+with m.app.app_context():
+    m.migrar(log=lambda *a: None)
+    a = m.Admin(nome='Admin', username='bench_admin'); a.set_senha('bench')
+    e = m.Estabelecimento(nome='Loja', username='bench_est'); e.set_senha('bench')
+    m.db.session.add_all([a, e]); m.db.session.commit()
+    coops = []
+    for i in range(200):
+        c = m.Cooperado(nome=f'Coop {i}', username=f'coop{i}', credito=1000)
+        c.senha_hash = a.senha_hash; c.ensure_app_token(); coops.append(c)
+    m.db.session.add_all(coops); m.db.session.commit()
+    m.db.session.add_all([
+        m.Lancamento(os_numero=str(i), cooperado_id=coops[i % 200].id, estabelecimento_id=e.id,
+                     valor=10.0, saldo_aberto=10.0)
+        for i in range(300)
+    ])
+    m.db.session.commit()
+    print(json.dumps([(c.id, c.app_token) for c in coops]))
+'''
+    out = subprocess.run([sys.executable, '-c', 'import json\n' + codigo], env=env, cwd=RAIZ,
+                         capture_output=True, text=True, check=True)
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def _esperar_porta(porta, limite=30):
+    fim = time.time() + limite
+    while time.time() < fim:
+        try:
+            c = http.client.HTTPConnection('127.0.0.1', porta, timeout=1)
+            c.request('GET', '/login')
+            c.getresponse().read()
+            return
+        except OSError:
+            time.sleep(0.2)
+    raise RuntimeError('gunicorn não subiu')
+
+
+def _login_admin(porta):
+    c = http.client.HTTPConnection('127.0.0.1', porta)
+    c.request('POST', '/login', body='username=bench_admin&senha=bench',
+              headers={'Content-Type': 'application/x-www-form-urlencoded'})
+    r = c.getresponse()
+    r.read()
+    return r.getheader('Set-Cookie').split(';', 1)[0]
+
+
+def _cliente(porta, fim, tokens, cookie, tempos, erros, seed):
+    rnd = random.Random(seed)
+    conn = http.client.HTTPConnection('127.0.0.1', porta, timeout=30)
+    while time.time() < fim:
+        sorteio = rnd.random()
+        if sorteio < 0.5:
+            cid, tok = rnd.choice(tokens)
+            corpo = json.dumps({'latitude': -23.5 + rnd.random() / 10, 'longitude': -46.6, 'user_id': cid})
+            args = ('POST', '/api/app/localizacao', corpo,
+                    {'Authorization': f'Bearer {tok}', 'Content-Type': 'application/json'})
+        elif sorteio < 0.8:
+            args = ('GET', '/lancamentos', None, {'Cookie': cookie})
+        else:
+            args = ('GET', '/login', None, {})
+        t0 = time.perf_counter()
+        try:
+            conn.request(*args)
+            r = conn.getresponse()
+            r.read()
+            if r.status >= 400:
+                erros.append(r.status)
+        except (OSError, http.client.HTTPException):
+            erros.append('conn')
+            conn.close()
+            conn = http.client.HTTPConnection('127.0.0.1', porta, timeout=30)
+            continue
+        tempos.append((time.perf_counter() - t0) * 1000)
+
+
+def medir(perfil, args, env_base, tokens, porta):
+    conf = os.path.join(tempfile.mkdtemp(), 'gunicorn_bench.conf.py')
+    with open(conf, 'w') as f:
+        f.write(CONF_BENCH.format(conf=os.path.join(RAIZ, 'gunicorn.conf.py')))
+    env = dict(env_base, GUNICORN_PERFIL=perfil, PORT=str(porta), WEB_CONCURRENCY=str(args.workers),
+               BENCH_LATENCIA_MS=str(args.latencia_ms))
+    proc = subprocess.Popen([sys.executable, '-m', 'gunicorn', '-c', conf, 'app:app'], cwd=RAIZ, env=env,
+                            stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    try:
+        _esperar_porta(porta)
+        cookie = _login_admin(porta)
+        tempos, erros = [], []
+        fim = time.time() + args.segundos
+        ths = [threading.Thread(target=_cliente, args=(porta, fim, tokens, cookie, tempos, erros, i))
+               for i in range(args.clientes)]
+        for t in ths:
+            t.start()
+        for t in ths:
+            t.join()
+    finally:
+        proc.terminate()
+        proc.wait(10)
+    tempos.sort()
+    return {
+        'perfil': perfil,
+        'req_s': round(len(tempos) / args.segundos, 1),
+        'p50_ms': round(statistics.median(tempos), 1) if tempos else None,
+        'p99_ms': round(tempos[int(len(tempos) * 0.99)], 1) if tempos else None,
+        'erros': len(erros),
+    }
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--segundos', type=int, default=15)
+    ap.add_argument('--clientes', type=int, default=16)
+    ap.add_argument('--workers', type=int, default=2)
+    ap.add_argument('--latencia-ms', type=int, default=5)
+    ap.add_argument('--perfis', default=','.join(PERFIS))
+    args = ap.parse_args()
+
+    env = dict(os.environ)
+    env['DATABASE_URL'] = f"sqlite:///{tempfile.mkdtemp()}/bench.db"
+    env['RATE_LIMITS_JSON'] = json.dumps({
+        ep: {'taxa': 1e6, 'rajada': 1e6, 'concorrencia': 0}
+        for ep in ('login', 'api_app_localizacao', 'api_app_localizacao_lote', 'registrar_story_view')
+    })
+    tokens = _preparar_banco(env)
+
+    print(f"workers={args.workers} clientes={args.clientes} segundos={args.segundos} "
+          f"latencia_ms={args.latencia_ms}")
+    print('| perfil | req/s | p50 (ms) | p99 (ms) | erros |')
+    print('|---|---:|---:|---:|---:|')
+    for i, perfil in enumerate(args.perfis.split(',')):
+        r = medir(perfil, args, env, tokens, 18000 + i)
+        print(f"| {r['perfil']} | {r['req_s']} | {r['p50_ms']} | {r['p99_ms']} | {r['erros']} |")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,96 @@
+"""
+Benchmark do índice espacial em memória (IndiceEspacial).
+
+Simula 10k cooperados se movendo numa área do tamanho da Grande São Paulo:
+mede a taxa de atualizações de posição e a latência de nearest()/bbox()
+comparando com a varredura linear que seria feita carregando a tabela.
+
+    python bench/bench_indice_espacial.py [--pontos 10000] [--rodadas 20]
+"""
+import argparse
+import os
+import random
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+from app import IndiceEspacial, _distancia_m  # noqa: E402
+
+LAT0, LAT1 = -23.85, -23.35
+LNG0, LNG1 = -46.95, -46.35
+
+
+def _pct(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(len(valores) * p))]
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--pontos', type=int, default=10000)
+    ap.add_argument('--rodadas', type=int, default=20)
+    ap.add_argument('--consultas', type=int, default=500)
+    ap.add_argument('--k', type=int, default=10)
+    ap.add_argument('--seed', type=int, default=42)
+    args = ap.parse_args()
+
+    rnd = random.Random(args.seed)
+    idx = IndiceEspacial()
+    pos = {i: [rnd.uniform(LAT0, LAT1), rnd.uniform(LNG0, LNG1)] for i in range(args.pontos)}
+    agora = time.time()
+
+    t0 = time.perf_counter()
+    for i, (la, ln) in pos.items():
+        idx.atualizar(i, la, ln, agora)
+    carga = time.perf_counter() - t0
+
+    # cada rodada: todos os pontos andam até ~150 m (um heartbeat de app)
+    t0 = time.perf_counter()
+    for r in range(args.rodadas):
+        ts = agora + r + 1
+        for i, p in pos.items():
+            p[0] += rnd.uniform(-0.0015, 0.0015)
+            p[1] += rnd.uniform(-0.0015, 0.0015)
+            idx.atualizar(i, p[0], p[1], ts)
+    atualizacoes = args.pontos * args.rodadas
+    taxa = atualizacoes / (time.perf_counter() - t0)
+    agora += args.rodadas
+
+    alvos = [(rnd.uniform(LAT0, LAT1), rnd.uniform(LNG0, LNG1)) for _ in range(args.consultas)]
+
+    lat_idx = []
+    for la, ln in alvos:
+        t0 = time.perf_counter()
+        idx.nearest(la, ln, k=args.k, max_age=120, agora=agora)
+        lat_idx.append((time.perf_counter() - t0) * 1000)
+
+    lat_lin = []
+    for la, ln in alvos[:50]:
+        t0 = time.perf_counter()
+        sorted((_distancia_m(la, ln, p[0], p[1]), i) for i, p in pos.items())[:args.k]
+        lat_lin.append((time.perf_counter() - t0) * 1000)
+
+    # confere o resultado contra a varredura linear
+    for la, ln in alvos[:20]:
+        esperado = [i for _, i in sorted((_distancia_m(la, ln, p[0], p[1]), i) for i, p in pos.items())[:args.k]]
+        obtido = [x['cooperado_id'] for x in idx.nearest(la, ln, k=args.k, agora=agora)]
+        assert esperado == obtido, (esperado, obtido)
+
+    lat_bbox = []
+    for la, ln in alvos:
+        t0 = time.perf_counter()
+        idx.bbox(la - 0.02, ln - 0.02, la + 0.02, ln + 0.02, max_age=120, agora=agora)
+        lat_bbox.append((time.perf_counter() - t0) * 1000)
+
+    print(f"pontos={args.pontos} carga_inicial={carga * 1000:.1f}ms atualizacoes/s={taxa:,.0f}")
+    print(f"nearest(k={args.k})  p50={statistics.median(lat_idx):.3f}ms p99={_pct(lat_idx, 0.99):.3f}ms")
+    print(f"bbox(~4x4km)    p50={statistics.median(lat_bbox):.3f}ms p99={_pct(lat_bbox, 0.99):.3f}ms")
+    print(f"varredura linear p50={statistics.median(lat_lin):.3f}ms")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Benchmark do login: fluxo antigo (Admin -> Estabelecimento -> Cooperado,
+uma consulta e um PBKDF2 por tabela) x autenticar_principal() (UNION ALL
+numa ida ao banco e um único PBKDF2).
+
+    DATABASE_URL=postgresql://... python bench/bench_login.py --amostras 30
+
+Sem DATABASE_URL usa um SQLite temporário (a diferença de round trips
+aparece muito mais num Postgres remoto).
+"""
+import argparse
+import os
+import statistics
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{tempfile.mkdtemp()}/bench.db")
+
+import app as coopex  # noqa: E402
+from app import Admin, Cooperado, Estabelecimento, db  # noqa: E402
+
+SENHA = 'senha-bench'
+
+
+def login_sequencial(username, senha):
+    """O login() como era antes da consulta unificada."""
+    user = Admin.query.filter_by(username=username).first()
+    if user and user.checar_senha(senha):
+        return 'admin', user.id
+    est = Estabelecimento.query.filter_by(username=username).first()
+    if est and est.checar_senha(senha):
+        return 'estabelecimento', est.id
+    coop = Cooperado.query.filter_by(username=username).first()
+    if coop and coop.checar_senha(senha):
+        coop.ensure_app_token()
+        db.session.commit()
+        return 'cooperado', coop.id
+    return None
+
+
+def _pct(valores, p):
+    valores = sorted(valores)
+    return valores[min(len(valores) - 1, int(round((len(valores) - 1) * p)))]
+
+
+def _medir(fn, username, senha, amostras):
+    tempos = []
+    for _ in range(amostras):
+        t0 = time.perf_counter()
+        fn(username, senha)
+        tempos.append((time.perf_counter() - t0) * 1000)
+        db.session.remove()
+    return tempos
+
+
+def main():
+    ap = argparse.ArgumentParser()
+    ap.add_argument('--amostras', type=int, default=20)
+    args = ap.parse_args()
+
+    with coopex.app.app_context():
+        db.create_all()
+        for modelo, username in ((Admin, 'bench_admin'), (Estabelecimento, 'bench_est'), (Cooperado, 'bench_coop')):
+            if not modelo.query.filter_by(username=username).first():
+                obj = modelo(nome=username, username=username)
+                obj.set_senha(SENHA)
+                db.session.add(obj)
+        db.session.commit()
+
+        cenarios = [
+            ('admin ok', 'bench_admin', SENHA),
+            ('estabelecimento ok', 'bench_est', SENHA),
+            ('cooperado ok', 'bench_coop', SENHA),
+            ('senha errada', 'bench_coop', 'errada'),
+            ('usuario inexistente', 'ninguem', 'x'),
+        ]
+        print(f"metodo={coopex.SENHA_HASH_METODO} amostras={args.amostras} banco={db.engine.dialect.name}")
+        print(f"{'cenario':22} {'antes p50':>10} {'antes p99':>10} {'depois p50':>11} {'depois p99':>11}")
+        for nome, username, senha in cenarios:
+            antes = _medir(login_sequencial, username, senha, args.amostras)
+            depois = _medir(coopex.autenticar_principal, username, senha, args.amostras)
+            print(
+                f"{nome:22} {statistics.median(antes):9.1f}ms {_pct(antes, 0.99):9.1f}ms "
+                f"{statistics.median(depois):10.1f}ms {_pct(depois, 0.99):10.1f}ms"
+            )
+
+
+if __name__ == '__main__':
+    main()
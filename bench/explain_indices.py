@@ -0,0 +1,164 @@
+"""
+Regressão de índices: popula o banco com volume realista, chama os
+endpoints quentes, captura os SELECTs que cada um executa e roda EXPLAIN em
+cada um. Sai com código 1 se aparecer varredura sequencial numa tabela
+grande (lancamento, desconto_lancamento, catalogo_item, story_estabelecimento,
+story_view).
+
+    python bench/explain_indices.py                   # SQLite temporário
+    DATABASE_URL=postgresql://... python bench/explain_indices.py   # banco descartável!
+"""
+import os
+import random
+import re
+import sys
+import tempfile
+from datetime import datetime, timedelta
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{tempfile.mkdtemp()}/explain.db")
+os.environ.setdefault('AUTO_MIGRATE', '1')
+os.environ.setdefault('RATE_LIMITS_JSON', '{"login": {"taxa": 1000, "rajada": 1000}}')
+
+from sqlalchemy import event, insert, text  # noqa: E402
+
+import app as coopex  # noqa: E402
+from app import (  # noqa: E402
+    Admin, CatalogoItem, Cooperado, Estabelecimento, Lancamento,
+    StoryEstabelecimento, StoryView, db,
+)
+
+TABELAS_GRANDES = ('lancamento', 'desconto_lancamento', 'catalogo_item', 'story_estabelecimento', 'story_view')
+N_COOP, N_EST, N_LANC, N_ITENS, N_STORIES, N_VIEWS = 400, 40, 60000, 8000, 1200, 30000
+
+
+def popular():
+    rnd = random.Random(7)
+    agora = datetime.utcnow()
+    admin = Admin(nome='Admin', username='explain_admin')
+    admin.set_senha('explain')
+    db.session.add(admin)
+    db.session.commit()
+    hash_ = admin.senha_hash
+    db.session.execute(insert(Estabelecimento), [
+        {'nome': f'Estab {i}', 'username': f'est{i}', 'senha_hash': hash_} for i in range(N_EST)
+    ])
+    db.session.execute(insert(Cooperado), [
+        {'nome': f'Coop {i}', 'username': f'coop{i}', 'credito': 1000.0, 'senha_hash': hash_}
+        for i in range(N_COOP)
+    ])
+    db.session.execute(insert(Lancamento), [
+        {'data': agora - timedelta(minutes=rnd.randint(0, 60 * 24 * 365)), 'os_numero': str(i),
+         'cooperado_id': rnd.randint(1, N_COOP), 'estabelecimento_id': rnd.randint(1, N_EST),
+         'valor': 10.0, 'saldo_aberto': 10.0, 'parcelas_total': 4, 'concluido': False}
+        for i in range(N_LANC)
+    ])
+    db.session.execute(insert(CatalogoItem), [
+        {'estabelecimento_id': rnd.randint(1, N_EST), 'nome': f'Item {i}', 'valor': 1.0,
+         'criado_em': agora, 'atualizado_em': agora}
+        for i in range(N_ITENS)
+    ])
+    db.session.execute(insert(StoryEstabelecimento), [
+        {'estabelecimento_id': rnd.randint(1, N_EST), 'tipo': 'imagem', 'filename': f's{i}.jpg',
+         'mimetype': 'image/jpeg', 'criado_em': agora - timedelta(days=i % 90),
+         'expira_em': agora - timedelta(days=i % 90) + timedelta(days=1), 'ativo': i % 10 != 0}
+        for i in range(N_STORIES)
+    ])
+    pares = {(rnd.randint(1, N_STORIES), rnd.randint(1, N_COOP)) for _ in range(N_VIEWS)}
+    db.session.execute(insert(StoryView), [
+        {'story_id': s, 'cooperado_id': c, 'viu_em': agora, 'curtiu': rnd.random() < 0.3}
+        for s, c in pares
+    ])
+    db.session.commit()
+    with db.engine.begin() as conn:
+        conn.execute(text('ANALYZE'))
+
+
+def _cliente_logado(username):
+    c = coopex.app.test_client()
+    r = c.post('/login', data={'username': username, 'senha': 'explain'})
+    assert r.status_code == 302, (username, r.status_code)
+    return c
+
+
+def cenarios():
+    hoje = datetime.now(coopex.BR_TZ).date()
+    ini = (hoje - timedelta(days=30)).isoformat()
+    admin = _cliente_logado('explain_admin')
+    est = _cliente_logado('est3')
+    coop = _cliente_logado('coop5')
+    return [
+        ('painel_estabelecimento', lambda: est.get('/painel_estabelecimento')),
+        ('painel_estabelecimento (filtro)', lambda: est.get(f'/painel_estabelecimento?data_inicio={ini}')),
+        ('painel_cooperado', lambda: coop.get('/painel_cooperado')),
+        ('registrar_story_view', lambda: coop.post('/story/view', json={'story_id': 2})),
+        ('lancamentos (estab)', lambda: admin.get('/lancamentos?estabelecimento_id=3')),
+        ('dashboard (estab)', lambda: admin.get(f'/dashboard?estabelecimento_id=3&data_inicio={ini}')),
+        ('extrato', lambda: coop.get('/api/cooperado/extrato?limite=50')),
+        ('extrato (cursor)', lambda: coop.get('/api/cooperado/extrato', query_string={
+            'limite': 50, 'cursor': coop.get('/api/cooperado/extrato?limite=50').get_json()['proximo_cursor']})),
+    ]
+
+
+def _plano(conn_dbapi, dialeto, sql, params):
+    cur = conn_dbapi.cursor()
+    if dialeto == 'sqlite':
+        cur.execute('EXPLAIN QUERY PLAN ' + sql, params)
+        return [r[-1] for r in cur.fetchall()]
+    cur.execute('EXPLAIN ' + sql, params)
+    return [r[0] for r in cur.fetchall()]
+
+
+def _varreduras(dialeto, plano):
+    achadas = []
+    for linha in plano:
+        if dialeto == 'sqlite':
+            m = re.match(r'\s*SCAN (\w+)(.*)', linha)
+            if m and m.group(1) in TABELAS_GRANDES and 'USING' not in m.group(2):
+                achadas.append(m.group(1))
+        else:
+            m = re.search(r'Seq Scan on (\w+)', linha)
+            if m and m.group(1) in TABELAS_GRANDES:
+                achadas.append(m.group(1))
+    return achadas
+
+
+def main():
+    with coopex.app.app_context():
+        popular()
+        capturados = []
+
+        @event.listens_for(db.engine, 'before_cursor_execute')
+        def _capturar(conn, cursor, statement, parameters, context, executemany):
+            if statement.lstrip().upper().startswith('SELECT') and not executemany:
+                capturados.append((statement, parameters))
+
+        dialeto = db.engine.dialect.name
+        falhas = 0
+        for nome, chamar in cenarios():
+            capturados.clear()
+            resp = chamar()
+            assert resp.status_code < 400, (nome, resp.status_code)
+            consultas = list(capturados)
+            falhas_cenario = 0
+            raw = db.engine.raw_connection()
+            try:
+                for sql, params in consultas:
+                    varridas = _varreduras(dialeto, _plano(raw, dialeto, sql, params))
+                    if varridas:
+                        falhas_cenario += 1
+                        print(f"FALHOU {nome}: seq scan em {', '.join(varridas)}\n"
+                              f"       {' '.join(sql.split())[:300]}")
+            finally:
+                raw.close()
+            if not falhas_cenario:
+                print(f"ok     {nome}: {len(consultas)} consultas verificadas")
+            falhas += falhas_cenario
+        if falhas:
+            print(f"{falhas} consulta(s) com varredura sequencial em tabela grande.")
+            sys.exit(1)
+        print('Nenhuma varredura sequencial em tabela grande.')
+
+
+if __name__ == '__main__':
+    main()
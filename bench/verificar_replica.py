@@ -0,0 +1,84 @@
+"""
+Verifica o roteamento primário/réplica com dois SQLite locais: a réplica
+tem o cooperado com outro nome (marcador), e o teste confere quem
+respondeu cada requisição.
+
+    python bench/verificar_replica.py
+
+Para dois Postgres locais, exporte DATABASE_URL e DATABASE_REPLICA_URL antes
+(bancos descartáveis; os dois são migrados e populados pelo script).
+"""
+import os
+import sys
+import tempfile
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+_tmp = tempfile.mkdtemp()
+os.environ.setdefault('DATABASE_URL', f"sqlite:///{_tmp}/primario.db")
+os.environ.setdefault('DATABASE_REPLICA_URL', f"sqlite:///{_tmp}/replica.db")
+os.environ.setdefault('AUTO_MIGRATE', '1')
+os.environ.setdefault('REPLICA_JANELA_S', '1')
+os.environ.setdefault('TIMING_LOG', '0')
+
+from sqlalchemy import insert  # noqa: E402
+
+import app as coopex  # noqa: E402
+from app import Admin, Cooperado, Estabelecimento, db  # noqa: E402
+
+MARCADOR = 'SO-NA-REPLICA'
+
+
+def preparar():
+    replica = db.engines['replica']
+    for engine in (db.engine, replica):
+        with engine.begin() as conn:
+            for _, _, fn in coopex._MIGRACOES:
+                fn(conn)
+    admin = Admin(nome='Admin', username='replica_admin')
+    admin.set_senha('x')
+    for engine, nome_coop in ((db.engine, 'Ana'), (replica, f'Ana {MARCADOR}')):
+        with engine.begin() as conn:
+            conn.execute(insert(Admin), [{'nome': 'Admin', 'username': 'replica_admin', 'senha_hash': admin.senha_hash}])
+            conn.execute(insert(Cooperado), [{'nome': nome_coop, 'username': 'ana', 'credito': 100.0}])
+            conn.execute(insert(Estabelecimento), [{'nome': 'Loja', 'username': 'loja', 'senha_hash': admin.senha_hash}])
+
+
+def main():
+    falhas = 0
+
+    def conferir(nome, resp, esperado_replica):
+        nonlocal falhas
+        veio_da_replica = MARCADOR in resp.get_data(as_text=True)
+        ok = resp.status_code == 200 and veio_da_replica == esperado_replica
+        falhas += not ok
+        print(f"{'ok    ' if ok else 'FALHOU'} {nome}: status {resp.status_code}, "
+              f"respondeu {'réplica' if veio_da_replica else 'primário'}")
+
+    with coopex.app.app_context():
+        preparar()
+    c = coopex.app.test_client()
+    assert c.post('/login', data={'username': 'replica_admin', 'senha': 'x'}).status_code == 302
+
+    conferir('lancamentos sem escrita recente', c.get('/lancamentos'), True)
+    conferir('dashboard sem escrita recente', c.get('/dashboard'), True)
+    # escrita do próprio admin (ajuste de crédito) abre a janela read-your-writes
+    r = c.post('/ajustar_credito/1', data={'credito': '150'})
+    print(f"       escrita: status {r.status_code}")
+    conferir('lancamentos logo após escrever', c.get('/lancamentos'), False)
+    outro = coopex.app.test_client()
+    outro.post('/login', data={'username': 'replica_admin', 'senha': 'x'})
+    conferir('outra sessão no mesmo instante', outro.get('/lancamentos'), True)
+    time.sleep(float(os.environ['REPLICA_JANELA_S']) + 0.2)
+    conferir('lancamentos depois da janela', c.get('/lancamentos'), True)
+    est = coopex.app.test_client()
+    est.post('/login', data={'username': 'loja', 'senha': 'x'})
+    conferir('painel_estabelecimento (sem @ler_da_replica)', est.get('/painel_estabelecimento'), False)
+
+    if falhas:
+        sys.exit(1)
+    print('Roteamento primário/réplica ok.')
+
+
+if __name__ == '__main__':
+    main()
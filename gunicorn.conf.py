@@ -0,0 +1,62 @@
+# gunicorn.conf.py
+"""
+Configuração do gunicorn em produção (o gunicorn lê este arquivo sozinho
+quando roda na raiz do projeto).
+
+Perfis (GUNICORN_PERFIL):
+- "gthread-preload" (padrão): app importado uma vez no master antes do fork,
+  workers gthread; o engine do SQLAlchemy é descartado em cada worker
+  (post_fork) para nenhum processo herdar as conexões do pool do master.
+  Com APP_ENV=producao os templates são pré-compilados no import, então os
+  workers já nascem com eles compilados.
+- "gthread": workers gthread, cada worker importa o app.
+- "sync": o comportamento antigo (`gunicorn app:app` puro).
+
+Threads por worker = pool_size + max_overflow - conexões das tarefas de fundo
+do app (tarefas_fundo.py), assim toda thread de requisição consegue uma
+conexão sem esperar pool_timeout.
+Números de cada perfil em bench/README.md.
+"""
+import multiprocessing
+import os
+
+from tarefas_fundo import CONEXOES_FUNDO
+
+perfil = os.environ.get('GUNICORN_PERFIL', 'gthread-preload')
+
+# Mesmos valores padrão do SQLALCHEMY_ENGINE_OPTIONS em app.py
+_POOL_SIZE = int(os.environ.get('DB_POOL_SIZE', '5'))
+_MAX_OVERFLOW = int(os.environ.get('DB_MAX_OVERFLOW', '10'))
+
+bind = f"0.0.0.0:{os.environ.get('PORT', '5000')}"
+workers = int(os.environ.get('WEB_CONCURRENCY', min(multiprocessing.cpu_count() * 2 + 1, 4)))
+
+if perfil == 'sync':
+    worker_class = 'sync'
+    preload_app = False
+else:
+    worker_class = 'gthread'
+    threads = int(os.environ.get(
+        'GUNICORN_THREADS', max(1, _POOL_SIZE + _MAX_OVERFLOW - CONEXOES_FUNDO)
+    ))
+    preload_app = perfil == 'gthread-preload'
+
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', '60'))
+graceful_timeout = 30
+keepalive = 5
+# recicla workers aos poucos (protege contra vazamento de memória)
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', '2000'))
+max_requests_jitter = max_requests // 10
+if os.path.isdir('/dev/shm'):
+    worker_tmp_dir = '/dev/shm'
+accesslog = os.environ.get('GUNICORN_ACCESSLOG') or None
+
+
+def post_fork(server, worker):
+    """Depois do fork: o worker abre as próprias conexões (não usa as do master)."""
+    if not preload_app:
+        return
+    from app import app, db
+    with app.app_context():
+        for engine in db.engines.values():   # primário e réplica (se houver)
+            engine.dispose(close=False)
@@ -0,0 +1,16 @@
+# tarefas_fundo.py
+"""
+Tarefas de fundo que o app sobe em cada worker (_garantir_thread_fundo em
+app.py) e quantas conexões do pool cada uma segura ao mesmo tempo. Fica fora
+do app.py para o gunicorn.conf.py dimensionar as threads sem importar o app.
+"""
+
+# nome -> conexões do pool ocupadas enquanto a tarefa roda
+TAREFAS_FUNDO = {
+    'loc_flush': 1,   # upsert das posições e depois o histórico, um engine.begin() por vez
+    'presenca': 1,    # UPDATEs de presença numa transação
+    'geo_sync': 1,    # leitura do que outros workers gravaram
+    'pool': 0,        # ajuste do pool adaptativo: só lê a telemetria
+}
+
+CONEXOES_FUNDO = sum(TAREFAS_FUNDO.values())